@@ -11,6 +11,7 @@ from pyroclast.boost_resnet.loss import (
     calculate_multiclass_gamma_tilde, initial_multiclass_distribution,
     multiclass_loss, update_binary_distribution)
 from pyroclast.boost_resnet.models import repr_module, classification_module
+from pyroclast.common.tf_util import normalize_image
 
 
 def learn(data_dict,
@@ -66,7 +67,7 @@ def learn(data_dict,
             print("TRAIN")
             for batch in tqdm(data_dict['train'], total=data_dict['train_bpe']):
                 global_step.assign_add(1)
-                x = tf.cast(batch['image'], tf.float32) / 255.
+                x = normalize_image(batch['image'])
                 label = batch['label']
                 if type(distribution_update_fn) is UpdateMulticlassDistribution:
                     distribution_update_fn.state = 0.
@@ -135,7 +136,7 @@ def learn(data_dict,
             print("TEST")
             batch_accuracies = []
             for batch in tqdm(data_dict['test'], total=data_dict['test_bpe']):
-                x = tf.cast(batch['image'], tf.float32) / 255.
+                x = normalize_image(batch['image'])
                 label = batch['label']
                 if type(distribution_update_fn) is UpdateMulticlassDistribution:
                     distribution_update_fn.state = 0.
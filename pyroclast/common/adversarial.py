@@ -80,3 +80,194 @@ def linear_optimization(jacobian, eps, norm):
 
     scaled_perturbation = tf.multiply(eps, optimal_perturbation)
     return scaled_perturbation
+
+
+def _datum_axes(x):
+    return list(range(1, len(x.shape)))
+
+
+def steepest_descent_direction(grad, norm):
+    """Unit-norm direction of steepest ascent of a linear function per datum
+
+    Unlike `linear_optimization`, the norm is taken over all data dimensions.
+
+    Args:
+        grad (Tensor): shape [N,...] with gradients of output w.r.t. data
+        norm (1, 2, or np.inf): norm of the unit ball the direction lies in
+
+    Returns:
+        direction (Tensor): shape [N,...]
+    """
+    axis = _datum_axes(grad)
+    if norm == np.inf:
+        return tf.sign(grad)
+    elif norm == 2:
+        square = tf.reduce_sum(tf.square(grad), axis, keepdims=True)
+        return grad / tf.sqrt(tf.maximum(1e-12, square))
+    elif norm == 1:
+        abs_grad = tf.abs(grad)
+        max_abs_grad = tf.reduce_max(abs_grad, axis, keepdims=True)
+        tied_for_max = tf.cast(tf.equal(abs_grad, max_abs_grad), grad.dtype)
+        num_ties = tf.reduce_sum(tied_for_max, axis, keepdims=True)
+        return tf.sign(grad) * tied_for_max / num_ties
+    raise NotImplementedError()
+
+
+def project_onto_ball(delta, eps, norm):
+    """Euclidean projection of each datum onto the norm ball of radius eps
+
+    Args:
+        delta (Tensor): shape [N,...]
+        eps (Tensor): radius, broadcastable to delta, e.g. shape [N,1,...,1]
+        norm (1, 2, or np.inf): norm defining the ball
+
+    Returns:
+        projected (Tensor): shape [N,...]
+    """
+    axis = _datum_axes(delta)
+    if norm == np.inf:
+        return tf.clip_by_value(delta, -eps, eps)
+    elif norm == 2:
+        l2 = tf.sqrt(tf.reduce_sum(tf.square(delta), axis, keepdims=True))
+        return delta * tf.minimum(1., eps / tf.maximum(1e-12, l2))
+    elif norm == 1:
+        # sort-based algorithm of Duchi et al., "Efficient Projections onto
+        # the l1-Ball for Learning in High Dimensions"
+        flat = tf.reshape(delta, [tf.shape(delta)[0], -1])
+        flat_eps = tf.reshape(tf.broadcast_to(eps, tf.shape(delta)),
+                              tf.shape(flat))[:, :1]
+        abs_flat = tf.abs(flat)
+        mu = tf.sort(abs_flat, axis=1, direction='DESCENDING')
+        cumsum = tf.cumsum(mu, axis=1)
+        j = tf.cast(tf.range(1, tf.shape(flat)[1] + 1), delta.dtype)
+        rho = tf.reduce_sum(tf.cast(mu * j > cumsum - flat_eps, tf.int32),
+                            axis=1,
+                            keepdims=True)
+        # a zero radius counts no coordinates, its projection is still zero
+        rho = tf.maximum(rho, 1)
+        theta = (tf.gather(cumsum, rho - 1, batch_dims=1) - flat_eps) / tf.cast(
+            rho, delta.dtype)
+        projected = tf.sign(flat) * tf.maximum(abs_flat - theta, 0.)
+        inside = tf.reduce_sum(abs_flat, axis=1, keepdims=True) <= flat_eps
+        return tf.reshape(tf.where(inside, flat, projected), tf.shape(delta))
+    raise NotImplementedError()
+
+
+def random_ball_sample(shape, eps, norm, dtype=tf.float32):
+    """Random points in the norm ball of radius eps, used as attack starts
+
+    Args:
+        shape (Tensor): shape [N,...] of the sample
+        eps (Tensor): radius, broadcastable to shape, e.g. shape [N,1,...,1]
+        norm (1, 2, or np.inf): norm defining the ball
+    """
+    if norm == np.inf:
+        return tf.random.uniform(shape, -1., 1., dtype) * eps
+    elif norm == 2:
+        direction = tf.random.normal(shape, dtype=dtype)
+        length = tf.sqrt(
+            tf.reduce_sum(tf.square(direction),
+                          _datum_axes(direction),
+                          keepdims=True))
+    elif norm == 1:
+        # Laplace distributed coordinates normalize to a uniform direction
+        direction = tf.sign(tf.random.normal(shape, dtype=dtype)) * \
+            tf.random.gamma(shape, 1., dtype=dtype)
+        length = tf.reduce_sum(tf.abs(direction),
+                               _datum_axes(direction),
+                               keepdims=True)
+    else:
+        raise NotImplementedError()
+    radius = tf.random.uniform(tf.shape(length), dtype=dtype)
+    return direction / tf.maximum(1e-12, length) * radius * eps
+
+
+@tf.function
+def projected_gradient_descent(forward_fn,
+                               x,
+                               eps,
+                               norm,
+                               num_steps,
+                               step_size=None,
+                               random_start=False,
+                               clip_min=None,
+                               clip_max=None,
+                               stop_fn=None,
+                               forward_args=()):
+    """
+    Madry et al.'s projected gradient descent attack, the iterated version of
+    `fast_gradient_method`. All steps run in a single compiled loop, for a
+    whole batch of data and optionally a whole batch of epsilons at once.
+
+    Keep forward_fn and stop_fn the same objects across calls (rather than
+    new lambdas), or every call is traced again.
+
+    Args:
+        forward_fn: forward pass from input data (and forward_args) to a tensor of shape () per input datum
+        x (Tensor): input data of shape [N,...]
+        eps (float or Tensor): norm constraint on the delta, either a scalar or a vector of E epsilons all attacked at once
+        norm (1, 2, or np.inf): norm choosing constraint set to optimize
+        num_steps (int): maximum number of gradient steps
+        step_size (float): size of each step relative to eps, defaults to 2.5 / num_steps
+        random_start (bool): if True, start from a random point in the norm ball
+        clip_min (float): optional lower bound on perturbed data
+        clip_max (float): optional upper bound on perturbed data
+        stop_fn: optional function from perturbed data (and forward_args) to a bool per datum, True freezes that datum's perturbation, e.g. once misclassified. The loop exits early when all data are frozen.
+        forward_args (tuple of Tensor): per datum arguments of shape [N,...] passed to forward_fn and stop_fn, e.g. labels
+
+    Returns:
+        perturbation (Tensor): data-space adversarial perturbation which, added \
+            to the original input, minimizes the output of forward_fn. Of shape \
+            [N,...], or [E,N,...] if eps is a vector.
+    """
+    eps = tf.cast(eps, x.dtype)
+    is_eps_batch = len(eps.shape) == 1
+    eps = tf.reshape(eps, [-1])
+    num_eps = tf.shape(eps)[0]
+    num_data = tf.shape(x)[0]
+    ones = [1] * (len(x.shape) - 1)
+
+    # the data are tiled once per epsilon, eps-major
+    tile = lambda t: tf.tile(t, [num_eps] + [1] * (len(t.shape) - 1))
+    x = tile(x)
+    forward_args = [tile(arg) for arg in forward_args]
+    eps = tf.reshape(tf.repeat(eps, num_data), [-1] + ones)
+    if step_size is None:
+        step_size = 2.5 / num_steps
+    step = step_size * eps
+
+    def clip(delta):
+        if clip_min is None and clip_max is None:
+            return delta
+        x_min = x.dtype.min if clip_min is None else clip_min
+        x_max = x.dtype.max if clip_max is None else clip_max
+        return tf.clip_by_value(x + delta, x_min, x_max) - x
+
+    if random_start:
+        delta = clip(random_ball_sample(tf.shape(x), eps, norm, x.dtype))
+    else:
+        delta = tf.zeros_like(x)
+    done = tf.zeros([tf.shape(x)[0]], tf.bool)
+
+    def cond(i, delta, done):
+        return tf.logical_and(i < num_steps,
+                              tf.logical_not(tf.reduce_all(done)))
+
+    def body(i, delta, done):
+        if stop_fn is not None:
+            done = tf.logical_or(done, stop_fn(x + delta, *forward_args))
+        with tf.GradientTape(watch_accessed_variables=False) as tape:
+            tape.watch(delta)
+            output = forward_fn(x + delta, *forward_args)
+        grad = tape.gradient(output, delta)
+        new_delta = delta - step * steepest_descent_direction(grad, norm)
+        new_delta = clip(project_onto_ball(new_delta, eps, norm))
+        delta = tf.where(tf.reshape(done, [-1] + ones), delta, new_delta)
+        return i + 1, delta, done
+
+    _, delta, _ = tf.while_loop(cond, body, [tf.constant(0), delta, done])
+    if is_eps_batch:
+        delta = tf.reshape(
+            delta, tf.concat(
+                [[num_eps, num_data], tf.shape(delta)[1:]], 0))
+    return delta
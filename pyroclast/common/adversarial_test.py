@@ -0,0 +1,66 @@
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+
+from pyroclast.common.adversarial import (project_onto_ball,
+                                          projected_gradient_descent)
+
+
+def datum_norm(x, norm):
+    return np.linalg.norm(np.reshape(x, [x.shape[0], -1]), ord=norm, axis=1)
+
+
+def linear_forward_fn(x, w):
+    return tf.reduce_sum(tf.reshape(x * w, [tf.shape(x)[0], -1]), axis=1)
+
+
+class AdversarialTest(parameterized.TestCase):
+
+    @parameterized.parameters(1, 2, np.inf)
+    def test_project_onto_ball(self, norm):
+        delta = tf.random.normal([4, 5, 5, 3])
+        eps = tf.reshape(tf.constant([0.1, 1., 10., 100.]), [4, 1, 1, 1])
+        projected = project_onto_ball(delta, eps, norm).numpy()
+        assert np.all(
+            datum_norm(projected, norm) <= eps.numpy().flatten() + 1e-4)
+        # data already inside the ball are unchanged
+        np.testing.assert_allclose(projected[-1], delta[-1], atol=1e-5)
+
+    @parameterized.parameters(1, 2, np.inf)
+    def test_project_onto_zero_ball(self, norm):
+        delta = tf.random.normal([2, 5, 5, 3])
+        projected = project_onto_ball(delta, 0., norm).numpy()
+        np.testing.assert_allclose(projected, 0., atol=1e-6)
+
+    @parameterized.parameters(1, 2, np.inf)
+    def test_projected_gradient_descent(self, norm):
+        x = tf.random.uniform([3, 4, 4, 1])
+        w = tf.random.normal([3, 4, 4, 1])
+        eps = tf.constant([0.01, 0.1])
+        perturbation = projected_gradient_descent(linear_forward_fn,
+                                                  x,
+                                                  eps,
+                                                  norm,
+                                                  20,
+                                                  random_start=True,
+                                                  forward_args=(w,)).numpy()
+        assert perturbation.shape == (2, 3, 4, 4, 1)
+        for i, e in enumerate(eps.numpy()):
+            assert np.all(datum_norm(perturbation[i], norm) <= e + 1e-4)
+            # a linear function is minimized on the boundary of the ball
+            change = linear_forward_fn(perturbation[i], w).numpy()
+            assert np.all(change < 0.)
+
+    def test_stop_fn_freezes_data(self):
+        x = tf.zeros([2, 3])
+        w = tf.ones([2, 3])
+        stop_fn = lambda x, w: tf.constant([True, False])
+        perturbation = projected_gradient_descent(linear_forward_fn,
+                                                  x,
+                                                  1.,
+                                                  2,
+                                                  10,
+                                                  stop_fn=stop_fn,
+                                                  forward_args=(w,)).numpy()
+        assert np.all(perturbation[0] == 0.)
+        assert np.all(perturbation[1] < 0.)
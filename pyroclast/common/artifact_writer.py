@@ -0,0 +1,158 @@
+"""Writes images, figures and Graphviz files off the training thread
+
+Encoding a PNG or rendering a decision tree can take longer than a
+training step. An `ArtifactWriter` hands that work to a pool of worker
+processes using the headless Agg backend, so callers only pay for
+pickling their arrays or figures.
+
+    with ArtifactWriter() as artifact_writer:
+        artifact_writer.save_array('sample.png', image)
+        artifact_writer.save_figure('heatmap.png', fig)
+        artifact_writer.save_dot('tree.dot', dot_source)
+
+Workers are spawned, so each one imports the `__main__` module of the
+process that created the writer. Library code and `python -m
+pyroclast.run` are unaffected, but a script which creates a writer must
+do so under `if __name__ == '__main__':`, or every worker would run the
+script again.
+"""
+import multiprocessing
+import os
+import pickle
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def _init_worker():
+    # pyplot is only imported inside functions, so it loads after this
+    os.environ['MPLBACKEND'] = 'Agg'
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _save_array(path, array, cmap, vmin, vmax):
+    import matplotlib.pyplot as plt
+    plt.imsave(path, array, cmap=cmap, vmin=vmin, vmax=vmax)
+    return path
+
+
+def _save_figure(path, pickled_fig, savefig_kwargs):
+    import matplotlib.pyplot as plt
+    fig = pickle.loads(pickled_fig)
+    fig.savefig(path, **savefig_kwargs)
+    plt.close(fig)
+    return path
+
+
+def _save_dot(path, source, render_format):
+    if source is not None:
+        with open(path, 'w') as dot_file:
+            dot_file.write(source)
+    if render_format is None:
+        return path
+    if shutil.which('dot') is None:
+        print('Graphviz dot not found, {} was not rendered'.format(path))
+        return path
+    rendered_path = '{}.{}'.format(os.path.splitext(path)[0], render_format)
+    subprocess.run(['dot', '-T' + render_format, path, '-o', rendered_path],
+                   check=True)
+    return rendered_path
+
+
+class ArtifactWriter(object):
+    """Pool of processes which encode and save artifacts
+
+    Calls return immediately. Exceptions raised by a worker are re-raised
+    by the next call after the failed write finishes, or by `wait`.
+    """
+
+    def __init__(self, max_workers=2, max_pending=None):
+        """
+        Args:
+            max_workers (int): Number of worker processes
+            max_pending (int): Optional, calls block while this many writes are unfinished, bounding memory held by queued artifacts
+        """
+        # spawned workers don't inherit the caller's TensorFlow runtime
+        self._executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker)
+        self.max_pending = max_pending
+        self._pending = []
+
+    def _submit(self, fn, *args):
+        self._collect(block=False)
+        if self.max_pending is not None:
+            while len(self._pending) >= self.max_pending:
+                self._pending[0].result()
+                self._collect(block=False)
+        future = self._executor.submit(fn, *args)
+        self._pending.append(future)
+        return future
+
+    def _collect(self, block):
+        pending = []
+        for future in self._pending:
+            if block or future.done():
+                # raises the worker's exception, if any
+                future.result()
+            else:
+                pending.append(future)
+        self._pending = pending
+
+    def save_array(self, path, array, cmap=None, vmin=None, vmax=None):
+        """Saves an array as an image
+
+        Args:
+            path (str): Path of the image, its extension sets the format
+            array (np.array): shape [height, width] or [height, width, 3 or 4], copied when called
+            cmap (str): Optional, colormap of single channel arrays
+        """
+        return self._submit(_save_array, path, np.array(array), cmap, vmin,
+                            vmax)
+
+    def save_figure(self, path, fig, close=True, **savefig_kwargs):
+        """Saves a matplotlib figure
+
+        Args:
+            path (str): Path of the image, its extension sets the format
+            fig (matplotlib.figure.Figure): Figure to save, as it is when called
+            close (bool): Whether to close the figure in this process once submitted
+        """
+        # pickled here, so later changes to the figure aren't saved
+        future = self._submit(_save_figure, path, pickle.dumps(fig),
+                              savefig_kwargs)
+        if close:
+            import matplotlib.pyplot as plt
+            plt.close(fig)
+        return future
+
+    def save_dot(self, path, source=None, render_format='png'):
+        """Writes a Graphviz file and renders it with dot
+
+        Args:
+            path (str): Path of the .dot file
+            source (str): Optional, contents of the .dot file, if None the file at path is only rendered
+            render_format (str): Optional, format passed to `dot -T`, None skips rendering
+        """
+        return self._submit(_save_dot, path, source, render_format)
+
+    def wait(self):
+        """Blocks until every submitted artifact is written"""
+        self._collect(block=True)
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,64 @@
+import os
+import os.path as osp
+import tempfile
+
+import matplotlib.pyplot as plt
+import numpy as np
+from absl.testing import parameterized
+
+from pyroclast.common.artifact_writer import ArtifactWriter
+
+
+class ArtifactWriterTest(parameterized.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def test_artifacts_written(self):
+        array = np.random.uniform(size=[6, 5])
+        fig = plt.figure()
+        plt.plot([0, 1], [1, 0])
+        with ArtifactWriter() as artifact_writer:
+            artifact_writer.save_array(osp.join(self.output_dir, 'array.png'),
+                                       array,
+                                       cmap='gray')
+            artifact_writer.save_figure(osp.join(self.output_dir, 'fig.png'),
+                                        fig)
+            artifact_writer.save_dot(osp.join(self.output_dir, 'tree.dot'),
+                                     'digraph { a -> b }',
+                                     render_format=None)
+        assert plt.imread(osp.join(self.output_dir,
+                                   'array.png')).shape[:2] == (6, 5)
+        assert plt.imread(osp.join(self.output_dir, 'fig.png')).ndim == 3
+        with open(osp.join(self.output_dir, 'tree.dot')) as dot_file:
+            assert dot_file.read() == 'digraph { a -> b }'
+
+    def test_close_drains_pending_writes(self):
+        artifact_writer = ArtifactWriter(max_workers=1)
+        for i in range(20):
+            artifact_writer.save_array(
+                osp.join(self.output_dir, '{}.png'.format(i)),
+                np.random.uniform(size=[64, 64, 3]))
+        artifact_writer.close()
+        assert sorted(os.listdir(self.output_dir)) == sorted(
+            '{}.png'.format(i) for i in range(20))
+
+    def test_worker_error_surfaces(self):
+        artifact_writer = ArtifactWriter()
+        artifact_writer.save_array(
+            osp.join(self.output_dir, 'missing', 'array.png'), np.zeros([2, 2]))
+        with self.assertRaises(FileNotFoundError):
+            artifact_writer.close()
+
+    @parameterized.parameters(1, 3)
+    def test_max_pending_bound(self, max_pending):
+        futures = []
+        with ArtifactWriter(max_workers=1,
+                            max_pending=max_pending) as artifact_writer:
+            for i in range(10):
+                futures.append(
+                    artifact_writer.save_array(
+                        osp.join(self.output_dir, '{}.png'.format(i)),
+                        np.random.uniform(size=[256, 256, 3])))
+                assert sum(not f.done() for f in futures) <= max_pending
+        assert all(f.done() for f in futures)
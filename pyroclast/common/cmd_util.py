@@ -53,6 +53,27 @@ def common_arg_parser():
                         default=None)
     parser.add_argument('--data_limit', type=int, default=-1)
     parser.add_argument('--data_dir', type=str, default=None)
+    parser.add_argument('--shuffle_buffer_size', type=int, default=1024)
+    parser.add_argument('--cache_data',
+                        help="""Cache decoded data after resizing. Empty
+                        string caches in memory, otherwise a directory to cache
+                        on disk.""",
+                        type=str,
+                        default=None)
+    parser.add_argument('--snapshot_dir',
+                        help="""Directory of decoded dataset snapshots shared
+                        by runs on this machine.""",
+                        type=str,
+                        default=None)
+    parser.add_argument('--data_server',
+                        help="""Address of a local data server (see
+                        pyroclast.common.data_server) to load data from.""",
+                        type=str,
+                        default=None)
+    parser.add_argument('--normalize_data',
+                        help='Batch images as float32 in [0,1]',
+                        action='store_true')
+    parser.add_argument('--drop_remainder', action='store_true')
     parser.add_argument('--output_dir', type=str, default='./')
     parser.add_argument('--debug', action='store_true')
     return parser
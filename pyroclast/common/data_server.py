@@ -0,0 +1,129 @@
+"""Local data server shared by concurrent training processes
+
+The server decodes each requested dataset once into a snapshot (see
+`pyroclast.common.snapshot`) in a shared memory directory and keeps it
+alive for as long as it runs. Training processes started with
+`--data_server <address>` ask the server for a dataset and then
+memory-map the same pages, each shuffling and batching with its own seed.
+
+Start a server with:
+`python -m pyroclast.common.data_server --address /tmp/pyroclast_data_server`
+"""
+import os
+import shutil
+import sys
+from multiprocessing.connection import Client, Listener
+
+import tensorflow as tf
+
+from pyroclast.common.cmd_util import arg_parser
+from pyroclast.common.snapshot import (load_snapshot, snapshot_dataset,
+                                       snapshot_key)
+from pyroclast.common.tf_util import normalize_image, setup_tfds
+
+AUTHKEY = b'pyroclast'
+METADATA_KEYS = [
+    'name', 'num_classes', 'shape', 'train_num', 'test_num', 'snapshot_dir'
+]
+
+
+def serve(address, snapshot_dir, data_dir=None):
+    """Serves dataset snapshots until interrupted
+
+    Args:
+        address (str): Path of the unix socket to listen on
+        snapshot_dir (str): Shared memory directory to hold snapshots, e.g. under /dev/shm
+        data_dir (str): Directory where TFDS should look for the data files
+    """
+    with Listener(address, family='AF_UNIX', authkey=AUTHKEY) as listener:
+        print('Serving data at', address)
+        while True:
+            with listener.accept() as conn:
+                request = conn.recv()
+                try:
+                    data_dict = setup_tfds(request['dataset'],
+                                           1,
+                                           request['resize_data_shape'],
+                                           request['data_limit'],
+                                           data_dir,
+                                           snapshot_dir=snapshot_dir)
+                    data_dict['snapshot_dir'] = snapshot_dir
+                    data_dict['shape'] = list(data_dict['shape'])
+                    conn.send({k: data_dict[k] for k in METADATA_KEYS})
+                except Exception as e:
+                    conn.send({'error': repr(e)})
+
+
+def setup_data_server(address,
+                      dataset,
+                      batch_size,
+                      resize_data_shape=None,
+                      data_limit=-1,
+                      shuffle_seed=None,
+                      normalize=False,
+                      drop_remainder=False,
+                      num_parallel_calls=tf.data.experimental.AUTOTUNE):
+    """Setup a dataset served by a local data server
+
+    Takes the same arguments as `pyroclast.common.tf_util.setup_tfds`
+    and returns a dict with the same keys. Batches are gathered
+    directly from the server's shared memory, so no decoding happens
+    in this process.
+
+    Args:
+        address (str): Path of the unix socket the server listens on
+    """
+    with Client(address, family='AF_UNIX', authkey=AUTHKEY) as conn:
+        conn.send({
+            'dataset': dataset,
+            'resize_data_shape': resize_data_shape,
+            'data_limit': data_limit
+        })
+        data_dict = conn.recv()
+    if 'error' in data_dict:
+        raise Exception('Data server at {} failed: {}'.format(
+            address, data_dict['error']))
+
+    data_dict['data_limit'] = data_limit
+
+    def normalize_batch(features):
+        features['image'] = normalize_image(features['image'])
+        return features
+
+    for split in ['train', 'test']:
+        arrays = load_snapshot(
+            os.path.join(
+                data_dict['snapshot_dir'],
+                snapshot_key(dataset, split, resize_data_shape, data_limit)))
+        # the snapshot holds only the first data_limit data
+        data_dict[split + '_num'] = arrays['label'].shape[0]
+        data_dict[split + '_bpe'] = data_dict[split + '_num'] // batch_size
+        ds = snapshot_dataset(arrays, batch_size, shuffle_seed, drop_remainder,
+                              num_parallel_calls)
+        if normalize:
+            ds = ds.map(normalize_batch, num_parallel_calls=num_parallel_calls)
+        data_dict[split] = ds.prefetch(tf.data.experimental.AUTOTUNE)
+    return data_dict
+
+
+def main(args):
+    parser = arg_parser()
+    parser.add_argument('--address',
+                        type=str,
+                        default='/tmp/pyroclast_data_server')
+    parser.add_argument('--snapshot_dir',
+                        type=str,
+                        default='/dev/shm/pyroclast_data_server')
+    parser.add_argument('--data_dir', type=str, default=None)
+    args = parser.parse_args(args)
+    try:
+        serve(args.address, args.snapshot_dir, args.data_dir)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # shared memory doesn't outlive the server
+        shutil.rmtree(args.snapshot_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
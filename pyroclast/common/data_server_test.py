@@ -0,0 +1,43 @@
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import numpy as np
+from absl.testing import parameterized
+
+from pyroclast.common import tf_util
+from pyroclast.common.data_server import serve, setup_data_server
+from pyroclast.common.tf_util_test import fake_tfds_load
+
+
+class DataServerTest(parameterized.TestCase):
+
+    def setUp(self):
+        super(DataServerTest, self).setUp()
+        tmp_dir = tempfile.mkdtemp()
+        self.address = os.path.join(tmp_dir, 'socket')
+        patcher = mock.patch.object(tf_util.tfds, 'load', fake_tfds_load(20))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        threading.Thread(target=serve,
+                         args=(self.address, os.path.join(tmp_dir,
+                                                          'snapshots')),
+                         daemon=True).start()
+        while not os.path.exists(self.address):
+            time.sleep(0.01)
+
+    @parameterized.parameters((-1, 20), (10, 10), (30, 20))
+    def test_counts_follow_data_limit(self, data_limit, num_examples):
+        data_dict = setup_data_server(self.address,
+                                      'fake',
+                                      4,
+                                      data_limit=data_limit)
+        for split in ['train', 'test']:
+            assert data_dict[split + '_num'] == num_examples
+            assert data_dict[split + '_bpe'] == num_examples // 4
+            index = np.concatenate(
+                [batch['index'] for batch in data_dict[split]])
+            np.testing.assert_array_equal(np.sort(index),
+                                          np.arange(num_examples))
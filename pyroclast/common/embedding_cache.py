@@ -0,0 +1,173 @@
+"""Content-addressed, size-bounded cache of preprocessed embeddings
+
+Entries are directories written by
+`pyroclast.common.preprocessed_dataset.PreprocessedDataset`. Their names
+hash the weights of the embedding module, the dataset identity and the
+preprocessing config, so an entry is never reused after any of those
+change. Least recently used entries are evicted once the cache grows
+past its size bound.
+
+Inspect or empty a cache with:
+`python -m pyroclast.common.embedding_cache stats --cache_dir .preprocessed_data`
+`python -m pyroclast.common.embedding_cache clear --cache_dir .preprocessed_data`
+"""
+import hashlib
+import json
+import os
+import os.path as osp
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from pyroclast.common.cmd_util import arg_parser
+
+CACHE_VERSION = 1
+INDEX_FILENAME = 'index.json'
+
+
+def module_fingerprint(variables):
+    """Hashes the names, shapes and values of a module's variables
+
+    Args:
+        variables (iterable of tf.Variable): e.g. `module.variables`
+
+    Returns:
+        fingerprint (str): Hex digest which changes whenever any weight does
+    """
+    digest = hashlib.sha1()
+    for v in sorted(variables, key=lambda v: v.name):
+        value = np.ascontiguousarray(v.numpy())
+        digest.update(v.name.encode('utf-8'))
+        digest.update(str(value.shape).encode('utf-8'))
+        digest.update(value.tobytes())
+    return digest.hexdigest()
+
+
+def cache_key(fingerprint, dataset, split, config):
+    """Content address of one cache entry
+
+    Args:
+        fingerprint (str): Fingerprint of the embedding module's weights
+        dataset (str): Name of the dataset
+        split (str): Name of the split, e.g. 'train'
+        config (dict): JSON-serializable preprocessing config
+
+    Returns:
+        key (str): Directory name of the entry
+    """
+    description = json.dumps(
+        {
+            'version': CACHE_VERSION,
+            'weights': fingerprint,
+            'dataset': dataset,
+            'split': split,
+            'config': config
+        },
+        sort_keys=True)
+    digest = hashlib.sha1(description.encode('utf-8')).hexdigest()[:16]
+    return '{}_{}_{}'.format(dataset, split, digest)
+
+
+class EmbeddingCache(object):
+    """Directory of cache entries bounded in total size"""
+
+    def __init__(self, cache_dir, max_bytes=None):
+        """
+        Args:
+            cache_dir (str): Directory holding the entries
+            max_bytes (int): Optional, size bound enforced by `evict`
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return osp.join(self.cache_dir, key)
+
+    def touch(self, key):
+        """Marks an entry as used now"""
+        index_path = osp.join(self.path(key), INDEX_FILENAME)
+        if osp.exists(index_path):
+            os.utime(index_path)
+
+    def entries(self):
+        """Lists complete entries
+
+        Returns:
+            entries (list of dict): With keys key, bytes, and last_used, oldest first
+        """
+        if not osp.exists(self.cache_dir):
+            return []
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            index_path = osp.join(self.path(key), INDEX_FILENAME)
+            # skips partially written entries
+            if not osp.exists(index_path):
+                continue
+            size = sum(
+                osp.getsize(osp.join(self.path(key), f))
+                for f in os.listdir(self.path(key)))
+            entries.append({
+                'key': key,
+                'bytes': size,
+                'last_used': osp.getmtime(index_path)
+            })
+        return sorted(entries, key=lambda e: e['last_used'])
+
+    def evict(self, keep=()):
+        """Removes least recently used entries until within max_bytes
+
+        Args:
+            keep (iterable of str): Keys which must not be removed, e.g. those in use
+
+        Returns:
+            evicted (list of str): Keys of removed entries
+        """
+        if self.max_bytes is None:
+            return []
+        entries = self.entries()
+        total = sum(e['bytes'] for e in entries)
+        evicted = []
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry['key'] in keep:
+                continue
+            shutil.rmtree(self.path(entry['key']), ignore_errors=True)
+            total -= entry['bytes']
+            evicted.append(entry['key'])
+        return evicted
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            'num_entries': len(entries),
+            'bytes': sum(e['bytes'] for e in entries),
+            'max_bytes': self.max_bytes,
+            'entries': entries
+        }
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def main(args):
+    parser = arg_parser()
+    parser.add_argument('command', choices=['stats', 'clear'])
+    parser.add_argument('--cache_dir', type=str, default='.preprocessed_data')
+    args = parser.parse_args(args)
+    cache = EmbeddingCache(args.cache_dir)
+    if args.command == 'stats':
+        stats = cache.stats()
+        for entry in stats['entries']:
+            print('{:>12d} B  last used {}  {}'.format(
+                entry['bytes'], time.ctime(entry['last_used']), entry['key']))
+        print('{} entries, {} B total'.format(stats['num_entries'],
+                                              stats['bytes']))
+    elif args.command == 'clear':
+        cache.clear()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -4,8 +4,9 @@ import sonnet as snt
 import tensorflow as tf
 from tqdm import tqdm
 
-from pyroclast.common.adversarial import fast_gradient_method
-from pyroclast.common.tf_util import OnePassCorrelation
+from pyroclast.common.adversarial import (fast_gradient_method,
+                                          linear_optimization)
+from pyroclast.common.tf_util import OnePassCorrelation, StreamingCorrelation
 
 
 class FeatureClassifierMixin(abc.ABC):
@@ -83,6 +84,23 @@ class FeatureClassifierMixin(abc.ABC):
         Returns:
            rho (tf.Tensor): The usefulness of each feature for each class. Of shape [num_features, num_classes].
         """
+        return self.usefulness_accumulator(iterable, num_classes,
+                                           is_preprocessed, debug).finalize()
+
+    def usefulness_accumulator(self,
+                               iterable,
+                               num_classes,
+                               is_preprocessed=False,
+                               debug=False):
+        """Accumulates the statistics behind `usefulness' without finalizing
+
+        Accumulators of disjoint shards of a dataset, e.g. computed by
+        parallel worker processes which return `state()`, merge exactly with
+        `StreamingCorrelation.merge`.
+
+        Returns:
+           accumulator (StreamingCorrelation): finalizes to usefulness of shape [num_features, num_classes]
+        """
 
         def get_features(x):
             if is_preprocessed:
@@ -99,16 +117,17 @@ class FeatureClassifierMixin(abc.ABC):
             return tf.cast(tf.one_hot(x, num_classes, on_value=1, off_value=-1),
                            tf.float32)
 
-        corr_calc = OnePassCorrelation()
+        corr_calc = StreamingCorrelation()
         if debug:
             print("Calculating usefulness...")
             iterable = tqdm(iterable)
         for x, y in iterable:
-            labels = tf.expand_dims(get_one_hot(y, num_classes), -2)
-            features = tf.expand_dims(get_features(x), -1)
-            corr_calc.accumulate(labels, features)
+            labels = get_one_hot(y, num_classes)
+            features = get_features(x)
+            corr_calc.accumulate(tf.reshape(features, [-1, features.shape[-1]]),
+                                 tf.reshape(labels, [-1, num_classes]))
 
-        return corr_calc.finalize()
+        return corr_calc
 
     def robustness(self, iterable, feature_idx, class_idx, num_classes, eps,
                    norm):
@@ -141,12 +160,111 @@ class FeatureClassifierMixin(abc.ABC):
         adv_usefulness = self.usefulness(adv_generator(iterable), num_classes)
         return adv_usefulness
 
+    def robustness_matrix(self,
+                          iterable,
+                          num_classes,
+                          eps,
+                          norm,
+                          feature_chunk_size=16,
+                          debug=False):
+        """Calculates the robustness of every feature/class pair in one pass
+
+        Equivalent to entry [feature_idx, class_idx] of `robustness` for
+        every pair. Labels are +/-1, so each feature's attack only has two
+        possible directions, taken from the Jacobian of the features. The
+        Jacobian and the attacked features are computed for
+        `feature_chunk_size` features at a time to bound memory.
+
+        Args:
+           iterable: yields (x, y) pairs, as taken by `usefulness'
+           num_classes (int): number of classes
+           eps (float): numerical limit on the norm of the actual delta
+           norm (1, 2, or np.inf): Which class of delta to use
+           feature_chunk_size (int): number of features attacked at once
+
+        Returns:
+           gamma (tf.Tensor): The robustness of each feature for each class. Of shape [num_features, num_classes].
+        """
+
+        def get_one_hot(x, num_classes):
+            return tf.cast(tf.one_hot(x, num_classes, on_value=1, off_value=-1),
+                           tf.float32)
+
+        @tf.function
+        def attacked_features(x, feature_ids):
+            # features after the attack on each feature for labels +1 and -1
+            num_chunk_features = tf.shape(feature_ids)[0]
+            with tf.GradientTape(watch_accessed_variables=False) as tape:
+                tape.watch(x)
+                features = tf.gather(self.features(x), feature_ids, axis=1)
+            jacobian = tape.batch_jacobian(features, x)
+            # [K*B,...], feature-major
+            jacobian = tf.reshape(
+                tf.transpose(jacobian,
+                             [1, 0] + list(range(2, len(jacobian.shape)))),
+                tf.concat([[-1], tf.shape(x)[1:]], 0))
+            delta = linear_optimization(jacobian, eps, norm)
+            tiled_x = tf.tile(x,
+                              [num_chunk_features] + [1] * (len(x.shape) - 1))
+            # minimizing +/- the feature moves against/along its gradient
+            attacked = self.features(
+                tf.concat([tiled_x - delta, tiled_x + delta], 0))
+            attacked = tf.reshape(attacked,
+                                  [2, num_chunk_features,
+                                   tf.shape(x)[0], -1])
+            mask = tf.one_hot(feature_ids, tf.shape(attacked)[-1])
+            attacked = tf.reduce_sum(attacked * mask[None, :, None, :], -1)
+            return tf.transpose(attacked, [0, 2, 1])
+
+        corr_calc = OnePassCorrelation()
+        if debug:
+            print("Calculating robustness...")
+            iterable = tqdm(iterable)
+        num_features = None
+        for x, y in iterable:
+            x = tf.cast(x, tf.float32)
+            labels = tf.expand_dims(get_one_hot(y, num_classes), -2)
+            if num_features is None:
+                num_features = self.features(x).shape[-1]
+            chunks = [
+                attacked_features(
+                    x,
+                    tf.range(start, min(start + feature_chunk_size,
+                                        num_features)))
+                for start in range(0, num_features, feature_chunk_size)
+            ]
+            attacked = tf.concat(chunks, -1)
+            features = tf.where(labels > 0, tf.expand_dims(attacked[0], -1),
+                                tf.expand_dims(attacked[1], -1))
+            corr_calc.accumulate(labels, features)
+
+        return corr_calc.finalize()
+
     def input_search(self,
                      x,
                      feature_target,
                      early_stopping,
-                     search_method='fgm'):
-        if search_method == 'fgm':
+                     search_method='adam',
+                     learning_rate=1e-2):
+        """Searches for inputs whose features match the given targets
+
+        Args:
+           x (tf.Tensor): initial inputs of shape [N, ...data_shape]
+           feature_target (tf.Tensor): target features of shape [N, num_features]
+           early_stopping (EarlyStopping): its max_epochs bounds the number of steps, and with 'adam' its patience and eps decide when each datum has converged
+           search_method (str): 'adam' optimizes the whole batch in one compiled loop, masking out converged data. 'fgm' takes fast gradient steps eagerly.
+           learning_rate (float): step size of Adam
+
+        Returns:
+           x (tf.Tensor): inputs of shape [N, ...data_shape]
+        """
+        if search_method == 'adam':
+            x = _adam_input_search(self.features, tf.cast(x, tf.float32),
+                                   tf.cast(feature_target, tf.float32),
+                                   early_stopping.max_epochs,
+                                   early_stopping.patience, early_stopping.eps,
+                                   learning_rate)
+        elif search_method == 'fgm':
             forward_fn = lambda _x: tf.norm(feature_target - self.features(_x),
                                             2)  # + 0.1 * tf.norm(x - _x, 2)
             for i in range(early_stopping.max_epochs):
@@ -157,3 +275,58 @@ class FeatureClassifierMixin(abc.ABC):
         else:
             raise NotImplementedError()
         return x
+
+
+@tf.function
+def _adam_input_search(features_fn,
+                       x,
+                       feature_target,
+                       max_steps,
+                       patience,
+                       tol,
+                       learning_rate,
+                       beta_1=0.9,
+                       beta_2=0.999,
+                       epsilon=1e-7):
+    """Minimizes ||feature_target - features_fn(x)|| per datum with Adam
+
+    A datum is converged, and its input frozen, once its distance hasn't
+    improved by more than tol for more than patience steps, mirroring
+    `EarlyStopping`. The loop exits when all data are converged.
+    """
+    num_data = tf.shape(x)[0]
+    ones = [1] * (len(x.shape) - 1)
+
+    def cond(step, x, m, v, best, counter, done):
+        return tf.logical_and(step < max_steps,
+                              tf.logical_not(tf.reduce_all(done)))
+
+    def body(step, x, m, v, best, counter, done):
+        with tf.GradientTape(watch_accessed_variables=False) as tape:
+            tape.watch(x)
+            distance = tf.norm(feature_target - features_fn(x), axis=-1)
+            total_distance = tf.reduce_sum(distance)
+        grad = tape.gradient(total_distance, x)
+
+        improved = distance < best - tol
+        best = tf.where(improved, distance, best)
+        counter = tf.where(improved, 0, counter + 1)
+        done = tf.logical_or(done, counter > patience)
+
+        t = tf.cast(step + 1, x.dtype)
+        m = beta_1 * m + (1. - beta_1) * grad
+        v = beta_2 * v + (1. - beta_2) * tf.square(grad)
+        update = learning_rate * (m / (1. - beta_1**t)) / (
+            tf.sqrt(v / (1. - beta_2**t)) + epsilon)
+        x = tf.where(tf.reshape(done, [-1] + ones), x, x - update)
+        return step + 1, x, m, v, best, counter, done
+
+    _, x, _, _, _, _, _ = tf.while_loop(cond, body, [
+        tf.constant(0), x,
+        tf.zeros_like(x),
+        tf.zeros_like(x),
+        tf.fill([num_data], x.dtype.max),
+        tf.zeros([num_data], tf.int32),
+        tf.zeros([num_data], tf.bool)
+    ])
+    return x
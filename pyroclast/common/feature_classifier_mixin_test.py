@@ -1,8 +1,10 @@
 import os.path as osp
 
+import numpy as np
 import tensorflow as tf
 from absl.testing import parameterized
 
+from pyroclast.common.early_stopping import EarlyStopping
 from pyroclast.common.feature_classifier_mixin import FeatureClassifierMixin
 from pyroclast.common.tf_util import setup_tfds
 
@@ -123,3 +125,108 @@ class FeatureClassifierMixinTest(parameterized.TestCase):
         assert tf.math.reduce_min(
             robustness) >= -1. - 1e-5  # has expected max value
         assert not tf.math.reduce_any(tf.math.is_nan(robustness))  # not nan
+
+    def test_robustness_matrix(self):
+        ds = self.ds['train'].map(lambda x:
+                                  (tf.cast(x['image'], tf.float32), x['label']))
+        robustness_matrix = self.model.robustness_matrix(ds,
+                                                         self.ds['num_classes'],
+                                                         0.1,
+                                                         2,
+                                                         feature_chunk_size=7)
+        assert robustness_matrix.shape == [self.model.num_features, 10]
+        # matches the single pair computation
+        robustness = self.model.robustness(ds, 3, 4, self.ds['num_classes'],
+                                           0.1, 2)
+        assert abs(robustness[3, 4] - robustness_matrix[3, 4]) < 1e-4
+
+
+class SmallFeatureClassifier(FeatureClassifierMixin, tf.Module):
+
+    def __init__(self):
+        super(SmallFeatureClassifier, self).__init__()
+        self.hidden_layer = tf.keras.layers.Dense(8, activation=tf.nn.tanh)
+        self.feature_layer = tf.keras.layers.Dense(3)
+        self.dense_layer = tf.keras.layers.Dense(2)
+
+    def __call__(self, x):
+        return self.classify_features(self.features(x))
+
+    def features(self, x):
+        return self.feature_layer(self.hidden_layer(x))
+
+    def classify_features(self, f):
+        return self.dense_layer(f)
+
+    def get_classification_module(self):
+        return self.dense_layer
+
+
+def eager_input_search(model, x, feature_target, max_epochs, patience, eps,
+                       learning_rate):
+    """Searches one datum at a time, each with its own Adam and EarlyStopping
+
+    Returns:
+        x (tf.Tensor): searched inputs
+        num_updates (list of int): number of Adam steps applied to each datum
+    """
+    results = []
+    num_updates = []
+    for datum, target in zip(tf.unstack(x), tf.unstack(feature_target)):
+        datum = tf.Variable(datum[None])
+        optimizer = tf.keras.optimizers.legacy.Adam(learning_rate, epsilon=1e-7)
+        early_stopping = EarlyStopping(patience, eps=eps, max_epochs=max_epochs)
+        step = 0
+        while step < max_epochs:
+            with tf.GradientTape() as tape:
+                distance = tf.norm(target - model.features(datum)[0])
+            if early_stopping(step, distance):
+                break
+            optimizer.apply_gradients([(tape.gradient(distance, datum), datum)])
+            step += 1
+        results.append(datum[0])
+        num_updates.append(step)
+    return tf.stack(results), num_updates
+
+
+class InputSearchTest(parameterized.TestCase):
+
+    def setUp(self):
+        super(InputSearchTest, self).setUp()
+        # seeds the keras initializers too, which tf.random.set_seed doesn't
+        tf.keras.utils.set_random_seed(0)
+        self.model = SmallFeatureClassifier()
+        self.x = tf.random.normal([5, 4])
+        # the first datum starts close to its target, so it converges first
+        self.feature_target = tf.concat(
+            [self.model.features(self.x[:1]) + 0.01,
+             tf.random.normal([4, 3])], 0)
+
+    def search(self, max_epochs, patience=5, eps=1e-3):
+        return self.model.input_search(
+            self.x, self.feature_target,
+            EarlyStopping(patience, eps=eps, max_epochs=max_epochs))
+
+    def test_input_search_matches_eager(self):
+        expected, num_updates = eager_input_search(self.model, self.x,
+                                                   self.feature_target, 300, 5,
+                                                   1e-3, 1e-2)
+        # data converge at different steps
+        assert len(set(num_updates)) > 1
+        assert min(num_updates) < 300
+        x = self.search(300)
+        np.testing.assert_allclose(x, expected, atol=1e-4)
+
+    def test_converged_data_stop_updating(self):
+        _, num_updates = eager_input_search(self.model, self.x,
+                                            self.feature_target, 300, 5, 1e-3,
+                                            1e-2)
+        first = min(num_updates)
+        converged = [i for i, n in enumerate(num_updates) if n == first]
+        # the loop ran past the first convergence, but those data are frozen
+        short, long = self.search(first + 1), self.search(first + 50)
+        np.testing.assert_array_equal(tf.gather(short, converged),
+                                      tf.gather(long, converged))
+        unconverged = [i for i in range(len(num_updates)) if i not in converged]
+        assert not np.allclose(tf.gather(short, unconverged),
+                               tf.gather(long, unconverged))
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 
 mapping = {}
@@ -236,3 +237,123 @@ def get_network_builder(name):
         return mapping[name]
     else:
         raise ValueError('Unknown network type: {}'.format(name))
+
+
+def recompute_grad(fn):
+    """Wraps fn so its activations are recomputed in the backward pass
+
+    Unlike `tf.recompute_grad`, the gradient is itself differentiable, by
+    recomputing the segment once more, so double backprop, e.g. training
+    with an exact input gradient penalty, works through wrapped segments.
+    The forward pass runs through `tf.recompute_grad`, so tapes don't
+    record its activations. Under double backprop the saving is not
+    guaranteed: eager tapes record the activations of the gradient, and
+    grappler may reorder the recomputations of a `tf.function`, so
+    measure (see `pyroclast.features.benchmark`) before relying on it.
+
+    Args:
+        fn (callable): Maps a tensor to a tensor, possibly reading variables
+    """
+    # only used for its forward pass, which no tape records
+    forward = tf.recompute_grad(fn)
+
+    def vector_jacobian_product(x, dy, variables):
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            y = fn(x)
+        return tape.gradient(y, [x] + variables,
+                             output_gradients=dy,
+                             unconnected_gradients=tf.UnconnectedGradients.ZERO)
+
+    def after(dependencies, tensors):
+        # without the dependency, graph execution would recompute as soon
+        # as the inputs are ready, or share the result of an earlier
+        # recomputation, and hold every activation until it is used
+        with tf.control_dependencies(dependencies):
+            return [tf.identity(t) for t in tensors]
+
+    @tf.custom_gradient
+    def inner(x):
+        y = forward(x)
+
+        def grad(dy, variables=None):
+            segment_variables = list(variables or [])
+
+            @tf.custom_gradient
+            def recomputed_vector_jacobian_product(x, dy):
+                x_recompute, = after([dy], [x])
+                grads = vector_jacobian_product(x_recompute, dy,
+                                                segment_variables)
+
+                def grad_of_grad(*ddgrads, variables=None):
+                    read_variables = list(variables or [])
+                    x_recompute, dy_recompute = after(ddgrads, [x, dy])
+                    with tf.GradientTape() as tape:
+                        tape.watch([x_recompute, dy_recompute])
+                        grads = vector_jacobian_product(x_recompute,
+                                                        dy_recompute,
+                                                        segment_variables)
+                    ddx = tape.gradient(
+                        grads, [x_recompute, dy_recompute] + read_variables,
+                        output_gradients=list(ddgrads),
+                        unconnected_gradients=tf.UnconnectedGradients.ZERO)
+                    return ddx[:2], ddx[2:]
+
+                return grads, grad_of_grad
+
+            # a tensor of the gradient's own graph, which the gradient of
+            # the gradient can capture
+            grads = recomputed_vector_jacobian_product(tf.identity(x), dy)
+            return grads[0], grads[1:]
+
+        return y, grad
+
+    return inner
+
+
+def rematerialize(network, num_segments):
+    """Applies a network while only keeping the outputs of each segment
+
+    The layers of `network` are split into `num_segments` contiguous
+    segments, each wrapped by `recompute_grad`. Backprop then keeps only
+    the activations at segment boundaries and recomputes the rest one
+    segment at a time, trading a forward pass for peak memory.
+
+    Args:
+        network (tf.keras.Model): Sequential network, or a functional
+            model whose layers form a chain (e.g. vgg19)
+        num_segments (int): Number of recomputed segments
+
+    Returns:
+        forward_fn (callable): Computes the same outputs as `network`
+    """
+    layers = [
+        layer for layer in network.layers
+        if not isinstance(layer, tf.keras.layers.InputLayer)
+    ]
+    bounds = np.linspace(0, len(layers), num_segments + 1).astype(int)
+
+    def make_segment(segment_layers):
+
+        def segment(x):
+            for layer in segment_layers:
+                x = layer(x)
+            return x
+
+        return recompute_grad(segment)
+
+    segments = [
+        make_segment(layers[start:end])
+        for start, end in zip(bounds[:-1], bounds[1:])
+        if end > start
+    ]
+
+    def forward_fn(x):
+        # variables can't be created inside a custom gradient
+        if not network.built:
+            network.build(x.shape)
+        for segment in segments:
+            x = segment(x)
+        return x
+
+    return forward_fn
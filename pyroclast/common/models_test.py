@@ -0,0 +1,74 @@
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+
+from pyroclast.common.models import rematerialize
+
+
+def input_grad_penalty_grads(forward_fn, variables, x):
+    """Gradients of the loss and of the input gradient norm, as in features"""
+    with tf.GradientTape(persistent=True) as tape:
+        with tf.GradientTape() as inner_tape:
+            inner_tape.watch(x)
+            y = forward_fn(x)
+            loss = tf.reduce_sum(tf.square(y))
+        input_grad = inner_tape.gradient(y, x)
+        penalty = tf.reduce_sum(tf.square(input_grad))
+    grads = tape.gradient(loss, variables)
+    # the input gradient doesn't depend on the last bias
+    second_order_grads = tape.gradient(
+        penalty, variables, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+    return y, input_grad, grads, second_order_grads
+
+
+class ModelsTest(parameterized.TestCase):
+
+    @parameterized.parameters(1, 2, 4)
+    def test_rematerialize_gradients(self, num_segments):
+        network = tf.keras.Sequential([
+            tf.keras.layers.Conv2D(8, 3, padding='same', activation='softplus'),
+            tf.keras.layers.Conv2D(8, 3, padding='same', activation='tanh'),
+            tf.keras.layers.Conv2D(4, 3, strides=2, activation='softplus'),
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Dense(3)
+        ])
+        x = tf.random.uniform([2, 10, 10, 1])
+        network(x)
+        remat_fn = rematerialize(network, num_segments)
+
+        expected = input_grad_penalty_grads(network, network.variables, x)
+        for forward_fn in [remat_fn, tf.function(remat_fn)]:
+            actual = input_grad_penalty_grads(forward_fn, network.variables, x)
+            for a, e in zip(tf.nest.flatten(actual), tf.nest.flatten(expected)):
+                np.testing.assert_allclose(a, e, rtol=1e-4, atol=1e-6)
+
+    def test_rematerialize_input_grad_penalty(self):
+        # the exact input gradient regularization of features.run_minibatch
+        network = tf.keras.Sequential([
+            tf.keras.layers.Conv2D(8, 3, activation='softplus'),
+            tf.keras.layers.Conv2D(8, 3, activation='softplus'),
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Dense(3)
+        ])
+        x = tf.random.uniform([4, 9, 9, 1])
+        network(x)
+
+        @tf.function
+        def penalty_and_grads(forward_fn):
+            with tf.GradientTape() as tape:
+                with tf.GradientTape() as inner_tape:
+                    inner_tape.watch(x)
+                    y_hat = forward_fn(x)
+                penalty = tf.math.square(
+                    tf.norm(inner_tape.gradient(y_hat, x), 2))
+            # the input gradient doesn't depend on the last bias
+            return penalty, tape.gradient(
+                penalty,
+                network.trainable_variables,
+                unconnected_gradients=tf.UnconnectedGradients.ZERO)
+
+        expected_penalty, expected_grads = penalty_and_grads(network)
+        penalty, grads = penalty_and_grads(rematerialize(network, 2))
+        np.testing.assert_allclose(penalty, expected_penalty, rtol=1e-5)
+        for g, e in zip(grads, expected_grads):
+            np.testing.assert_allclose(g, e, rtol=1e-4, atol=1e-6)
@@ -1,3 +1,6 @@
+import copy
+import os
+
 import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
@@ -10,17 +13,24 @@ def plot_grads(images,
                num_classes,
                debug=False,
                **kw):
-    image_tensors = [[x] for x in tf.split(images, images.shape[0])]
-    for j in range(len(models)):
-        output = tf.split(models[j].certainty_sensitivity(images, num_classes),
-                          images.shape[0])
-        for i, o in enumerate(output):
-            image_tensors[i].append(o)
+    """Plots each image next to its certainty sensitivity under each model
+
+    Returns:
+        fig (matplotlib.figure.Figure): One row per image, one column per model after the original
+    """
+    images = np.asarray(images)
+    image_tensors = [[image] for image in images]
+    for model in models:
+        sensitivities = np.asarray(
+            model.certainty_sensitivity(images, num_classes))
+        for row, sensitivity in zip(image_tensors, sensitivities):
+            row.append(sensitivity)
 
+    fig = plt.figure()
     plot_images(image_tensors,
                 col_labels=['original'] + model_names,
                 cmap='seismic')
-    plt.show()
+    return fig
 
 
 def imshow_example(x, image_shape, **kwargs):
@@ -53,11 +63,97 @@ def imshow_gradient(grad, image_shape, percentile=99, **kwargs):
     return plt.imshow(image, **imshow_kw)
 
 
-def plot_images(image_tensors, row_labels=None, col_labels=None, cmap=None):
+def _as_grid(image_tensors):
+    if type(image_tensors) != list:
+        return [[image_tensors]]
+    elif type(image_tensors[0]) != list:
+        return [image_tensors]
+    return image_tensors
+
+
+def _cell_values(image, cmap):
+    """Squeezes an image to [H, W] or [H, W, 3] with values in [0, 1]
+
+    Single channel images are scaled by their own range, like
+    `plt.imshow` does for each image. When color images share the grid,
+    the colormap is applied so every cell is RGB.
+    """
+    image = np.squeeze(np.asarray(image))
+    if image.ndim == 2:
+        image = image.astype(np.float32)
+        low, high = image.min(), image.max()
+        image = (image - low) / (high -
+                                 low) if high > low else np.zeros_like(image)
+        if cmap is not None and cmap is not False:
+            return plt.get_cmap(cmap)(image)[..., :3]
+        return image
+    if image.dtype == np.uint8:
+        return image[..., :3] / 255.
+    return np.clip(image[..., :3], 0., 1.)
+
+
+def _grid_cmap(cmap):
+    """Colormap which draws the NaN padding of single channel grids white"""
+    cmap = copy.copy(plt.get_cmap(cmap))
+    cmap.set_bad('white')
+    return cmap
+
+
+def compose_grid(image_tensors, cmap=None, padding=1):
+    """Tiles images into a single array
+
+    Padding, and cells missing from short rows, are white in color grids
+    and NaN in single channel grids, so a colormap can't give them a
+    color of the data (see `_grid_cmap`).
+
+    Args:
+       image_tensors (tf.Tensor | list(tf.Tensor) | list(list(tf.Tensor)): Tensors that hold image information. In order of (row, col).
+       cmap (None | str): Colormap of single channel images, only applied when the grid also holds color images
+       padding (int): Pixels between neighboring cells
+
+    Returns:
+       grid (np.array): shape [rows * (cell_height + padding) - padding, cols * (cell_width + padding) - padding] or with a trailing RGB axis, with values in [0, 1]
+       cell_shape (tuple of int): (cell_height, cell_width)
+    """
+    image_tensors = _as_grid(image_tensors)
+    nrows = len(image_tensors)
+    ncols = max([len(x) for x in image_tensors])
+
+    cells = [[np.squeeze(np.asarray(image))
+              for image in row]
+             for row in image_tensors]
+    is_color = any(c.ndim == 3 for row in cells for c in row)
+    cells = [[_cell_values(c, cmap if is_color else None)
+              for c in row]
+             for row in cells]
+    cell_height = max(c.shape[0] for row in cells for c in row)
+    cell_width = max(c.shape[1] for row in cells for c in row)
+
+    shape = [
+        nrows * (cell_height + padding) - padding,
+        ncols * (cell_width + padding) - padding
+    ]
+    grid = np.full(shape + ([3] if is_color else []),
+                   1. if is_color else np.nan,
+                   dtype=np.float32)
+    for row_idx, row in enumerate(cells):
+        top = row_idx * (cell_height + padding)
+        for col_idx, cell in enumerate(row):
+            left = col_idx * (cell_width + padding)
+            grid[top:top + cell.shape[0], left:left + cell.shape[1]] = cell
+    return grid, (cell_height, cell_width)
+
+
+def plot_images(image_tensors,
+                row_labels=None,
+                col_labels=None,
+                cmap=None,
+                fontsize=8):
     """Plot images in a list or grid
 
-    When this has run, the matplotlib.plt state is ready to be shown
-    or saved to an image.
+    The images are tiled into one array and drawn with a single
+    imshow, so large grids render quickly. When this has run, the
+    matplotlib.plt state is ready to be shown or saved to an image.
 
     Args:
        image_tensors (tf.Tensor | list(tf.Tensor) | list(list(tf.Tensor)): Tensors that hold image information. In order of (row, col).
@@ -65,40 +161,82 @@ def plot_images(image_tensors, row_labels=None, col_labels=None, cmap=None):
        col_labels (None | list(str)): Labels for the columns
 
     """
-
-    if type(image_tensors) != list:
-        image_tensors = [[image_tensors]]
-    elif type(image_tensors[0]) != list:
-        image_tensors = [image_tensors]
-
+    image_tensors = _as_grid(image_tensors)
     nrows = len(image_tensors)
     ncols = max([len(x) for x in image_tensors])
 
-    kwargs = {'cmap': cmap}
+    padding = 1
+    grid, (cell_height, cell_width) = compose_grid(image_tensors, cmap, padding)
+    ax = plt.gca()
+    ax.set_xticks([])
+    ax.set_yticks([])
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.imshow(grid,
+              cmap=_grid_cmap(cmap),
+              vmin=0.,
+              vmax=1.,
+              interpolation='none')
 
     if row_labels is not None:
         assert len(row_labels) == nrows
         for row_idx, label in enumerate(row_labels):
-            index = row_idx * ncols + 1
-            plt.subplot(nrows, ncols, index)
-            side_text(label)
+            ax.text(-padding, (row_idx + 0.5) * (cell_height + padding),
+                    label,
+                    ha='right',
+                    va='center',
+                    rotation='vertical',
+                    fontsize=fontsize)
 
     if col_labels is not None:
         assert len(col_labels) == ncols
         for col_idx, label in enumerate(col_labels):
-            index = col_idx + 1
-            plt.subplot(nrows, ncols, index)
-            top_text(label)
-
-    for row_idx, row in enumerate(image_tensors):
-        for col_idx, image_tensor in enumerate(row):
-            index = row_idx * ncols + col_idx + 1
-            axes = plt.subplot(nrows, ncols, index)
-            squeezed_tensor = tf.squeeze(image_tensor)
-
-            plt.xticks([])
-            plt.yticks([])
-            plt.imshow(squeezed_tensor, **kwargs)
+            ax.text((col_idx + 0.5) * (cell_width + padding),
+                    -padding,
+                    label,
+                    ha='center',
+                    va='bottom',
+                    fontsize=fontsize)
+
+
+def save_images(path,
+                image_tensors,
+                row_labels=None,
+                col_labels=None,
+                cmap=None,
+                max_rows=64):
+    """Saves a grid of images, split into tiles of at most max_rows rows
+
+    Without labels the tiles are written with `plt.imsave`, skipping
+    figure creation entirely.
+
+    Args:
+       path (str): Path of the image, tiles after the first are suffixed _1, _2, ...
+       max_rows (int): Rows per saved tile
+
+    Returns:
+       paths (list of str): Paths of the saved tiles
+    """
+    image_tensors = _as_grid(image_tensors)
+    root, ext = os.path.splitext(path)
+    paths = []
+    for tile_idx, start in enumerate(range(0, len(image_tensors), max_rows)):
+        tile_path = path if tile_idx == 0 else '{}_{}{}'.format(
+            root, tile_idx, ext)
+        rows = image_tensors[start:start + max_rows]
+        tile_row_labels = None if row_labels is None else row_labels[start:
+                                                                     start +
+                                                                     max_rows]
+        if tile_row_labels is None and col_labels is None:
+            grid, _ = compose_grid(rows, cmap)
+            plt.imsave(tile_path, grid, cmap=_grid_cmap(cmap), vmin=0., vmax=1.)
+        else:
+            fig = plt.figure()
+            plot_images(rows, tile_row_labels, col_labels, cmap)
+            fig.savefig(tile_path, bbox_inches='tight', dpi=200)
+            plt.close(fig)
+        paths.append(tile_path)
+    return paths
 
 
 def top_text(text, fontsize=8):
@@ -0,0 +1,72 @@
+import time
+import types
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+from absl.testing import parameterized
+
+from pyroclast.common.plot import compose_grid, plot_grads, plot_images
+
+matplotlib.use('Agg')
+
+
+class PlotTest(parameterized.TestCase):
+
+    def test_compose_grid_layout(self):
+        images = [[np.random.uniform(size=[4, 5, 1]) for _ in range(3)],
+                  [np.random.uniform(size=[4, 5])]]
+        grid, cell_shape = compose_grid(images, padding=1)
+        assert cell_shape == (4, 5)
+        assert grid.shape == (2 * 5 - 1, 3 * 6 - 1)
+        for row_idx, row in enumerate(images):
+            for col_idx, image in enumerate(row):
+                image = np.squeeze(image)
+                cell = grid[row_idx * 5:row_idx * 5 + 4, col_idx *
+                            6:col_idx * 6 + 5]
+                np.testing.assert_allclose(cell, (image - image.min()) /
+                                           (image.max() - image.min()),
+                                           rtol=1e-5)
+        # padding, and the cells missing from the short row, are masked
+        assert np.isnan(grid[4]).all() and np.isnan(grid[:, 5]).all()
+        assert np.isnan(grid[5:, 6:]).all()
+        assert np.isnan(grid).sum() == grid.size - 4 * 4 * 5
+
+    def test_compose_color_grid(self):
+        images = [
+            np.random.randint(0, 256, [3, 3, 3], dtype=np.uint8),
+            np.random.uniform(size=[3, 3])
+        ]
+        grid, _ = compose_grid(images, cmap='gray')
+        assert grid.shape == (3, 7, 3)
+        np.testing.assert_allclose(grid[:, :3], images[0] / 255.)
+        np.testing.assert_array_equal(grid[:, 3], 1.)
+
+    def test_padding_drawn_white(self):
+        fig = plt.figure()
+        plot_images([np.zeros([2, 2]), np.ones([2, 2])], cmap='viridis')
+        image = fig.axes[0].get_images()[0]
+        colors = image.to_rgba(image.get_array())
+        np.testing.assert_array_equal(colors[:, 2], 1.)
+        plt.close(fig)
+
+    def test_thousand_image_grid(self):
+        images = [[np.random.uniform(size=[28, 28, 1])
+                   for _ in range(40)]
+                  for _ in range(25)]
+        start = time.time()
+        fig = plt.figure()
+        plot_images(images, cmap='gray')
+        fig.canvas.draw()
+        assert time.time() - start < 1.
+        assert len(fig.axes[0].get_images()) == 1
+        plt.close(fig)
+
+    def test_plot_grads(self):
+        images = np.random.uniform(size=[3, 6, 6, 1]).astype(np.float32)
+        model = types.SimpleNamespace(
+            certainty_sensitivity=lambda x, num_classes: -x)
+        fig = plot_grads(images, [model, model], ['a', 'b'], [6, 6], 10)
+        grid = fig.axes[0].get_images()[0].get_array()
+        assert grid.shape == (3 * 7 - 1, 3 * 7 - 1)
+        plt.close(fig)
@@ -1,8 +1,15 @@
-import tensorflow as tf
-from tqdm import tqdm
+import json
+import os
 import os.path as osp
-import tensorflow_datasets as tfds
+import shutil
+
 import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+from tqdm import tqdm
+
+from pyroclast.common.snapshot import snapshot_dataset
+from pyroclast.common.tf_util import normalize_image
 
 
 def _float_feature(value):
@@ -15,6 +22,99 @@ def _int64_feature(value):
     return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
 
 
+class ShardWriter(object):
+    """Streams batches of an array into fixed-size .npy shards
+
+    Each shard is written through a memory map, so only the batch being
+    appended is ever held in memory.
+    """
+
+    def __init__(self, base_path, name, shard_size):
+        """
+        Args:
+            base_path (str): Directory the shards are written to
+            name (str): Prefix of each shard's filename
+            shard_size (int): Number of rows per shard
+        """
+        self.base_path = base_path
+        self.name = name
+        self.shard_size = shard_size
+        self.shard_lengths = []
+        self._shard = None
+
+    def _shard_path(self, idx):
+        return osp.join(self.base_path, '{}_{:05d}.npy'.format(self.name, idx))
+
+    def append(self, batch):
+        batch = np.asarray(batch)
+        while batch.shape[0] > 0:
+            if self._shard is None or self.shard_lengths[-1] == self.shard_size:
+                self._flush()
+                self._shard = np.lib.format.open_memmap(
+                    self._shard_path(len(self.shard_lengths)),
+                    mode='w+',
+                    dtype=batch.dtype,
+                    shape=(self.shard_size,) + batch.shape[1:])
+                self.shard_lengths.append(0)
+            start = self.shard_lengths[-1]
+            num = min(self.shard_size - start, batch.shape[0])
+            self._shard[start:start + num] = batch[:num]
+            self.shard_lengths[-1] += num
+            batch = batch[num:]
+
+    def _flush(self):
+        if self._shard is not None:
+            self._shard.flush()
+            self._shard = None
+
+    def close(self):
+        """Flushes the last shard and trims it to the number of rows written
+
+        Returns:
+            shard_lengths (list of int): Number of rows in each shard
+        """
+        if self._shard is not None and self.shard_lengths[-1] < self.shard_size:
+            path = self._shard_path(len(self.shard_lengths) - 1)
+            trimmed = np.lib.format.open_memmap(
+                path + '.tmp',
+                mode='w+',
+                dtype=self._shard.dtype,
+                shape=(self.shard_lengths[-1],) + self._shard.shape[1:])
+            trimmed[:] = self._shard[:self.shard_lengths[-1]]
+            trimmed.flush()
+            del trimmed
+            self._shard = None
+            os.replace(path + '.tmp', path)
+        self._flush()
+        return self.shard_lengths
+
+
+class ShardedArray(object):
+    """Read-only view over memory-mapped .npy shards as a single array
+
+    Supports gathering rows with an array of indices, which only reads
+    the requested rows from disk.
+    """
+
+    def __init__(self, paths):
+        self.shards = [np.load(p, mmap_mode='r') for p in paths]
+        self.offsets = np.cumsum([0] + [s.shape[0] for s in self.shards])
+        self.shape = (int(self.offsets[-1]),) + self.shards[0].shape[1:]
+        self.dtype = self.shards[0].dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        idx = np.asarray(idx)
+        shard_idx = np.searchsorted(self.offsets, idx, side='right') - 1
+        result = np.empty(idx.shape + self.shape[1:], dtype=self.dtype)
+        for s in np.unique(shard_idx):
+            mask = shard_idx == s
+            result[mask] = self.shards[s][idx[mask] - self.offsets[s]]
+        return result
+
+
 class PreprocessedDataset():
 
     def __init__(self,
@@ -22,36 +122,60 @@ class PreprocessedDataset():
                  module,
                  filepath,
                  data_key='image',
-                 label_key='label'):
+                 label_key='label',
+                 shard_size=8192):
         self.module = module
         self.base_ds = ds
+        self.data_key = data_key
+        self.label_key = label_key
 
-        if not osp.exists(filepath +
-                          '_embeds.npy') or not osp.exists(filepath +
-                                                           '_labels.npy'):
-            self.save(filepath, data_key, label_key)
-        self.ds = self.load(filepath, data_key, label_key)
+        if not osp.exists(osp.join(filepath, 'index.json')):
+            self.save(filepath, data_key, label_key, shard_size)
+        self.arrays = self.load(filepath, data_key, label_key)
 
-    def __call__(self, batch_size):
-        return self.ds.shuffle(1024).batch(batch_size)
+    def __call__(self, batch_size, shuffle_seed=None):
+        return snapshot_dataset(self.arrays,
+                                batch_size,
+                                shuffle_seed,
+                                keys=[self.data_key, self.label_key])
 
-    def save(self, base_path, data_key, label_key):
+    def save(self, base_path, data_key, label_key, shard_size):
 
         def _inner(batch):
-            embed = self.module(tf.cast(batch[data_key], tf.float32))
+            embed = self.module(normalize_image(batch[data_key]))
             label = batch[label_key]
             return (embed, label)
 
-        ds = tfds.as_numpy(self.base_ds.map(_inner).unbatch())
-        tuples = [x for x in tqdm(ds)]
-        embeds, labels = zip(*tuples)
-        np.save(base_path + '_embeds', np.array(embeds))
-        np.save(base_path + '_labels', np.array(labels))
+        # written to a temporary directory so concurrent runs never read a partial store
+        tmp_path = '{}.tmp{}'.format(base_path, os.getpid())
+        tf.io.gfile.makedirs(tmp_path)
+        embed_writer = ShardWriter(tmp_path, 'embeds', shard_size)
+        label_writer = ShardWriter(tmp_path, 'labels', shard_size)
+        for embed, label in tqdm(tfds.as_numpy(self.base_ds.map(_inner))):
+            embed_writer.append(embed)
+            label_writer.append(label)
+        index = {'embeds': embed_writer.close(), 'labels': label_writer.close()}
+        # written last, its presence marks a complete store
+        with open(osp.join(tmp_path, 'index.json'), 'w') as index_file:
+            json.dump(index, index_file)
+        try:
+            os.rename(tmp_path, base_path)
+        except OSError:
+            # another process finished the same store first
+            shutil.rmtree(tmp_path)
 
     def load(self, base_path, data_key, label_key):
-        embeds = np.load(base_path + '_embeds.npy')
-        labels = np.load(base_path + '_labels.npy')
-        return tf.data.Dataset.from_tensors({
-            data_key: embeds,
-            label_key: labels
-        }).unbatch()
+        with open(osp.join(base_path, 'index.json')) as index_file:
+            index = json.load(index_file)
+        return {
+            data_key:
+                ShardedArray([
+                    osp.join(base_path, 'embeds_{:05d}.npy'.format(i))
+                    for i in range(len(index['embeds']))
+                ]),
+            label_key:
+                ShardedArray([
+                    osp.join(base_path, 'labels_{:05d}.npy'.format(i))
+                    for i in range(len(index['labels']))
+                ])
+        }
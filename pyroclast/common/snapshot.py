@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_datasets as tfds
+from tqdm import tqdm
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_KEYS = ['image', 'label']
+
+
+def snapshot_key(dataset, split, resize_data_shape=None, data_limit=-1):
+    """Content address of a decoded dataset snapshot
+
+    Args:
+        dataset (str): Name of the TFDS
+        split (str): Name of the split, e.g. 'train'
+        resize_data_shape (iterable of int): Resize shape applied before decoding is stored, or None
+        data_limit (int): Upper limit to the number of data stored, -1 for all data
+
+    Returns:
+        key (str): Directory name of the snapshot
+    """
+    if resize_data_shape is not None:
+        resize_data_shape = [int(d) for d in resize_data_shape]
+    description = json.dumps(
+        {
+            'version': SNAPSHOT_VERSION,
+            'dataset': dataset,
+            'split': split,
+            'resize_data_shape': resize_data_shape,
+            'data_limit': int(data_limit)
+        },
+        sort_keys=True)
+    digest = hashlib.sha1(description.encode('utf-8')).hexdigest()[:16]
+    return '{}_{}_{}'.format(dataset, split, digest)
+
+
+def build_snapshot(ds, path, num_examples, batch_size=256):
+    """Decodes a dataset once and writes it to memory-mappable .npy files
+
+    The snapshot is written to a temporary directory and renamed into
+    place, so concurrent runs building the same snapshot never see a
+    partial one.
+
+    Args:
+        ds (tf.data.Dataset): Unbatched dataset of dicts with `image' and `label' keys
+        path (str): Directory to write the snapshot to
+        num_examples (int): Number of data in `ds`
+        batch_size (int): Number of data decoded per write
+    """
+    image_spec = ds.element_spec['image']
+    if not image_spec.shape.is_fully_defined():
+        raise ValueError(
+            'Snapshots need a fixed image shape, got {}. Set resize_data_shape.'
+            .format(image_spec.shape))
+    label_spec = ds.element_spec['label']
+
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    tf.io.gfile.makedirs(tmp_path)
+    arrays = {
+        'image':
+            np.lib.format.open_memmap(os.path.join(tmp_path, 'image.npy'),
+                                      mode='w+',
+                                      dtype=image_spec.dtype.as_numpy_dtype,
+                                      shape=tuple([num_examples] +
+                                                  image_spec.shape.as_list())),
+        'label':
+            np.lib.format.open_memmap(os.path.join(tmp_path, 'label.npy'),
+                                      mode='w+',
+                                      dtype=label_spec.dtype.as_numpy_dtype,
+                                      shape=tuple([num_examples] +
+                                                  label_spec.shape.as_list()))
+    }
+
+    ds = ds.map(lambda x: {k: x[k] for k in SNAPSHOT_KEYS}).batch(batch_size)
+    idx = 0
+    for batch in tqdm(tfds.as_numpy(ds),
+                      total=-(-num_examples // batch_size),
+                      desc='Building snapshot'):
+        num = batch['label'].shape[0]
+        for k in SNAPSHOT_KEYS:
+            arrays[k][idx:idx + num] = batch[k]
+        idx += num
+    if idx != num_examples:
+        shutil.rmtree(tmp_path)
+        raise ValueError('Expected {} data but the dataset held {}'.format(
+            num_examples, idx))
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished building the same snapshot first
+        shutil.rmtree(tmp_path)
+
+
+def load_snapshot(path):
+    """Maps a snapshot written by `build_snapshot` without reading it
+
+    Returns:
+        arrays (dict): Read-only memory-mapped arrays keyed by `image' and `label'
+    """
+    return {
+        k: np.load(os.path.join(path, k + '.npy'), mmap_mode='r')
+        for k in SNAPSHOT_KEYS
+    }
+
+
+def load_or_build_snapshot(ds,
+                           snapshot_dir,
+                           dataset,
+                           split,
+                           num_examples,
+                           resize_data_shape=None,
+                           data_limit=-1):
+    """Maps the snapshot of a dataset split, building it on the first call
+
+    Args:
+        ds (tf.data.Dataset): Unbatched, decoded (and resized) dataset split
+        snapshot_dir (str): Directory shared by all runs on a node
+        dataset (str): Name of the TFDS
+        split (str): Name of the split
+        num_examples (int): Number of data in the split
+        resize_data_shape (iterable of int): Resize shape already applied to `ds`, or None
+        data_limit (int): Store only the first data_limit data, -1 for all data
+
+    Returns:
+        arrays (dict): Read-only memory-mapped arrays keyed by `image' and `label'
+    """
+    path = os.path.join(
+        snapshot_dir, snapshot_key(dataset, split, resize_data_shape,
+                                   data_limit))
+    if not os.path.exists(path):
+        if data_limit >= 0:
+            num_examples = min(num_examples, data_limit)
+        build_snapshot(ds.take(data_limit), path, num_examples)
+    return load_snapshot(path)
+
+
+def snapshot_dataset(arrays,
+                     batch_size,
+                     shuffle_seed=None,
+                     drop_remainder=False,
+                     num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                     keys=SNAPSHOT_KEYS):
+    """Serves shuffled batches from memory-mapped arrays
+
+    Only indices pass through the shuffle, so every epoch is a full
+    permutation of the data at the cost of one int64 per datum. Each
+    batch is then gathered from the memory map in a single read. The
+    row of each datum is served as its `index'.
+
+    Args:
+        arrays (dict): Arrays of equal length, e.g. as returned by `load_snapshot`. Anything indexable by an array of row indices works.
+        batch_size (int): Number of data per batch
+        shuffle_seed (int): Optional, seed of the epoch order
+        drop_remainder (bool): If True, drop the final partial batch
+        keys (list of str): Keys of `arrays` to serve
+
+    Returns:
+        ds (tf.data.Dataset): Batches as dicts with the given keys and `index'
+    """
+    num_examples = arrays[keys[0]].shape[0]
+    batch_dim = batch_size if drop_remainder else None
+
+    def gather(idx):
+        # sorting keeps reads sequential, order within a batch is irrelevant
+        idx = np.sort(idx)
+        return [idx] + [np.ascontiguousarray(arrays[k][idx]) for k in keys]
+
+    def to_batch(idx):
+        values = tf.numpy_function(gather, [idx], [tf.int64] +
+                                   [tf.as_dtype(arrays[k].dtype) for k in keys])
+        batch = {'index': values[0]}
+        batch['index'].set_shape([batch_dim])
+        values = values[1:]
+        for k, v in zip(keys, values):
+            v.set_shape([batch_dim] + list(arrays[k].shape[1:]))
+            batch[k] = v
+        return batch
+
+    return tf.data.Dataset.range(num_examples).shuffle(
+        num_examples,
+        seed=shuffle_seed).batch(batch_size, drop_remainder=drop_remainder).map(
+            to_batch, num_parallel_calls=num_parallel_calls)
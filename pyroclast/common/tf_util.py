@@ -1,3 +1,6 @@
+import os
+import time
+
 import numpy as np
 import tensorflow as tf
 import tensorflow_probability as tfp
@@ -6,6 +9,8 @@ import tensorflow_datasets as tfds
 
 import tensorflow_datasets as tfds
 
+from pyroclast.common.snapshot import load_or_build_snapshot, snapshot_dataset
+
 tfd = tfp.distributions
 tfb = tfp.bijectors
 
@@ -15,59 +20,173 @@ def setup_tfds(dataset,
                resize_data_shape=None,
                data_limit=-1,
                data_dir=None,
-               shuffle_seed=None):
+               shuffle_seed=None,
+               shuffle_buffer_size=1024,
+               cache=None,
+               normalize=False,
+               drop_remainder=False,
+               num_parallel_calls=tf.data.experimental.AUTOTUNE,
+               snapshot_dir=None):
     """Setup a TensorFlow Dataset
 
     Args:
         dataset (str): Name of the TFDS to load `(Full list here) <https://www.tensorflow.org/datasets/catalog/overview>`_
         batch_size (int): Number of data per batch
         resize_data_shape (interable of int): If specified, do an image reshape on the data to the given shape
-        data_limit (int): Upper limit to the number of data to load, -1 to load all data
+        data_limit (int): Upper limit to the number of data to load, -1 to load all data. With a cache or snapshot, these are the first data_limit data of the split, otherwise a shuffled subset
         data_dir (relative path str): Directory where TFDS should look for the data files
+        shuffle_seed (int): Optional, seed for the shuffle buffer
+        shuffle_buffer_size (int): Number of data held in the shuffle buffer
+        cache (None | str): If None, don't cache. If the empty string, cache decoded (and resized) data in memory. Otherwise, a directory in which to cache decoded data on disk
+        normalize (bool): If True, images are batched as float32 in [0,1] instead of uint8
+        drop_remainder (bool): If True, drop the final partial batch so every batch has a static shape
+        num_parallel_calls (int): Parallelism of the decode/resize and normalization maps
+        snapshot_dir (None | str): If specified, a directory of decoded dataset snapshots shared between runs. The first run builds the snapshot of each split and later runs memory-map it. Takes precedence over cache
 
     Returns:
         A dict with keys train, test, train_bpe, test_bpe, shape, and num_classes.
 
         train, test are iterators over batches of each set respectively.
+        Batches hold each datum's `index', its position in the unshuffled
+        split, which is stable across epochs and runs
         train_bpe and test_bpe are the number of batches per epoch in each set
         shape is the shape of each datum
         num_classes is the number of classes in the labels
     """
     data_dict, info = tfds.load(dataset, with_info=True, data_dir=data_dir)
     data_dict['name'] = dataset
-    data_dict['train_bpe'] = info.splits['train'].num_examples // batch_size
-    data_dict['train_num'] = info.splits['train'].num_examples
-    data_dict['test_bpe'] = info.splits['test'].num_examples // batch_size
-    data_dict['test_num'] = info.splits['test'].num_examples
+    for split in ['train', 'test']:
+        num_examples = info.splits[split].num_examples
+        if data_limit >= 0:
+            num_examples = min(num_examples, data_limit)
+        data_dict[split + '_bpe'] = num_examples // batch_size
+        data_dict[split + '_num'] = num_examples
     data_dict['num_classes'] = info.features['label'].num_classes
+    data_dict['data_limit'] = data_limit
 
     def resize_ds_img(features):
-        features['image'] = tf.image.resize(features['image'],
-                                            resize_data_shape)
+        # cast back to the stored dtype so cached data stays compact
+        features['image'] = tf.saturate_cast(
+            tf.round(tf.image.resize(features['image'], resize_data_shape)),
+            features['image'].dtype)
         # I'm not actually sure if this bit with the mask is right at all, but it's needed for batching right now
         if 'segmentation_mask' in features:
-            features['segmentation_mask'] = tf.image.resize(
-                features['segmentation_mask'], resize_data_shape)
+            features['segmentation_mask'] = tf.saturate_cast(
+                tf.round(
+                    tf.image.resize(features['segmentation_mask'],
+                                    resize_data_shape)),
+                features['segmentation_mask'].dtype)
+        return features
+
+    def normalize_batch(features):
+        features['image'] = normalize_image(features['image'])
         return features
 
     if resize_data_shape is None:
         data_dict['shape'] = info.features['image'].shape
     else:
-        data_dict['train'] = data_dict['train'].map(resize_ds_img)
-        data_dict['test'] = data_dict['test'].map(resize_ds_img)
         data_dict['shape'] = resize_data_shape + [
             info.features['image'].shape[-1]
         ]
 
-    data_dict['train'] = data_dict['train'].shuffle(
-        1024, seed=shuffle_seed).take(data_limit).batch(batch_size).prefetch(
-            tf.data.experimental.AUTOTUNE)
-    data_dict['test'] = data_dict['test'].shuffle(
-        1024, seed=shuffle_seed).take(data_limit).batch(batch_size).prefetch(
-            tf.data.experimental.AUTOTUNE)
+    for split in ['train', 'test']:
+        ds = data_dict[split]
+        if resize_data_shape is not None:
+            ds = ds.map(resize_ds_img, num_parallel_calls=num_parallel_calls)
+        if snapshot_dir is not None:
+            arrays = load_or_build_snapshot(ds, snapshot_dir, dataset, split,
+                                            info.splits[split].num_examples,
+                                            resize_data_shape, data_limit)
+            ds = snapshot_dataset(arrays, batch_size, shuffle_seed,
+                                  drop_remainder, num_parallel_calls)
+        else:
+            # numbered before the shuffle, so indices don't depend on it
+            ds = ds.enumerate().map(_with_index,
+                                    num_parallel_calls=num_parallel_calls)
+            if cache is not None:
+                # a cache is only kept once it is read to the end, so the
+                # limit is applied first and is part of the cache's name
+                ds = ds.take(data_limit).cache(
+                    _cache_path(cache, dataset, split, resize_data_shape,
+                                data_limit))
+            ds = ds.shuffle(shuffle_buffer_size,
+                            seed=shuffle_seed).take(data_limit).batch(
+                                batch_size, drop_remainder=drop_remainder)
+        if normalize:
+            ds = ds.map(normalize_batch, num_parallel_calls=num_parallel_calls)
+        data_dict[split] = ds.prefetch(tf.data.experimental.AUTOTUNE)
     return data_dict
 
 
+def _with_index(index, features):
+    features['index'] = index
+    return features
+
+
+def _cache_path(cache, dataset, split, resize_data_shape, data_limit=-1):
+    if cache == '':
+        return cache
+    tf.io.gfile.makedirs(cache)
+    if resize_data_shape is None:
+        shape_str = 'native'
+    else:
+        shape_str = 'x'.join([str(d) for d in resize_data_shape])
+    name = '{}_{}_{}'.format(dataset, split, shape_str)
+    if data_limit >= 0:
+        name += '_limit{}'.format(data_limit)
+    return os.path.join(cache, name)
+
+
+def normalize_image(image):
+    """Converts image data to float32 in [0,1]
+
+    Data which is already floating point is assumed to have been normalized
+    by the input pipeline (see `setup_tfds`) and is only cast.
+
+    Args:
+        image (tf.Tensor): uint8 image data in [0,255] or float image data in [0,1]
+
+    Returns:
+        image (tf.Tensor): float32 image data in [0,1]
+    """
+    if image.dtype.is_floating:
+        return tf.cast(image, tf.float32)
+    return tf.cast(image, tf.float32) / 255.
+
+
+class InputWaitTimer(object):
+    """Wraps an iterable of batches and times how long its consumer waits
+
+    Iterating over this object yields the same batches as the wrapped
+    iterable. After each pass, `wait_time` holds the number of seconds
+    spent blocked on the input pipeline, which should be near zero
+    when data loading keeps up with training.
+    """
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.wait_time = 0.
+        self.num_batches = 0
+
+    def __iter__(self):
+        self.wait_time = 0.
+        self.num_batches = 0
+        iterator = iter(self.iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.wait_time += time.perf_counter() - start
+            self.num_batches += 1
+            yield batch
+
+    def __str__(self):
+        return '{:.2f}s over {} batches'.format(self.wait_time,
+                                                self.num_batches)
+
+
 def calculate_accuracy(logits, label):
     """Compare argmax logits to int label, returns value in [0,1]"""
     prediction = tf.argmax(logits, 1)
@@ -117,6 +236,98 @@ class OnePassCorrelation(object):
         return numerator / (denominator + 1e-12)
 
 
+class StreamingCorrelation(object):
+    """Pearson correlation between every column of two streamed matrices
+
+    Accumulates means, second moments and the co-moment in the pairwise
+    form of Chan et al., whose batch update is one matmul and which stays
+    accurate where raw power sums cancel. State lives in float64 variables
+    on device, so accumulating never syncs with the host. Accumulators of
+    disjoint shards can be merged exactly.
+    """
+
+    def __init__(self, dtype=tf.float64):
+        self.dtype = dtype
+        self._variables = None
+        self._compiled_accumulate = tf.function(self._accumulate)
+        self._compiled_update = tf.function(self._update)
+
+    def _build(self, num_a, num_b):
+        zeros = lambda shape: tf.Variable(tf.zeros(shape, self.dtype),
+                                          trainable=False)
+        self._variables = {
+            'n': zeros([]),
+            'mean_a': zeros([num_a]),
+            'mean_b': zeros([num_b]),
+            'm2_a': zeros([num_a]),
+            'm2_b': zeros([num_b]),
+            'comoment': zeros([num_a, num_b])
+        }
+
+    def _update(self, n, mean_a, mean_b, m2_a, m2_b, comoment):
+        v = self._variables
+        total = v['n'] + n
+        weight = n / tf.maximum(total, 1.)
+        delta_a = mean_a - v['mean_a']
+        delta_b = mean_b - v['mean_b']
+        v['comoment'].assign_add(comoment +
+                                 tf.tensordot(delta_a, delta_b, axes=0) *
+                                 v['n'] * weight)
+        v['m2_a'].assign_add(m2_a + tf.square(delta_a) * v['n'] * weight)
+        v['m2_b'].assign_add(m2_b + tf.square(delta_b) * v['n'] * weight)
+        v['mean_a'].assign_add(delta_a * weight)
+        v['mean_b'].assign_add(delta_b * weight)
+        v['n'].assign(total)
+
+    def _accumulate(self, a, b):
+        mean_a = tf.reduce_mean(a, axis=0)
+        mean_b = tf.reduce_mean(b, axis=0)
+        centered_a = a - mean_a
+        centered_b = b - mean_b
+        cast = lambda t: tf.cast(t, self.dtype)
+        self._update(cast(tf.shape(a)[0]), cast(mean_a), cast(mean_b),
+                     cast(tf.reduce_sum(tf.square(centered_a), axis=0)),
+                     cast(tf.reduce_sum(tf.square(centered_b), axis=0)),
+                     cast(tf.matmul(centered_a, centered_b, transpose_a=True)))
+
+    def accumulate(self, a, b):
+        """
+        Args:
+            a (Tensor): shape [N, num_a]
+            b (Tensor): shape [N, num_b]
+        """
+        a = tf.cast(a, tf.float32)
+        b = tf.cast(b, tf.float32)
+        if self._variables is None:
+            self._build(a.shape[-1], b.shape[-1])
+        self._compiled_accumulate(a, b)
+
+    def state(self):
+        """Returns the accumulated statistics as a dict of NumPy arrays"""
+        return {k: v.numpy() for k, v in self._variables.items()}
+
+    def merge(self, other):
+        """Adds the statistics of another accumulator, or of its `state()`"""
+        if isinstance(other, StreamingCorrelation):
+            other = other.state()
+        if self._variables is None:
+            self._build(other['mean_a'].shape[0], other['mean_b'].shape[0])
+        self._compiled_update(*[
+            tf.constant(other[k], self.dtype)
+            for k in ['n', 'mean_a', 'mean_b', 'm2_a', 'm2_b', 'comoment']
+        ])
+        return self
+
+    def finalize(self):
+        """
+        Returns:
+            correlation (Tensor): shape [num_a, num_b]
+        """
+        v = self._variables
+        denominator = tf.sqrt(tf.tensordot(v['m2_a'], v['m2_b'], axes=0))
+        return tf.cast(v['comoment'] / (denominator + 1e-12), tf.float32)
+
+
 def load_model(module,
                model_save_name,
                data_dict,
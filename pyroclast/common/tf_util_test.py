@@ -0,0 +1,85 @@
+import os
+import tempfile
+import types
+from unittest import mock
+
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+
+from pyroclast.common import tf_util
+from pyroclast.common.tf_util import StreamingCorrelation, setup_tfds
+
+
+def fake_tfds_load(num_examples, num_classes=3, shape=(4, 4, 1)):
+    """Stands in for `tfds.load` with random images of the given shape"""
+
+    def load(dataset, with_info, data_dir):
+        data_dict = {}
+        splits = {}
+        for split in ['train', 'test']:
+            data_dict[split] = tf.data.Dataset.from_tensor_slices({
+                'image':
+                    np.random.randint(0,
+                                      256, [num_examples] + list(shape),
+                                      dtype=np.uint8),
+                'label':
+                    np.arange(num_examples) % num_classes
+            })
+            splits[split] = types.SimpleNamespace(num_examples=num_examples)
+        info = types.SimpleNamespace(
+            splits=splits,
+            features={
+                'image': types.SimpleNamespace(shape=shape),
+                'label': types.SimpleNamespace(num_classes=num_classes)
+            })
+        return data_dict, info
+
+    return load
+
+
+class SetupTfdsTest(parameterized.TestCase):
+
+    def test_limited_cache_is_completed(self):
+        cache_dir = tempfile.mkdtemp()
+        with mock.patch.object(tf_util.tfds, 'load', fake_tfds_load(20)):
+            data_dict = setup_tfds('fake',
+                                   4,
+                                   data_limit=10,
+                                   cache=cache_dir,
+                                   shuffle_seed=0)
+            index = np.concatenate(
+                [batch['index'] for batch in data_dict['train']])
+        np.testing.assert_array_equal(np.sort(index), np.arange(10))
+        # an unfinished cache is discarded, a finished one has an index file
+        assert 'fake_train_native_limit10.index' in os.listdir(cache_dir)
+
+        # a different limit doesn't read the cache of the first
+        with mock.patch.object(tf_util.tfds, 'load', fake_tfds_load(20)):
+            data_dict = setup_tfds('fake', 4, cache=cache_dir)
+            index = np.concatenate(
+                [batch['index'] for batch in data_dict['train']])
+        np.testing.assert_array_equal(np.sort(index), np.arange(20))
+
+
+class StreamingCorrelationTest(parameterized.TestCase):
+
+    @parameterized.parameters(1, 3)
+    def test_merged_shards_match_numpy(self, num_shards):
+        a = np.random.randn(300, 5).astype(np.float32) * 3. + 100.
+        b = np.random.randn(300, 4).astype(np.float32)
+        b[:, 0] += a[:, 0]
+        expected = np.corrcoef(np.concatenate([a, b], 1).T)[:5, 5:]
+
+        shards = []
+        for a_shard, b_shard in zip(np.array_split(a, num_shards),
+                                    np.array_split(b, num_shards)):
+            corr_calc = StreamingCorrelation()
+            for i in range(0, a_shard.shape[0], 32):
+                corr_calc.accumulate(a_shard[i:i + 32], b_shard[i:i + 32])
+            shards.append(corr_calc)
+        merged = StreamingCorrelation()
+        for corr_calc in shards:
+            merged.merge(corr_calc.state())
+
+        np.testing.assert_allclose(merged.finalize(), expected, atol=1e-5)
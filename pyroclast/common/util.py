@@ -27,7 +27,7 @@ def ensure_dir_exists(dir_path):
         os.makedirs(dir_path)
 
 
-def heatmap(matrix, path, title):
+def heatmap(matrix, path, title, artifact_writer=None):
     X = np.hstack([
         matrix.numpy(),
         np.reshape(np.arange(matrix.shape[0]), [matrix.shape[0], 1])
@@ -44,5 +44,8 @@ def heatmap(matrix, path, title):
     ax.set_yticklabels(idxs)
     fig.colorbar(plot)
     ax.set_title(title)
+    if artifact_writer is not None:
+        artifact_writer.save_figure(path, fig)
+        return
     plt.savefig(path)
     plt.close(fig)
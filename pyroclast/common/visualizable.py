@@ -1,7 +1,10 @@
 import abc
+import inspect
 import tensorflow as tf
 import sonnet as snt
 
+SALIENCY_MAPS = ['sensitivity', 'certainty_sensitivity', 'activation']
+
 
 class VisualizableMixin(abc.ABC):
     """Interface Model interface.
@@ -34,6 +37,21 @@ class VisualizableMixin(abc.ABC):
            conv_layers (iterable of tf.Module): An iterable of layers in the convolution stack
         """
 
+    @abc.abstractmethod
+    def logits_from_conv_stack(self, z):
+        """Calculates output logits from the output of the conv stack
+
+        Completes the forward pass started by the layers of
+        `conv_stack_submodel`, so activations and gradients can come
+        from the same pass.
+
+        Args:
+           z (tf.Tensor): Output of the last layer of `conv_stack_submodel`
+
+        Returns:
+            logits (tf.Tensor): shape [batch_size, num_classes]
+        """
+
     def activation_map(self, x, layer_index=-1):
         """Calculates the activation map of a layer of the convolution stack
 
@@ -50,16 +68,30 @@ class VisualizableMixin(abc.ABC):
         Returns:
            activation_map (np.array): shape [batch_size, ...data_shape]
         """
-        if layer_index < 0:
-            layer_index += len(self.conv_stack_submodel)
-        layer_index = max(0, layer_index)
+        return self.activation_maps(x, [layer_index])[0]
 
-        result = x
-        for i, layer in enumerate(self.conv_stack_submodel):
-            result = layer(result)
-            if i == layer_index:
-                break
-        return tf.image.resize(result, [x.shape[1], x.shape[2]])
+    def activation_maps(self, x, layer_indices, upsample=True):
+        """Calculates the activation maps of several layers in one pass
+
+        The conv stack is run once, up to the deepest requested layer,
+        by a compiled extractor which is reused across calls. Maps of
+        the same resolution are upsampled together.
+
+        Args:
+           x (np.array): shape [batch_size, ...data_shape]
+           layer_indices (list of int): Indices of layers in the convolutional stack
+           upsample (bool): Whether to resize the maps to the width and height of x
+
+        Returns:
+           activation_maps (list of tf.Tensor): One per layer index, of shape [batch_size, height, width, channels]
+        """
+        layers = list(self.conv_stack_submodel)
+        resolved = _resolve_layer_indices(layer_indices, len(layers))
+        activations = _run_conv_stack(layers[:max(resolved) + 1], x)
+        maps = [activations[i] for i in resolved]
+        if upsample:
+            maps = upsample_maps(maps, [x.shape[1], x.shape[2]])
+        return maps
 
     def cam_map(self, x):
         """Calculates the class activation mapping
@@ -113,7 +145,65 @@ class VisualizableMixin(abc.ABC):
             grads = tape.gradient(result, x)
         return grads
 
-    def smooth(self, x, map_fn, n=50, sigma=0.01):
+    def saliency_maps(self,
+                      x,
+                      map_names=SALIENCY_MAPS,
+                      layer_indices=(-1,),
+                      softmax=False):
+        """Calculates several saliency maps of a batch at once
+
+        Every map comes from a single forward pass, recorded by one
+        persistent tape. The activations of the convolution stack are
+        collected on the way to the logits, whose gradients give the
+        sensitivity maps.
+
+        Args:
+           x (np.array): shape [batch_size, ...data_shape]
+           map_names (list of str): Maps to calculate, from SALIENCY_MAPS
+           layer_indices (list of int): Layers of the convolution stack whose activations to return
+           softmax (bool): Whether to softmax before calculating the sensitivity map
+
+        Returns:
+           maps (dict of tf.Tensor): 'sensitivity' and 'certainty_sensitivity' of shape [batch_size, ...data_shape], and 'activation_<layer_index>' at the layer's own resolution
+        """
+        for name in map_names:
+            if name not in SALIENCY_MAPS:
+                raise ValueError(
+                    'Unknown saliency map {}, options are {}'.format(
+                        name, SALIENCY_MAPS))
+        x = tf.convert_to_tensor(x)
+        maps = {}
+        layers = list(self.conv_stack_submodel)
+        resolved = _resolve_layer_indices(layer_indices, len(layers))
+
+        gradient_maps = [n for n in map_names if n != 'activation']
+        with tf.GradientTape(persistent=True,
+                             watch_accessed_variables=False) as tape:
+            tape.watch(x)
+            activations = _run_conv_stack(layers, x)
+            if gradient_maps:
+                logits = self.logits_from_conv_stack(activations[-1])
+                targets = {}
+                if 'sensitivity' in gradient_maps:
+                    targets['sensitivity'] = tf.nn.softmax(
+                        logits) if softmax else logits
+                if 'certainty_sensitivity' in gradient_maps:
+                    num_classes = logits.shape[-1]
+                    targets['certainty_sensitivity'] = tf.reduce_mean(
+                        tf.nn.softmax_cross_entropy_with_logits(
+                            logits=logits,
+                            labels=tf.ones(num_classes) / num_classes))
+        if gradient_maps:
+            for name, target in targets.items():
+                maps[name] = tape.gradient(target, x)
+        del tape
+
+        if 'activation' in map_names:
+            for layer_index, i in zip(layer_indices, resolved):
+                maps['activation_{}'.format(layer_index)] = activations[i]
+        return maps
+
+    def smooth(self, x, map_fn, n=50, sigma=0.01, chunk_size=10):
         """Computes the smooth version of a saliency-map
 
         Implements the smoothing operation defined in the SmoothGRAD
@@ -123,19 +213,36 @@ class VisualizableMixin(abc.ABC):
         images that have been perturbed with Gausssian noise. Gaussian
         noise is parameterized by the standard deviation (sigma).
 
+        Noise samples are processed chunk_size at a time and only a
+        running sum of the maps is kept, so memory doesn't grow with
+        n. The first chunk runs eagerly, so lazily built layers create
+        their variables before the remaining chunks run in a compiled
+        loop.
+
         Args:
            x (np.array): shape [batch_size, ...data_shape]
            n (int): The number of samples to collect
            sigma (float): The standard deviation of the Gaussian noise
+           chunk_size (int): The number of samples mapped at once
 
         Returns:
            smooth_map (np.array): shape [batch_size, ...data_shape]
 
         """
-        x_noise = tf.random.normal([n] + [1 for _ in enumerate(x.shape)],
-                                   stddev=sigma)
-        maps = snt.BatchApply(map_fn)(x + x_noise)
-        maps = tf.math.reduce_sum(maps, axis=0)
+        x = tf.convert_to_tensor(x)
+        chunk_size = max(1, min(chunk_size, n))
+        # bound methods are split so the compiled loop isn't retraced
+        # each time the method is looked up
+        map_args = ()
+        if inspect.ismethod(map_fn):
+            map_fn, map_args = map_fn.__func__, (map_fn.__self__,)
+        maps = _smooth_chunk(map_fn, map_args, x, sigma, chunk_size,
+                             tf.ones([chunk_size]))
+        if n > chunk_size:
+            maps = _smooth_remaining_chunks(map_fn, map_args, x,
+                                            tf.constant(sigma, x.dtype),
+                                            chunk_size, tf.constant(chunk_size),
+                                            tf.constant(n), maps)
         maps /= n
         assert maps.shape == x.shape
         return maps
@@ -159,3 +266,79 @@ class VisualizableMixin(abc.ABC):
         """
 
         return self.smooth(x, self.sensitivity_map, n, sigma)
+
+
+def upsample_maps(maps, size):
+    """Resizes maps to size, with one resize per distinct resolution
+
+    Args:
+        maps (list of tf.Tensor): shape [batch_size, height, width, channels]
+        size (list of int): Target [height, width]
+
+    Returns:
+        maps (list of tf.Tensor): shape [batch_size, ...size, channels]
+    """
+    resized = list(maps)
+    by_resolution = {}
+    for i, m in enumerate(maps):
+        by_resolution.setdefault(tuple(m.shape[1:3]), []).append(i)
+    for indices in by_resolution.values():
+        channels = [maps[i].shape[-1] for i in indices]
+        stacked = tf.image.resize(tf.concat([maps[i] for i in indices], -1),
+                                  size)
+        for i, m in zip(indices, tf.split(stacked, channels, axis=-1)):
+            resized[i] = m
+    return resized
+
+
+def _resolve_layer_indices(layer_indices, num_layers):
+    """Clips possibly negative layer indices to [0, num_layers)"""
+    return [
+        min(max(0, i + num_layers if i < 0 else i), num_layers - 1)
+        for i in layer_indices
+    ]
+
+
+def _run_conv_stack(layers, x):
+    if all(getattr(layer, 'built', True) for layer in layers):
+        return _conv_stack_activations(layers, x)
+    # layers create their variables on their first, eager, call
+    return _conv_stack_activations.python_function(layers, x)
+
+
+@tf.function
+def _conv_stack_activations(layers, x):
+    """Outputs of every layer of a sequential stack"""
+    activations = []
+    for layer in layers:
+        x = layer(x)
+        activations.append(x)
+    return activations
+
+
+def _smooth_chunk(map_fn, map_args, x, sigma, chunk_size, sample_weights):
+    """Sums map_fn over chunk_size noisy copies of x, weighting each copy"""
+    x_noise = tf.random.normal([chunk_size] + [1 for _ in enumerate(x.shape)],
+                               stddev=sigma)
+    maps = snt.BatchApply(lambda _x: map_fn(*map_args, _x))(x + x_noise)
+    weights = tf.reshape(tf.cast(sample_weights, maps.dtype),
+                         [chunk_size] + [1 for _ in enumerate(x.shape)])
+    return tf.math.reduce_sum(maps * weights, axis=0)
+
+
+@tf.function
+def _smooth_remaining_chunks(map_fn, map_args, x, sigma, chunk_size, start, n,
+                             maps):
+    """Adds the maps of noise samples [start, n) to the running sum maps
+
+    Samples of the last chunk past n are weighted by zero, so every
+    chunk keeps the same shape.
+    """
+
+    def body(i, maps):
+        sample_weights = tf.range(i, i + chunk_size) < n
+        return i + chunk_size, maps + _smooth_chunk(map_fn, map_args, x, sigma,
+                                                    chunk_size, sample_weights)
+
+    _, maps = tf.while_loop(lambda i, maps: i < n, body, [start, maps])
+    return maps
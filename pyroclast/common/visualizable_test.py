@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 from absl.testing import parameterized
 
@@ -28,6 +29,9 @@ class BasicMnistVisualizable(VisualizableMixin, tf.Module):
     def conv_stack_submodel(self):
         return [self.conv_layer_1, self.conv_layer_2]
 
+    def logits_from_conv_stack(self, z):
+        return self.dense_layer(self.flatten_layer(z))
+
 
 class VisualizableMixinTest(parameterized.TestCase):
 
@@ -84,3 +88,54 @@ class VisualizableMixinTest(parameterized.TestCase):
             assert smooth_grad_maps is not None
             assert smooth_grad_maps.shape[0:3] == x.shape[0:3]
             break
+
+    @parameterized.parameters((7, 3), (9, 3), (3, 10))
+    def test_smooth_chunks(self, n, chunk_size):
+        x = tf.random.uniform([4, 28, 28, 1])
+        # without noise every sample's map is the same
+        smooth_maps = self.model.smooth(x,
+                                        self.model.sensitivity_map,
+                                        n=n,
+                                        sigma=0.,
+                                        chunk_size=chunk_size)
+        np.testing.assert_allclose(smooth_maps,
+                                   self.model.sensitivity_map(x),
+                                   atol=1e-6)
+
+    def conv_stack_activations(self, x):
+        """Reference activations, computed one layer at a time"""
+        activations = []
+        for layer in self.model.conv_stack_submodel:
+            x = layer(x)
+            activations.append(x)
+        return activations
+
+    def test_saliency_maps(self):
+        x = tf.random.uniform([4, 28, 28, 1])
+        maps = self.model.saliency_maps(x, layer_indices=[0, -1])
+        np.testing.assert_allclose(maps['sensitivity'],
+                                   self.model.sensitivity_map(x),
+                                   rtol=1e-5,
+                                   atol=1e-6)
+        np.testing.assert_allclose(maps['certainty_sensitivity'],
+                                   self.model.certainty_sensitivity(x, 10),
+                                   rtol=1e-5,
+                                   atol=1e-7)
+        activations = self.conv_stack_activations(x)
+        for layer_index in [0, -1]:
+            np.testing.assert_allclose(
+                maps['activation_{}'.format(layer_index)],
+                activations[layer_index],
+                atol=1e-6)
+
+    def test_activation_maps(self):
+        x = tf.random.uniform([4, 28, 28, 1])
+        layer_indices = list(range(-3, 3))
+        activation_maps = self.model.activation_maps(x, layer_indices)
+        activations = self.conv_stack_activations(x)
+        for layer_index, activation_map in zip(layer_indices, activation_maps):
+            # indices out of range are clipped to the first or last layer
+            expected = activations[min(max(layer_index, -2), 1)]
+            np.testing.assert_allclose(activation_map,
+                                       tf.image.resize(expected, [28, 28]),
+                                       atol=1e-6)
@@ -7,7 +7,9 @@ import tensorflow as tf
 from PIL import Image
 from tqdm import tqdm
 
+from pyroclast.common.artifact_writer import ArtifactWriter
 from pyroclast.common.early_stopping import EarlyStopping
+from pyroclast.common.tf_util import normalize_image
 from pyroclast.cpvae.ddt import DDT
 from pyroclast.cpvae.util import build_saveable_objects
 from pyroclast.util import direct
@@ -84,7 +86,7 @@ def outer_run_minibatch(
 
     def run_minibatch(epoch, data, labels, is_train=True, prefix='train'):
         print("Tracing! {} {} {} {}".format(epoch, data, labels, is_train))
-        x = tf.cast(data, tf.float32) / 255.
+        x = normalize_image(data)
         labels = tf.cast(labels, tf.int32)
 
         with tf.GradientTape() as tape:
@@ -198,13 +200,17 @@ def eval(
     }
 
 
-def sample(model, num_samples, epoch, output_dir):
+def sample(model, num_samples, epoch, output_dir, artifact_writer=None):
     for i in range(num_samples):
         im = np.squeeze(model.sample_prior()[0])
         im = np.minimum(1., np.maximum(0., im))
-        im = Image.fromarray((255. * im).astype(np.uint8))
-        im.save(
-            os.path.join(output_dir, "epoch_{}_sample_{}.png".format(epoch, i)))
+        im = (255. * im).astype(np.uint8)
+        path = os.path.join(output_dir,
+                            "epoch_{}_sample_{}.png".format(epoch, i))
+        if artifact_writer is not None:
+            artifact_writer.save_array(path, im, cmap='gray', vmin=0, vmax=255)
+        else:
+            Image.fromarray(im).save(path)
 
 
 def train(data_dict, model, optimizer, global_step, writer, early_stopping,
@@ -228,73 +234,79 @@ def train(data_dict, model, optimizer, global_step, writer, early_stopping,
     test_batches = data_dict['test']
     if debug:
         test_batches = tqdm(test_batches, total=data_dict['test_bpe'])
-    for epoch in range(early_stopping.max_epochs):
-        # train
-        tf.print("Epoch", epoch)
-        tf.print("Epoch", epoch, output_stream=output_log_file)
-        tf.print("TRAIN", output_stream=output_log_file)
-        loss_numerator = 0
-        loss_denominator = 0
-        classification_rate_numerator = 0
-        for batch in train_batches:
-            loss_n, class_rate_n, loss_d = run_minibatch_fn(
-                epoch=tf.constant(epoch),
-                data=batch['image'],
-                labels=batch['label'],
-                is_train=tf.constant(True))
-            loss_numerator += loss_n
-            classification_rate_numerator += class_rate_n
-            loss_denominator += loss_d
-        tf.print("loss:",
-                 float(loss_numerator) / float(loss_denominator),
-                 output_stream=output_log_file)
-        tf.print("classification_rate:",
-                 float(classification_rate_numerator) / float(loss_denominator),
-                 output_stream=output_log_file)
-
-        # test
-        loss_numerator = 0
-        loss_denominator = 0
-        classification_rate_numerator = 0
-        tf.print("TEST", output_stream=output_log_file)
-        for batch in test_batches:
-            loss_n, class_rate_n, loss_d = run_minibatch_fn(
-                epoch=tf.constant(epoch),
-                data=batch['image'],
-                labels=batch['label'],
-                is_train=tf.constant(False))
-            loss_numerator += loss_n
-            loss_denominator += loss_d
-            classification_rate_numerator += class_rate_n
-        tf.print("loss:",
-                 float(loss_numerator) / float(loss_denominator),
-                 output_stream=output_log_file)
-        tf.print("classification_rate:",
-                 float(classification_rate_numerator) / float(loss_denominator),
-                 output_stream=output_log_file)
-
-        # sample
-        if debug:
-            tf.print('Sampling')
-        sample(model, num_samples, epoch, output_dir)
-
-        # save parameters
-        if early_stopping(epoch,
-                          float(loss_numerator) / float(loss_denominator)):
-            break
-
-        # update
-        if type(model.classifier) is DDT and epoch % tree_update_period == 0:
-            if debug:
-                tf.print('Updating decision tree')
-            score = model.classifier.update_model_tree(data_dict['train'],
-                                                       model.encode,
-                                                       oversample=oversample,
-                                                       debug=debug)
-            tf.print("Accuracy at DDT fit from sampling:",
-                     score,
+    # samples and trees are written in the background
+    with ArtifactWriter() as artifact_writer:
+        for epoch in range(early_stopping.max_epochs):
+            # train
+            tf.print("Epoch", epoch)
+            tf.print("Epoch", epoch, output_stream=output_log_file)
+            tf.print("TRAIN", output_stream=output_log_file)
+            loss_numerator = 0
+            loss_denominator = 0
+            classification_rate_numerator = 0
+            for batch in train_batches:
+                loss_n, class_rate_n, loss_d = run_minibatch_fn(
+                    epoch=tf.constant(epoch),
+                    data=batch['image'],
+                    labels=batch['label'],
+                    is_train=tf.constant(True))
+                loss_numerator += loss_n
+                classification_rate_numerator += class_rate_n
+                loss_denominator += loss_d
+            tf.print("loss:",
+                     float(loss_numerator) / float(loss_denominator),
+                     output_stream=output_log_file)
+            tf.print("classification_rate:",
+                     float(classification_rate_numerator) /
+                     float(loss_denominator),
+                     output_stream=output_log_file)
+
+            # test
+            loss_numerator = 0
+            loss_denominator = 0
+            classification_rate_numerator = 0
+            tf.print("TEST", output_stream=output_log_file)
+            for batch in test_batches:
+                loss_n, class_rate_n, loss_d = run_minibatch_fn(
+                    epoch=tf.constant(epoch),
+                    data=batch['image'],
+                    labels=batch['label'],
+                    is_train=tf.constant(False))
+                loss_numerator += loss_n
+                loss_denominator += loss_d
+                classification_rate_numerator += class_rate_n
+            tf.print("loss:",
+                     float(loss_numerator) / float(loss_denominator),
                      output_stream=output_log_file)
-            model.classifier.save_dot(output_dir, epoch)
+            tf.print("classification_rate:",
+                     float(classification_rate_numerator) /
+                     float(loss_denominator),
+                     output_stream=output_log_file)
+
+            # sample
+            if debug:
+                tf.print('Sampling')
+            sample(model, num_samples, epoch, output_dir, artifact_writer)
+
+            # save parameters
+            if early_stopping(epoch,
+                              float(loss_numerator) / float(loss_denominator)):
+                break
+
+            # update
+            is_tree_update_epoch = epoch % tree_update_period == 0
+            if type(model.classifier) is DDT and is_tree_update_epoch:
+                if debug:
+                    tf.print('Updating decision tree')
+                score = model.classifier.update_model_tree(
+                    data_dict['train'],
+                    model.encode,
+                    oversample=oversample,
+                    debug=debug)
+                tf.print("Accuracy at DDT fit from sampling:",
+                         score,
+                         output_stream=output_log_file)
+                model.classifier.save_dot(output_dir, epoch, artifact_writer)
 
     return model
 
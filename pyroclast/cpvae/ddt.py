@@ -44,13 +44,24 @@ class DDT(tf.Module):
             self.decision_tree)
         return score
 
-    def save_dot(self, output_dir, epoch):
-        sklearn.tree.export_graphviz(self.decision_tree,
-                                     out_file=os.path.join(
-                                         output_dir,
-                                         'ddt_epoch{}.dot'.format(epoch)),
-                                     filled=True,
-                                     rounded=True)
+    def save_dot(self, output_dir, epoch, artifact_writer=None):
+        """Writes the tree as a .dot file
+
+        Args:
+            artifact_writer (ArtifactWriter): Optional, if given the file is written and rendered to PNG in the background
+        """
+        path = os.path.join(output_dir, 'ddt_epoch{}.dot'.format(epoch))
+        if artifact_writer is None:
+            sklearn.tree.export_graphviz(self.decision_tree,
+                                         out_file=path,
+                                         filled=True,
+                                         rounded=True)
+            return
+        source = sklearn.tree.export_graphviz(self.decision_tree,
+                                              out_file=None,
+                                              filled=True,
+                                              rounded=True)
+        artifact_writer.save_dot(path, source)
 
 
 def get_decision_tree_boundaries(dtree):
@@ -1,11 +1,17 @@
+import csv
 import importlib
+import json
+import os
+
 import tensorflow as tf
 import matplotlib.pyplot as plt
+from tqdm import tqdm
 
 from pyroclast.common.early_stopping import EarlyStopping
-from pyroclast.common.tf_util import load_model
+from pyroclast.common.tf_util import load_model, normalize_image
 from pyroclast.common.plot import plot_images
-from pyroclast.common.adversarial import fast_gradient_method
+from pyroclast.common.adversarial import (fast_gradient_method,
+                                          steepest_descent_direction)
 from pyroclast.features.features import build_savable_objects
 
 
@@ -22,7 +28,7 @@ def visualize_perturbation_feature(data_dict, seed, output_dir, debug,
         x = batch_data['image'][0]
         y = batch_data['label'][0]
         break
-    x = tf.cast(x, dtype=tf.float32) / 255.
+    x = normalize_image(x)
     x = tf.reshape(x, [1] + x.shape)
 
     pred = model(x)
@@ -47,23 +53,21 @@ def visualize_perturbation_feature(data_dict, seed, output_dir, debug,
 
     col_labels = ['Original'] + ['e = %.2f' % e for e in epsilons]
 
-    for feature_idx in feature_ids[:num_features_to_visualize]:
-        print('feature_idx', feature_idx)
-        num_features = weights.shape[0]
-        mask = get_one_hot(feature_idx, num_features)
-        features = model.features(x)
-        perturbations = [
-            features -
-            tf.expand_dims(get_one_hot(feature_idx, num_features) * eps, 0)
-            for eps in epsilons
-        ]
-
-        inputs = []
-        for p, eps in zip(perturbations, epsilons):
-            print('Epsilon ', eps)
-            early_stopping = EarlyStopping(10, eps=0.00001, max_epochs=100000)
-            inputs.append(model.input_search(x, p, early_stopping))
-        images.append([x] + inputs)
+    # the whole features x epsilons grid is searched in a single call
+    features = model.features(x)
+    num_features = weights.shape[0]
+    targets = [
+        features -
+        tf.expand_dims(get_one_hot(feature_idx, num_features) * eps, 0)
+        for feature_idx in feature_ids[:num_features_to_visualize]
+        for eps in epsilons
+    ]
+    early_stopping = EarlyStopping(10, eps=0.00001, max_epochs=100000)
+    inputs = model.input_search(tf.tile(x, [len(targets), 1, 1, 1]),
+                                tf.concat(targets, 0), early_stopping)
+    for i in range(num_features_to_visualize):
+        row = inputs[i * len(epsilons):(i + 1) * len(epsilons)]
+        images.append([x] + [tf.expand_dims(img, 0) for img in row])
 
     classes = [[tf.argmax(model(x)) for x in y] for y in images]
     print(classes)
@@ -88,7 +92,7 @@ def visualize_perturbation_class(data_dict, seed, output_dir, debug,
         x = batch_data['image'][0]
         y = batch_data['label'][0]
         break
-    x = tf.cast(x, dtype=tf.float32) / 255.
+    x = normalize_image(x)
     x = tf.reshape(x, [1] + x.shape)
 
     pred = model(x)
@@ -142,10 +146,128 @@ def visualize_smoothgrad(data_dict, seed, output_dir, debug, module_name,
         x = batch_data['image'][0]
         y = batch_data['label'][0]
         break
-    x = tf.cast(x, dtype=tf.float32) / 255.
+    x = normalize_image(x)
     x = tf.reshape(x, [1] + x.shape)
 
     smooth_grad = model.smooth_grad(x)
     gray_scale_image = tf.image.rgb_to_grayscale(smooth_grad)
     plot_images([x, gray_scale_image], cmap='gray')
     plt.show()
+
+
+def build_robust_accuracy_step(model, epsilons, norms):
+    """Builds a compiled step accumulating robust accuracy over an epsilon grid
+
+    Each batch takes a single gradient of the classification loss. The FGM
+    direction of every norm is derived from it and scaled by every epsilon,
+    so all perturbed copies of the batch are classified in one forward pass.
+
+    Args:
+        model (tf.Module): Maps normalized images to logits
+        epsilons (list of float): Perturbation sizes, 0. gives clean accuracy
+        norms (list of 1, 2, or np.inf): Norms of the perturbations
+
+    Returns:
+        step (tf.function): Takes a batch dict
+        num_correct (tf.Variable): Count of correct predictions of shape [num_norms, num_epsilons]
+        num_data (tf.Variable): Count of data seen by step
+    """
+    num_correct = tf.Variable(tf.zeros([len(norms), len(epsilons)], tf.int64))
+    num_data = tf.Variable(0, dtype=tf.int64)
+
+    @tf.function
+    def step(batch):
+        x = normalize_image(batch['image'])
+        labels = tf.cast(batch['label'], tf.int32)
+        with tf.GradientTape(watch_accessed_variables=False) as tape:
+            tape.watch(x)
+            loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=labels, logits=model(x))
+        grad = tape.gradient(loss, x)
+
+        eps = tf.reshape(tf.constant(epsilons, x.dtype),
+                         [-1, 1] + [1] * (len(x.shape) - 1))
+        counts = []
+        for norm in norms:
+            direction = steepest_descent_direction(grad, norm)
+            perturbed = tf.clip_by_value(x + eps * direction, 0., 1.)
+            perturbed = tf.reshape(perturbed,
+                                   tf.concat([[-1], tf.shape(x)[1:]], 0))
+            prediction = tf.reshape(
+                tf.argmax(model(perturbed), axis=-1, output_type=tf.int32),
+                [len(epsilons), -1])
+            counts.append(
+                tf.reduce_sum(tf.cast(tf.equal(prediction, labels), tf.int64),
+                              axis=1))
+        num_correct.assign_add(tf.stack(counts))
+        num_data.assign_add(tf.cast(tf.shape(x)[0], tf.int64))
+
+    return step, num_correct, num_data
+
+
+def robust_accuracy(data_dict,
+                    seed,
+                    output_dir,
+                    debug,
+                    module_name,
+                    model_name,
+                    norm,
+                    epsilons=(0., 0.01, 0.02, 0.03, 0.05, 0.1, 0.2, 0.3),
+                    norms=None,
+                    conv_stack_name='ross_net',
+                    **kwargs):
+    """Measures accuracy on the test set under FGM perturbations
+
+    Writes robust_accuracy_<model_name>.json and .csv to output_dir, with
+    one accuracy per norm and epsilon.
+
+    Args:
+        epsilons (iterable of float): Perturbation sizes to evaluate
+        norms (iterable of 1, 2, or np.inf): Optional, norms to evaluate, defaults to [norm]
+        conv_stack_name (str): Optional, conv stack of the model
+        kwargs: Other experiment defaults, e.g. data_index, which are unused
+    """
+    module = importlib.import_module(module_name)
+    model = load_model(module,
+                       model_name,
+                       data_dict,
+                       output_dir=output_dir,
+                       conv_stack_name=conv_stack_name)
+    epsilons = [float(e) for e in epsilons]
+    norms = [norm] if norms is None else list(norms)
+    step, num_correct, num_data = build_robust_accuracy_step(
+        model, epsilons, norms)
+
+    batches = data_dict['test']
+    if debug:
+        batches = tqdm(batches, total=data_dict['test_bpe'])
+    # counts stay on device, so the host only syncs after the last batch
+    for batch in batches:
+        step(batch)
+    num_data = int(num_data.numpy())
+    accuracy = num_correct.numpy() / float(num_data)
+
+    results = [{
+        'norm': str(n),
+        'epsilon': e,
+        'accuracy': float(accuracy[i, j])
+    } for i, n in enumerate(norms) for j, e in enumerate(epsilons)]
+    for result in results:
+        print('norm {norm:>4s} eps {epsilon:.4f}: {accuracy:.4f}'.format(
+            **result))
+
+    base_path = os.path.join(output_dir, 'robust_accuracy_' + model_name)
+    with open(base_path + '.json', 'w') as json_file:
+        json.dump(
+            {
+                'model_name': model_name,
+                'num_data': num_data,
+                'results': results
+            },
+            json_file,
+            indent=2)
+    with open(base_path + '.csv', 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, ['norm', 'epsilon', 'accuracy'])
+        writer.writeheader()
+        writer.writerows(results)
+    return accuracy
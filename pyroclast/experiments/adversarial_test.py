@@ -0,0 +1,60 @@
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+
+from pyroclast.common.adversarial import projected_gradient_descent
+from pyroclast.experiments.adversarial import build_robust_accuracy_step
+
+
+class RobustAccuracyTest(parameterized.TestCase):
+
+    def setUp(self):
+        self.model = tf.keras.Sequential([
+            tf.keras.layers.Conv2D(4, 3, activation='relu'),
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Dense(3)
+        ])
+        self.batches = [{
+            'image':
+                tf.cast(tf.random.uniform([n, 8, 8, 1], maxval=256, seed=n),
+                        tf.uint8),
+            'label':
+                tf.random.uniform([n], maxval=3, dtype=tf.int64, seed=n)
+        } for n in [5, 5, 3]]
+        self.model(tf.zeros([1, 8, 8, 1]))
+
+    def negative_loss(self, x, labels):
+        return -tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=labels, logits=self.model(x))
+
+    @parameterized.parameters(1, 2, np.inf)
+    def test_robust_accuracy_step(self, norm):
+        epsilons = [0., 0.05, 0.5]
+        step, num_correct, num_data = build_robust_accuracy_step(
+            self.model, epsilons, [norm])
+        for batch in self.batches:
+            step(batch)
+        assert int(num_data.numpy()) == 13
+
+        # a single PGD step of the full size is the FGM perturbation
+        expected = np.zeros([len(epsilons)], np.int64)
+        for batch in self.batches:
+            x = tf.cast(batch['image'], tf.float32) / 255.
+            labels = tf.cast(batch['label'], tf.int32)
+            for i, eps in enumerate(epsilons):
+                delta = projected_gradient_descent(self.negative_loss,
+                                                   x,
+                                                   eps,
+                                                   norm,
+                                                   1,
+                                                   step_size=1.,
+                                                   clip_min=0.,
+                                                   clip_max=1.,
+                                                   forward_args=(labels,))
+                prediction = tf.argmax(self.model(x + delta),
+                                       axis=1,
+                                       output_type=tf.int32)
+                expected[i] += int(
+                    tf.reduce_sum(
+                        tf.cast(tf.equal(prediction, labels), tf.int64)))
+        np.testing.assert_array_equal(num_correct.numpy()[0], expected)
@@ -0,0 +1,114 @@
+"""Saliency maps of a whole dataset split
+
+Streams a split through a model once, calculating every requested map
+of a batch from one forward pass (see
+`pyroclast.common.visualizable.VisualizableMixin.saliency_maps`), and
+writes the maps to a store of sharded .npy files which can be read
+back without loading it into memory.
+
+Run with e.g.
+`python -m pyroclast.run --module experiments.saliency --task saliency_maps --dataset mnist --module_name pyroclast.features.features --model_name mnist_basic --map_names "['sensitivity', 'activation']"`
+"""
+import importlib
+import json
+import os
+import os.path as osp
+import shutil
+
+import tensorflow as tf
+from tqdm import tqdm
+
+from pyroclast.common.preprocessed_dataset import ShardedArray, ShardWriter
+from pyroclast.common.tf_util import load_model, normalize_image
+from pyroclast.common.visualizable import SALIENCY_MAPS
+
+
+def saliency_maps(data_dict,
+                  seed,
+                  output_dir,
+                  debug,
+                  module_name,
+                  model_name,
+                  map_names=SALIENCY_MAPS,
+                  layer_indices=(-1,),
+                  split='test',
+                  shard_size=8192,
+                  conv_stack_name='ross_net',
+                  **kwargs):
+    """Writes saliency maps of every datum of a split to a sharded store
+
+    The store is written to output_dir/saliency_<model_name>_<split>
+    and holds one array per map plus the labels and the 'index' of each
+    datum (see `setup_tfds`), as the split is served shuffled.
+
+    Args:
+        map_names (list of str): Maps to calculate, from SALIENCY_MAPS
+        layer_indices (list of int): Layers of the convolution stack whose activations to store
+        split (str): Name of the split, e.g. 'test'
+        shard_size (int): Number of rows per shard
+        conv_stack_name (str): Optional, conv stack of the model
+        kwargs: Other experiment defaults, e.g. norm, which are unused
+
+    Returns:
+        store (dict of ShardedArray): As returned by `load_saliency_maps`
+    """
+    module = importlib.import_module(module_name)
+    model = load_model(module,
+                       model_name,
+                       data_dict,
+                       output_dir=output_dir,
+                       conv_stack_name=conv_stack_name)
+    map_names = list(map_names)
+    layer_indices = list(layer_indices)
+
+    @tf.function
+    def compute_maps(x):
+        return model.saliency_maps(x, map_names, layer_indices)
+
+    base_path = osp.join(output_dir, 'saliency_{}_{}'.format(model_name, split))
+    # written to a temporary directory so readers never see a partial store
+    tmp_path = '{}.tmp{}'.format(base_path, os.getpid())
+    tf.io.gfile.makedirs(tmp_path)
+    writers = {}
+    batches = data_dict[split]
+    if debug:
+        batches = tqdm(batches, total=data_dict[split + '_bpe'])
+    try:
+        for batch in batches:
+            if 'index' not in batch:
+                raise ValueError(
+                    "saliency_maps needs batches with an 'index' to "
+                    "identify each datum, as served by setup_tfds and "
+                    "the data server")
+            maps = compute_maps(normalize_image(batch['image']))
+            maps['labels'] = batch['label']
+            maps['index'] = batch['index']
+            for name, value in maps.items():
+                if name not in writers:
+                    writers[name] = ShardWriter(tmp_path, name, shard_size)
+                writers[name].append(value.numpy())
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    index = {name: writer.close() for name, writer in writers.items()}
+    with open(osp.join(tmp_path, 'index.json'), 'w') as index_file:
+        json.dump(index, index_file)
+    shutil.rmtree(base_path, ignore_errors=True)
+    os.rename(tmp_path, base_path)
+    return load_saliency_maps(base_path)
+
+
+def load_saliency_maps(base_path):
+    """Reads a store written by `saliency_maps`
+
+    Returns:
+        store (dict of ShardedArray): Memory-mapped arrays keyed by map name, e.g. store['sensitivity'][indices]
+    """
+    with open(osp.join(base_path, 'index.json')) as index_file:
+        index = json.load(index_file)
+    return {
+        name: ShardedArray([
+            osp.join(base_path, '{}_{:05d}.npy'.format(name, i))
+            for i in range(len(shard_lengths))
+        ]) for name, shard_lengths in index.items()
+    }
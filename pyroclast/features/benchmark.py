@@ -0,0 +1,137 @@
+"""Benchmarks of the input gradient regularized training step
+
+Runs on random data, so it measures cost rather than accuracy, e.g.
+`python -m pyroclast.features.benchmark --conv_stack_name vgg19 --batch_size 64 --remat_segments 4`
+"""
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from pyroclast.common.cmd_util import arg_parser
+from pyroclast.common.tf_util import normalize_image
+from pyroclast.features.features import (INPUT_GRAD_METHODS,
+                                         finite_difference_input_grad_norm,
+                                         run_minibatch)
+from pyroclast.features.generic_classifier import GenericClassifier
+from pyroclast.features.networks import get_network_builder
+
+MEMORY_DEVICE = 'GPU:0' if tf.config.list_physical_devices('GPU') else 'CPU:0'
+
+
+def build_models(conv_stack_name, num_classes, remat_segments):
+    """Models sharing one set of weights, keyed by their number of remat segments"""
+    if conv_stack_name == 'vgg19':
+        conv_stack = get_network_builder(conv_stack_name)(shape=[32, 32, 3])
+    else:
+        conv_stack = get_network_builder(conv_stack_name)()
+    classifier = tf.keras.Sequential([tf.keras.layers.Dense(num_classes)])
+    return {
+        n: GenericClassifier(conv_stack, classifier, 'benchmark', n)
+        for n in sorted(set([0, remat_segments]))
+    }
+
+
+def random_batch(shape, batch_size, num_classes):
+    return {
+        'image':
+            tf.cast(
+                tf.random.uniform([batch_size] + list(shape), 0, 256, tf.int32),
+                tf.uint8),
+        'label':
+            tf.random.uniform([batch_size], 0, num_classes, tf.int64)
+    }
+
+
+def time_steps(model, optimizer, global_step, batch, num_classes, num_steps,
+               lambd, **kwargs):
+    """Measures training steps, excluding the traced first step
+
+    Returns:
+        step_time (float): Mean wall-clock time of a step in seconds
+        peak_bytes (int): Peak memory allocated by TensorFlow during the steps
+    """
+    writer = tf.summary.create_noop_writer()
+
+    def step():
+        l, _, _ = run_minibatch(model, optimizer, global_step, 0, batch,
+                                num_classes, lambd, 0., writer, **kwargs)
+        return float(l)
+
+    step()
+    tf.config.experimental.reset_memory_stats(MEMORY_DEVICE)
+    start = time.time()
+    for _ in range(num_steps):
+        step()
+    step_time = (time.time() - start) / num_steps
+    return step_time, tf.config.experimental.get_memory_info(
+        MEMORY_DEVICE)['peak']
+
+
+def input_grad_norm_error(model, batch, fd_step_size, num_samples):
+    """Compares finite difference estimates to the exact input gradient norm
+
+    Returns:
+        exact (float): ||d sum(y_hat) / dx||^2
+        relative_errors (np.array): |estimate - exact| / exact of each sample
+    """
+    x = normalize_image(batch['image'])
+    with tf.GradientTape() as tape:
+        tape.watch(x)
+        y_hat = model(x)
+    exact = float(tf.math.square(tf.norm(tape.gradient(y_hat, x), 2)))
+    estimates = np.array([
+        float(finite_difference_input_grad_norm(model, x, y_hat, fd_step_size))
+        for _ in range(num_samples)
+    ])
+    return exact, np.abs(estimates - exact) / exact
+
+
+def main(args):
+    parser = arg_parser()
+    parser.add_argument('--conv_stack_name', type=str, default='ross_net')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--num_steps', type=int, default=10)
+    parser.add_argument('--lambd', type=float, default=1.)
+    parser.add_argument('--fd_step_size', type=float, default=1e-2)
+    parser.add_argument('--remat_segments', type=int, default=0)
+    args = parser.parse_args(args)
+
+    shape = [32, 32, 3] if args.conv_stack_name == 'vgg19' else [28, 28, 1]
+    models = build_models(args.conv_stack_name, args.num_classes,
+                          args.remat_segments)
+    batch = random_batch(shape, args.batch_size, args.num_classes)
+    # shared so the optimizer's variables are only created by the first trace
+    optimizer = tf.keras.optimizers.Adam()
+    global_step = tf.Variable(0, dtype=tf.int64)
+
+    configs = [('unregularized', 0., 'exact')]
+    configs += [(method, args.lambd, method) for method in INPUT_GRAD_METHODS]
+    print('{:>18s} {:>6s} {:>10s} {:>10s}'.format('', 'remat', 's/step',
+                                                  'peak MiB'))
+    for remat_segments, model in models.items():
+        for name, lambd, method in configs:
+            step_time, peak_bytes = time_steps(model,
+                                               optimizer,
+                                               global_step,
+                                               batch,
+                                               args.num_classes,
+                                               args.num_steps,
+                                               lambd,
+                                               input_grad_method=method,
+                                               fd_step_size=args.fd_step_size)
+            print('{:>18s} {:>6d} {:>10.4f} {:>10.1f}'.format(
+                name, remat_segments, step_time, peak_bytes / 2**20))
+
+    exact, relative_errors = input_grad_norm_error(models[0], batch,
+                                                   args.fd_step_size,
+                                                   args.num_steps)
+    print('Exact input gradient norm: {:.4e}'.format(exact))
+    print('Finite difference relative error: {:.3f} mean, {:.3f} median'.format(
+        np.mean(relative_errors), np.median(relative_errors)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -7,12 +7,45 @@ import tensorflow as tf
 from tqdm import tqdm
 
 from pyroclast.common.early_stopping import EarlyStopping
+from pyroclast.common.embedding_cache import (EmbeddingCache, cache_key,
+                                              module_fingerprint)
 from pyroclast.features.networks import get_network_builder
 from pyroclast.common.plot import plot_grads
 from pyroclast.common.preprocessed_dataset import PreprocessedDataset
+from pyroclast.common.tf_util import InputWaitTimer, normalize_image
 from pyroclast.common.util import heatmap
 from pyroclast.features.generic_classifier import GenericClassifier
 
+INPUT_GRAD_METHODS = ['exact', 'finite_difference']
+
+
+def finite_difference_input_grad_norm(model, x, y_hat, step_size):
+    """Estimates the squared norm of the input gradient of the summed logits
+
+    Each datum is perturbed along its own random unit direction u, for
+    which E[(grad . u)^2] = ||grad||^2 / d, where d is the datum's number
+    of elements. The directional derivative is taken by forward
+    difference, so the estimate costs a single extra forward pass and no
+    second order backprop. As u is a unit vector, the difference step has
+    length step_size whatever the size of the input.
+
+    Args:
+        model (tf.Module): Maps x to logits
+        x (Tensor): Batch of inputs
+        y_hat (Tensor): model(x), reused as the base point of the difference
+        step_size (float): Length of the finite difference step
+
+    Returns:
+        input_grad_norm (Tensor): Scalar estimate of ||d sum(y_hat) / dx||^2
+    """
+    direction = tf.nn.l2_normalize(tf.random.normal(tf.shape(x)),
+                                   axis=list(range(1, len(x.shape))))
+    num_elements = tf.cast(tf.reduce_prod(tf.shape(x)[1:]), x.dtype)
+    perturbed_y_hat = model(x + step_size * direction)
+    directional_derivative = tf.reduce_sum(perturbed_y_hat - y_hat,
+                                           axis=-1) / step_size
+    return num_elements * tf.reduce_sum(tf.math.square(directional_derivative))
+
 
 # define minibatch fn
 @tf.function
@@ -25,7 +58,9 @@ def run_minibatch(model,
                   lambd,
                   alpha,
                   writer,
-                  is_train=True):
+                  is_train=True,
+                  input_grad_method='exact',
+                  fd_step_size=1e-2):
     """
     Args:
         model (tf.Module):
@@ -35,8 +70,18 @@ def run_minibatch(model,
         batch (dict): dict from dataset
         writer (tf.summary.SummaryWriter):
         is_train (bool): Optional, run backwards pass if True
+        input_grad_method (str): Optional, 'exact' backprops through the input
+            gradient, 'finite_difference' estimates its norm with one extra
+            forward pass (see `finite_difference_input_grad_norm`)
+        fd_step_size (float): Optional, step size of the finite difference
     """
-    x = tf.cast(batch['image'], tf.float32) / 255.
+    if input_grad_method not in INPUT_GRAD_METHODS:
+        raise ValueError('input_grad_method must be one of {}, got {}'.format(
+            INPUT_GRAD_METHODS, input_grad_method))
+    if input_grad_method == 'finite_difference' and alpha != 0.:
+        raise ValueError(
+            'Gradient masking (alpha != 0) needs the exact input gradient')
+    x = normalize_image(batch['image'])
     labels = tf.cast(batch['label'], tf.int32)
     with tf.GradientTape() as tape:
         with tf.GradientTape() as inner_tape:
@@ -47,7 +92,11 @@ def run_minibatch(model,
             classification_loss = tf.nn.softmax_cross_entropy_with_logits(
                 labels=tf.one_hot(labels, num_classes), logits=y_hat)
 
-        if lambd != 0.:
+        if lambd != 0. and input_grad_method == 'finite_difference':
+            input_grad_reg_loss = finite_difference_input_grad_norm(
+                model, x, y_hat, fd_step_size)
+            grad_masked_classification_loss = 0.
+        elif lambd != 0.:
             # input gradient regularization
             grad = inner_tape.gradient(y_hat, x)
             input_grad_reg_loss = tf.math.square(tf.norm(grad, 2))
@@ -99,25 +148,118 @@ def run_minibatch(model,
     return loss_numerator, accuracy_numerator, denominator
 
 
-def train(data_dict, model, optimizer, global_step, writer, early_stopping,
-          train_conv_stack, lambd, alpha, checkpoint, ckpt_manager, debug):
+@tf.function
+def run_free_adversarial_minibatch(model, optimizer, global_step, batch,
+                                   num_classes, perturbation, eps, writer):
+    """Trains on a minibatch plus a persistent adversarial perturbation
+
+    One backward pass gives gradients for both the weights, which descend
+    the classification loss, and the perturbation, which ascends it with a
+    signed step projected back into the L-inf ball of radius eps. Replaying
+    each minibatch several times in a row thus trains adversarially at the
+    cost of standard training (Shafahi et al., "Adversarial Training for
+    Free!").
+
+    Args:
+        model (tf.Module):
+        optimizer (tf.Optimizer):
+        global_step (Tensor):
+        batch (dict): dict from dataset
+        num_classes (int):
+        perturbation (tf.Variable): Perturbation of at least the batch's shape, updated in place and carried over between minibatches
+        eps (float): L-inf bound on the perturbation
+        writer (tf.summary.SummaryWriter):
+    """
+    x = normalize_image(batch['image'])
+    labels = tf.cast(batch['label'], tf.int32)
+    batch_size = tf.shape(x)[0]
+    delta = perturbation[:batch_size]
+    with tf.GradientTape() as tape:
+        tape.watch(delta)
+        y_hat = model(tf.clip_by_value(x + delta, 0., 1.))
+        classification_loss = tf.nn.softmax_cross_entropy_with_logits(
+            labels=tf.one_hot(labels, num_classes), logits=y_hat)
+        mean_classification_loss = tf.reduce_mean(classification_loss)
+    global_step.assign_add(1)
+
+    train_vars = model.trainable_variables
+    gradients = tape.gradient(mean_classification_loss,
+                              [delta] + list(train_vars))
+    optimizer.apply_gradients(zip(gradients[1:], train_vars))
+    perturbation[:batch_size].assign(
+        tf.clip_by_value(delta + eps * tf.sign(gradients[0]), -eps, eps))
+
+    with writer.as_default():
+        prediction = tf.math.argmax(y_hat, axis=-1, output_type=tf.int32)
+        classification_rate = tf.reduce_mean(
+            tf.cast(tf.equal(prediction, labels), tf.float32))
+        tf.summary.scalar("train_adversarial_classification_rate",
+                          classification_rate,
+                          step=global_step)
+        tf.summary.scalar("train_adversarial_loss/mean classification",
+                          mean_classification_loss,
+                          step=global_step)
+    loss_numerator = tf.reduce_sum(classification_loss)
+    accuracy_numerator = tf.reduce_sum(
+        tf.cast(tf.equal(prediction, labels), tf.int32))
+    denominator = x.shape[0]
+    return loss_numerator, accuracy_numerator, denominator
+
+
+def train(data_dict,
+          model,
+          optimizer,
+          global_step,
+          writer,
+          early_stopping,
+          train_conv_stack,
+          lambd,
+          alpha,
+          checkpoint,
+          ckpt_manager,
+          debug,
+          input_grad_method='exact',
+          fd_step_size=1e-2,
+          free_adv_replays=0,
+          free_adv_eps=8. / 255.):
     if train_conv_stack:
         train_model = model
     else:
         train_model = model.classifier
+    perturbation = None
 
     for epoch in range(early_stopping.max_epochs):
         # train
-        train_batches = data_dict['train']
+        train_timer = InputWaitTimer(data_dict['train'])
+        train_batches = train_timer
         num_classes = data_dict['num_classes']
         if debug:
-            train_batches = tqdm(train_batches, total=data_dict['train_bpe'])
+            train_batches = tqdm(train_timer, total=data_dict['train_bpe'])
         print("Epoch", epoch)
         print("TRAIN")
         loss_numerator = 0
         acc_numerator = 0
         denominator = 0
         for batch in train_batches:
+            if free_adv_replays > 0:
+                if perturbation is None:
+                    # sized by the first batch, which setup_tfds makes
+                    # the largest, later batches use a leading slice
+                    perturbation = tf.Variable(
+                        tf.zeros_like(normalize_image(batch['image'])))
+                    # variables can only be created by the first trace of
+                    # run_free_adversarial_minibatch, which may be another
+                    # model's
+                    train_model(perturbation)
+                    optimizer.build(train_model.trainable_variables)
+                for _ in range(free_adv_replays):
+                    l, a, d = run_free_adversarial_minibatch(
+                        train_model, optimizer, global_step, batch, num_classes,
+                        perturbation, free_adv_eps, writer)
+                    acc_numerator += a
+                    loss_numerator += l
+                    denominator += d
+                continue
             l, a, d = run_minibatch(train_model,
                                     optimizer,
                                     global_step,
@@ -127,17 +269,21 @@ def train(data_dict, model, optimizer, global_step, writer, early_stopping,
                                     lambd,
                                     alpha,
                                     writer,
-                                    is_train=True)
+                                    is_train=True,
+                                    input_grad_method=input_grad_method,
+                                    fd_step_size=fd_step_size)
             acc_numerator += a
             loss_numerator += l
             denominator += d
         print("Train Accuracy:", float(acc_numerator) / float(denominator))
         print("Train Loss:", float(loss_numerator) / float(denominator))
+        print("Train Input Wait:", train_timer)
 
         # test
-        test_batches = data_dict['test']
+        test_timer = InputWaitTimer(data_dict['test'])
+        test_batches = test_timer
         if debug:
-            test_batches = tqdm(test_batches, total=data_dict['test_bpe'])
+            test_batches = tqdm(test_timer, total=data_dict['test_bpe'])
         print("TEST")
         loss_numerator = 0
         acc_numerator = 0
@@ -152,12 +298,15 @@ def train(data_dict, model, optimizer, global_step, writer, early_stopping,
                                     lambd,
                                     alpha,
                                     writer,
-                                    is_train=False)
+                                    is_train=False,
+                                    input_grad_method=input_grad_method,
+                                    fd_step_size=fd_step_size)
             acc_numerator += a
             loss_numerator += l
             denominator += d
         print("Test Accuracy:", float(acc_numerator) / float(denominator))
         print("Test Loss:", float(loss_numerator) / float(denominator))
+        print("Test Input Wait:", test_timer)
 
         # checkpointing and early stopping
         if early_stopping(epoch, float(loss_numerator) / float(denominator)):
@@ -167,8 +316,12 @@ def train(data_dict, model, optimizer, global_step, writer, early_stopping,
     checkpoint.restore(ckpt_manager.latest_checkpoint).assert_consumed()
 
 
-def build_savable_objects(conv_stack_name, data_dict, learning_rate, model_dir,
-                          model_name):
+def build_savable_objects(conv_stack_name,
+                          data_dict,
+                          learning_rate,
+                          model_dir,
+                          model_name,
+                          remat_segments=0):
     global_step = tf.compat.v1.train.get_or_create_global_step()
     if conv_stack_name == 'vgg19':
         conv_stack = get_network_builder(conv_stack_name)(shape=[32, 32, 3])
@@ -178,7 +331,8 @@ def build_savable_objects(conv_stack_name, data_dict, learning_rate, model_dir,
         [tf.keras.layers.Dense(data_dict['num_classes'])])
 
     clean = lambda varStr: re.sub('\W|^(?=\d)', '_', varStr)
-    model = GenericClassifier(conv_stack, classifier, clean(model_name))
+    model = GenericClassifier(conv_stack, classifier, clean(model_name),
+                              remat_segments)
     optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate,
                                          beta_1=0.5,
                                          epsilon=10e-4)
@@ -202,6 +356,57 @@ def build_savable_objects(conv_stack_name, data_dict, learning_rate, model_dir,
     }
 
 
+def preprocess_data_dict(data_dict, model, conv_stack_name, cache_dir,
+                         max_bytes, seed):
+    """Replaces the train and test sets with cached conv stack embeddings
+
+    Cache entries are keyed on the conv stack's weights, the dataset and
+    the preprocessing config, so stale embeddings are never reused.
+
+    Args:
+        data_dict (dict): As returned by `setup_tfds`
+        model (GenericClassifier): Model whose conv stack embeds the data
+        conv_stack_name (str): Name of the conv stack network
+        cache_dir (str): Directory of the embedding cache
+        max_bytes (int): Size bound of the embedding cache
+        seed (int): Seed of the shuffle order
+
+    Returns:
+        A copy of data_dict where train and test are batches of embeddings
+    """
+
+    def embed(x):
+        # flattened the same way as GenericClassifier.__call__ squeezes
+        features = model.features(x)
+        return tf.reshape(features, [-1, features.shape[1:].num_elements()])
+
+    for x in data_dict['train']:
+        batch_size = x['label'].shape[0]
+        # build the conv stack so its weights can be fingerprinted
+        embed(normalize_image(x['image']))
+        break
+    cache = EmbeddingCache(cache_dir, max_bytes)
+    fingerprint = module_fingerprint(model.conv_stack.variables)
+    config = {
+        'conv_stack_name': conv_stack_name,
+        'shape': [int(d) for d in data_dict['shape']],
+        'data_limit': data_dict.get('data_limit', -1),
+        'embedding': 'flat'
+    }
+
+    preprocessed_data_dict = copy.copy(data_dict)
+    keys = []
+    for split in ['train', 'test']:
+        key = cache_key(fingerprint, data_dict['name'], split, config)
+        preprocessed_data_dict[split] = PreprocessedDataset(
+            data_dict[split], embed, cache.path(key))(batch_size,
+                                                      shuffle_seed=seed)
+        cache.touch(key)
+        keys.append(key)
+    cache.evict(keep=keys)
+    return preprocessed_data_dict
+
+
 def learn(data_dict,
           seed,
           output_dir,
@@ -209,14 +414,39 @@ def learn(data_dict,
           learning_rate=3e-3,
           conv_stack_name='vgg19',
           is_preprocessed=False,
-          train_conv_stack=False,
+          train_conv_stack=True,
           patience=2,
           max_epochs=10,
           lambd=0.,
           alpha=0.,
-          model_name='generic_classifier'):
+          model_name='generic_classifier',
+          preprocessed_dir='.preprocessed_data',
+          preprocessed_max_bytes=20 * 2**30,
+          input_grad_method='exact',
+          fd_step_size=1e-2,
+          remat_segments=0,
+          free_adv_replays=0,
+          free_adv_eps=8. / 255.):
+    """
+    Args:
+        train_conv_stack (bool): Optional, if False the conv stack is frozen, the data is embedded once (see `preprocess_data_dict`) and only the classifier is trained, without input gradient regularization
+        remat_segments (int): Optional, if positive the conv stack's activations are recomputed in the backward pass (see `pyroclast.common.models.rematerialize`)
+        free_adv_replays (int): Optional, if positive train adversarially "for free" by replaying each minibatch this many times (see `run_free_adversarial_minibatch`). Divide max_epochs by the same factor to keep the cost of standard training.
+        free_adv_eps (float): Optional, L-inf bound on the free adversarial perturbation
+    """
+    if (lambd != 0. or alpha != 0.) and (is_preprocessed or
+                                         not train_conv_stack):
+        # the classifier only sees cached embeddings, so the gradient would
+        # be with respect to the embeddings rather than the input
+        raise ValueError(
+            'Input gradient regularization (lambd or alpha != 0) needs '
+            'train_conv_stack=True and is_preprocessed=False')
+    if free_adv_replays > 0 and (is_preprocessed or not train_conv_stack):
+        raise ValueError(
+            'Free adversarial training perturbs the input, so it needs '
+            'train_conv_stack=True and is_preprocessed=False')
     objects = build_savable_objects(conv_stack_name, data_dict, learning_rate,
-                                    output_dir, model_name)
+                                    output_dir, model_name, remat_segments)
     model = objects['model']
     optimizer = objects['optimizer']
     global_step = objects['global_step']
@@ -225,18 +455,13 @@ def learn(data_dict,
 
     writer = tf.summary.create_file_writer(output_dir)
     # setup checkpointing
-    if is_preprocessed:
-        for x in data_dict['train']:
-            batch_size = x['label'].shape[0]
-            break
-        preprocessed_dataset = copy.copy(data_dict)
-        preprocessed_dataset['train'] = PreprocessedDataset(
-            data_dict['train'], model.features, '.preprocessed_data/vgg19' +
-            data_dict['name'] + '_train')(batch_size)
-        preprocessed_dataset['test'] = PreprocessedDataset(
-            data_dict['test'], model.features, '.preprocessed_data/vgg19' +
-            data_dict['name'] + '_test')(batch_size)
-        train_data = preprocessed_dataset
+    # a frozen conv stack gives the same features every epoch, so embed the
+    # data once and train the classifier directly on the cached features
+    if is_preprocessed or not train_conv_stack:
+        train_data = preprocess_data_dict(data_dict, model, conv_stack_name,
+                                          preprocessed_dir,
+                                          preprocessed_max_bytes, seed)
+        train_conv_stack = False
     else:
         train_data = data_dict
 
@@ -245,7 +470,8 @@ def learn(data_dict,
                                    eps=0.03,
                                    max_epochs=max_epochs)
     train(train_data, model, optimizer, global_step, writer, early_stopping,
-          (not is_preprocessed), lambd, alpha, checkpoint, ckpt_manager, debug)
+          train_conv_stack, lambd, alpha, checkpoint, ckpt_manager, debug,
+          input_grad_method, fd_step_size, free_adv_replays, free_adv_eps)
 
     return model
 
@@ -254,7 +480,12 @@ def plot_input_grads(data_dict,
                      seed,
                      output_dir,
                      debug,
-                     conv_stack_name='vgg19'):
+                     conv_stack_name='vgg19',
+                     artifact_writer=None):
+    """
+    Args:
+        artifact_writer (ArtifactWriter): Optional, if given input_grads.png is saved in the background
+    """
     args = locals()
     args['learning_rate'] = 2e-4
     args['train_conv_stack'] = True
@@ -289,21 +520,30 @@ def plot_input_grads(data_dict,
             models[model_name] = model
 
     for batch in data_dict['test']:
-        fig = plot_grads(tf.cast(batch['image'][:5], tf.float32) / 255.,
+        fig = plot_grads(normalize_image(batch['image'][:5]),
                          list(models.values()),
                          list(models.keys()),
                          data_dict['shape'],
                          data_dict['num_classes'],
                          debug=debug)
         break
-    plt.savefig('input_grads.png')
+    if artifact_writer is not None:
+        artifact_writer.save_figure('input_grads.png', fig)
+    else:
+        fig.savefig('input_grads.png')
+        plt.close(fig)
 
 
 def visualize_feature_perturbations(data_dict,
                                     seed,
                                     output_dir,
                                     debug,
-                                    conv_stack_name='tiny_net'):
+                                    conv_stack_name='tiny_net',
+                                    artifact_writer=None):
+    """
+    Args:
+        artifact_writer (ArtifactWriter): Optional, if given the figures are saved in the background
+    """
     objects = build_savable_objects(conv_stack_name, data_dict, 2e-4,
                                     output_dir, 'features_model')
     model = objects['model']
@@ -321,7 +561,8 @@ def visualize_feature_perturbations(data_dict,
                                   debug=debug)
     heatmap(usefulness,
             output_dir + '/' + 'mnist_lambd1' + '_rho_usefulness.png',
-            'rho usefulness')
+            'rho usefulness',
+            artifact_writer=artifact_writer)
 
     for batch in data_dict['train']:
         if batch['label'][0] != 9:
@@ -338,15 +579,19 @@ def visualize_feature_perturbations(data_dict,
         print('Found class logits', model.logits(found))
         break
 
+    def save(path):
+        if artifact_writer is not None:
+            artifact_writer.save_figure(path, plt.gcf())
+        else:
+            plt.savefig(path)
+            plt.close()
+
     plt.imshow(tf.squeeze(original))
     print(tf.reduce_min(original), tf.reduce_max(original))
-    plt.savefig('original')
-    plt.close()
+    save('original')
     plt.imshow(tf.squeeze(found))
     print(tf.reduce_min(found), tf.reduce_max(found))
-    plt.savefig('found')
-    plt.close()
+    save('found')
     plt.imshow(tf.squeeze(found - original))
     print(tf.reduce_min(found - original), tf.reduce_max(found - original))
-    plt.savefig('diff')
-    plt.close()
+    save('diff')
@@ -1,9 +1,20 @@
+import os.path as osp
+import tempfile
+from unittest import mock
+
+import numpy as np
 import tensorflow as tf
 from absl.testing import parameterized
 
+from pyroclast.common import tf_util
+from pyroclast.common.tf_util_test import fake_tfds_load
+from pyroclast.features import features
 from pyroclast.features.networks import get_network_builder
 from pyroclast.common.tf_util import setup_tfds
-from pyroclast.features.features import build_savable_objects, run_minibatch
+from pyroclast.features.features import (build_savable_objects,
+                                         finite_difference_input_grad_norm,
+                                         run_free_adversarial_minibatch,
+                                         run_minibatch)
 
 
 class PrototypeModelTest(parameterized.TestCase):
@@ -45,4 +56,181 @@ class PrototypeModelTest(parameterized.TestCase):
                           batch, self.ds['num_classes'], 1., 0., writer)
             run_minibatch(self.model, self.optimizer, self.global_step, 0,
                           batch, self.ds['num_classes'], 1., 1., writer)
+            run_minibatch(self.model,
+                          self.optimizer,
+                          self.global_step,
+                          0,
+                          batch,
+                          self.ds['num_classes'],
+                          1.,
+                          0.,
+                          writer,
+                          input_grad_method='finite_difference')
             break
+
+
+class FrozenConvStackTest(parameterized.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        with mock.patch.object(tf_util.tfds, 'load', fake_tfds_load(12)):
+            self.ds = setup_tfds('fake', 4, shuffle_seed=0)
+
+    def learn(self, **kwargs):
+        return features.learn(self.ds,
+                              0,
+                              self.output_dir,
+                              False,
+                              conv_stack_name='attack_net',
+                              train_conv_stack=False,
+                              max_epochs=2,
+                              preprocessed_dir=osp.join(self.output_dir,
+                                                        'preprocessed'),
+                              **kwargs)
+
+    def test_classifier_trained_on_cached_features(self):
+        embedded = {}
+        preprocess_data_dict = features.preprocess_data_dict
+
+        def record_preprocess_data_dict(data_dict, model, *args):
+            preprocessed = preprocess_data_dict(data_dict, model, *args)
+            embedded['conv_stack'] = [
+                v.numpy() for v in model.conv_stack.variables
+            ]
+            embedded['batches'] = list(preprocessed['train'])
+            return preprocessed
+
+        with mock.patch.object(features, 'preprocess_data_dict',
+                               record_preprocess_data_dict):
+            model = self.learn()
+
+        # the classifier sees flat embeddings of the conv stack
+        batch = embedded['batches'][0]
+        assert batch['image'].shape == (4, 64)
+        np.testing.assert_allclose(model.classify_features(batch['image']),
+                                   model.classifier(batch['image']))
+        # while the conv stack is left untouched
+        for v, e in zip(model.conv_stack.variables, embedded['conv_stack']):
+            np.testing.assert_array_equal(v.numpy(), e)
+
+    @parameterized.parameters((1., 0.), (0., 1.))
+    def test_input_grad_regularization_rejected(self, lambd, alpha):
+        with self.assertRaises(ValueError):
+            self.learn(lambd=lambd, alpha=alpha)
+
+
+class FreeAdversarialTest(parameterized.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.model = tf.keras.Sequential(
+            [tf.keras.layers.Flatten(),
+             tf.keras.layers.Dense(3)])
+        self.optimizer = tf.keras.optimizers.SGD(0.1)
+        self.global_step = tf.Variable(0, dtype=tf.int64)
+        self.writer = tf.summary.create_noop_writer()
+
+    def test_perturbation_carried_across_replays(self):
+        eps = 0.1
+        batch = {
+            'image': np.random.randint(0, 256, [4, 4, 4, 1], dtype=np.uint8),
+            'label': np.arange(4) % 3
+        }
+        x = tf.cast(batch['image'], tf.float32) / 255.
+        self.model(x)
+        perturbation = tf.Variable(tf.zeros_like(x))
+        for _ in range(3):
+            # the signed ascent step from the perturbation before the replay
+            delta = tf.identity(perturbation)
+            with tf.GradientTape() as tape:
+                tape.watch(delta)
+                loss = tf.reduce_mean(
+                    tf.nn.softmax_cross_entropy_with_logits(
+                        labels=tf.one_hot(batch['label'], 3),
+                        logits=self.model(tf.clip_by_value(x + delta, 0., 1.))))
+            expected = tf.clip_by_value(
+                delta + eps * tf.sign(tape.gradient(loss, delta)), -eps, eps)
+            run_free_adversarial_minibatch(self.model, self.optimizer,
+                                           self.global_step, batch, 3,
+                                           perturbation, eps, self.writer)
+            np.testing.assert_allclose(perturbation, expected, atol=1e-6)
+            assert np.max(np.abs(perturbation.numpy())) <= eps + 1e-7
+        assert int(self.optimizer.iterations) == 3
+
+    def test_weights_updated_every_replay(self):
+        with mock.patch.object(tf_util.tfds, 'load', fake_tfds_load(10)):
+            # the last batch has 2 data
+            ds = setup_tfds('fake', 4, shuffle_seed=0)
+        objects = {}
+
+        def record_build_savable_objects(*args):
+            objects.update(build_savable_objects(*args))
+            return objects
+
+        with mock.patch.object(features, 'build_savable_objects',
+                               record_build_savable_objects):
+            features.learn(ds,
+                           0,
+                           self.output_dir,
+                           False,
+                           conv_stack_name='attack_net',
+                           max_epochs=1,
+                           free_adv_replays=3)
+        num_batches = len(list(ds['train']))
+        assert num_batches == 3
+        assert int(objects['optimizer'].iterations) == 3 * num_batches
+
+
+class FiniteDifferenceTest(parameterized.TestCase):
+
+    @parameterized.parameters(([4, 4, 1],), ([32, 32, 3],))
+    def test_matches_exact_input_grad_norm(self, shape):
+        tf.keras.utils.set_random_seed(0)
+        model = tf.keras.Sequential([
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Dense(16, activation='tanh'),
+            tf.keras.layers.Dense(3)
+        ])
+        x = tf.random.uniform([4] + shape)
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            y_hat = model(x)
+        exact = float(tf.math.square(tf.norm(tape.gradient(y_hat, x), 2)))
+
+        estimate = tf.function(finite_difference_input_grad_norm)
+        estimates = [
+            float(estimate(model, x, y_hat, 1e-2)) for _ in range(2000)
+        ]
+        # unbiased, up to the sampling error of the mean
+        np.testing.assert_allclose(np.mean(estimates), exact, rtol=0.1)
+
+    def test_matches_exact_directional_derivative(self):
+        tf.keras.utils.set_random_seed(0)
+        model = tf.keras.Sequential([
+            tf.keras.layers.Conv2D(8, 3, activation='relu'),
+            tf.keras.layers.Conv2D(8, 3, activation='relu'),
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Dense(3)
+        ])
+        x = tf.random.uniform([4, 32, 32, 3])
+        with tf.GradientTape() as tape:
+            tape.watch(x)
+            y_hat = model(x)
+        grad = tape.gradient(y_hat, x)
+
+        relative_errors = []
+        for seed in range(20):
+            tf.random.set_seed(seed)
+            estimate = float(
+                finite_difference_input_grad_norm(model, x, y_hat, 1e-2))
+            # the same direction, by reseeding
+            tf.random.set_seed(seed)
+            direction = tf.nn.l2_normalize(tf.random.normal(x.shape),
+                                           axis=[1, 2, 3])
+            exact = 32 * 32 * 3 * float(
+                tf.reduce_sum(
+                    tf.math.square(
+                        tf.reduce_sum(grad * direction, axis=[1, 2, 3]))))
+            relative_errors.append(abs(estimate - exact) / exact)
+        # a step of length 1e-2 rarely crosses a relu's kink
+        assert np.mean(relative_errors) < 0.03
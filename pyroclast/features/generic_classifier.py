@@ -1,14 +1,22 @@
 from pyroclast.common.feature_classifier_mixin import FeatureClassifierMixin
+from pyroclast.common.models import rematerialize
 from pyroclast.common.visualizable import VisualizableMixin
 import tensorflow as tf
 
 
 class GenericClassifier(tf.Module, VisualizableMixin, FeatureClassifierMixin):
 
-    def __init__(self, conv_stack, classifier, name):
+    def __init__(self, conv_stack, classifier, name, remat_segments=0):
+        """
+        Args:
+            remat_segments (int): Optional, if positive the conv stack is split into this many segments whose activations are recomputed in the backward pass
+        """
         super(GenericClassifier, self).__init__(name=name)
         self.conv_stack = conv_stack
         self.classifier = classifier
+        self._remat_fn = None
+        if remat_segments > 0:
+            self._remat_fn = rematerialize(conv_stack, remat_segments)
 
     def __call__(self, x):
         embed = self.features(x)
@@ -17,6 +25,8 @@ class GenericClassifier(tf.Module, VisualizableMixin, FeatureClassifierMixin):
         return self.classifier(embed)
 
     def features(self, x):
+        if self._remat_fn is not None:
+            return self._remat_fn(x)
         return self.conv_stack(x)
 
     def classify_features(self, z):
@@ -28,5 +38,30 @@ class GenericClassifier(tf.Module, VisualizableMixin, FeatureClassifierMixin):
     def logits(self, x):
         return self(x)
 
+    @property
     def conv_stack_submodel(self):
-        raise NotImplementedError()
+        """Layers of the conv stack before it is flattened
+
+        An InputLayer is skipped, as in `rematerialize`, so activation 0 is
+        that of the first real layer.
+        """
+        layers = []
+        for layer in self._conv_stack_layers:
+            if isinstance(layer, tf.keras.layers.Flatten):
+                break
+            layers.append(layer)
+        return layers
+
+    @property
+    def _conv_stack_layers(self):
+        return [
+            layer for layer in self.conv_stack.layers
+            if not isinstance(layer, tf.keras.layers.InputLayer)
+        ]
+
+    def logits_from_conv_stack(self, z):
+        for layer in self._conv_stack_layers[len(self.conv_stack_submodel):]:
+            z = layer(z)
+        if len(z.shape) > 2:
+            z = tf.squeeze(z)
+        return self.classifier(z)
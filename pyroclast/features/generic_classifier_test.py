@@ -0,0 +1,31 @@
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+
+from pyroclast.features.generic_classifier import GenericClassifier
+
+
+class GenericClassifierTest(parameterized.TestCase):
+
+    def test_functional_conv_stack(self):
+        # a functional model, like vgg19, has an InputLayer first
+        inputs = tf.keras.Input([8, 8, 3])
+        h = tf.keras.layers.Conv2D(4, 3, activation=tf.nn.relu)(inputs)
+        h = tf.keras.layers.Conv2D(4, 3, activation=tf.nn.relu)(h)
+        conv_stack = tf.keras.Model(inputs, tf.keras.layers.Flatten()(h))
+        model = GenericClassifier(conv_stack, tf.keras.layers.Dense(2),
+                                  'classifier')
+        x = tf.random.uniform([5, 8, 8, 3])
+        logits = model(x)
+
+        layers = model.conv_stack_submodel
+        assert len(layers) == 2
+        assert not any(
+            isinstance(layer, tf.keras.layers.InputLayer) for layer in layers)
+        z = x
+        for layer in layers:
+            z = layer(z)
+        np.testing.assert_allclose(model.logits_from_conv_stack(z),
+                                   logits,
+                                   rtol=1e-5,
+                                   atol=1e-6)
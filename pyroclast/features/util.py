@@ -1,5 +1,7 @@
 import tensorflow as tf
 
+from pyroclast.common.tf_util import normalize_image
+
 
 def build_savable_objects(conv_stack_name, data_dict, learning_rate, model_dir,
                           model_name):
@@ -78,7 +80,7 @@ def run_minibatch(model,
         writer (tf.summary.SummaryWriter):
         is_train (bool): Optional, run backwards pass if True
     """
-    x = tf.cast(batch['image'], tf.float32) / 255.
+    x = normalize_image(batch['image'])
     labels = tf.cast(batch['label'], tf.int32)
     with tf.GradientTape() as tape:
         with tf.GradientTape() as inner_tape:
@@ -132,6 +132,7 @@ class EvalTask(luigi.Task):
             beta=self.beta,
             gamma=self.gamma,
             patience=12,
+            snapshot_dir=get_base_path('snapshot'),
             debug=True)
 
     def output(self):
@@ -226,6 +227,7 @@ class TrainTask(luigi.Task):
             beta=self.beta,
             gamma=self.gamma,
             patience=12,
+            snapshot_dir=get_base_path('snapshot'),
             debug=True)
 
     def output(self):
@@ -89,6 +89,7 @@ class TrainTask(luigi.Task):
         cmd_str += ' --learning_rate {}'.format(self.learning_rate)
         cmd_str += ' --seed {}'.format(self.seed)
         cmd_str += ' --output_dir {}'.format(local_output_dir)
+        cmd_str += ' --snapshot_dir {}'.format(get_base_path('snapshot'))
         subprocess.run(cmd_str.split(' '), check=True)
         shutil.copytree(local_output_dir, remote_output_dir)
 
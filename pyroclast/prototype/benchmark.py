@@ -0,0 +1,92 @@
+"""Benchmarks of the prototype distance kernels
+
+Runs on random data at the size of the prototype layer's input, e.g.
+`python -m pyroclast.prototype.benchmark --batch_size 64 --num_prototypes 200 --prototype_dim 128`
+"""
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from pyroclast.common.cmd_util import arg_parser
+from pyroclast.prototype.tf_util import (distance_similarity, l2_distance,
+                                         min_l2_distance)
+
+
+def conv_l2_distance(images, vectors):
+    """The previous kernel, with two convolutions, kept for comparison"""
+    image_sq = tf.nn.conv2d(input=images**2,
+                            filters=tf.ones(
+                                [1, 1, images.shape[-1], vectors.shape[0]]),
+                            strides=1,
+                            padding="SAME")
+    vectors_sq = tf.reduce_sum(vectors**2, 1)
+    vector_filters = tf.expand_dims(tf.expand_dims(tf.transpose(vectors), 0), 0)
+    image_vector_prod = tf.nn.conv2d(input=images,
+                                     filters=vector_filters,
+                                     strides=1,
+                                     padding="SAME")
+    return image_sq - (2 * image_vector_prod) + vectors_sq
+
+
+def conv_activations(images, vectors):
+    distances = conv_l2_distance(images, vectors)
+    similarities = distance_similarity(distances)
+    return tf.reduce_min(distances, [1, 2]), tf.reduce_max(similarities, [1, 2])
+
+
+def matmul_activations(images, vectors):
+    distances = l2_distance(images, vectors)
+    similarities = distance_similarity(distances)
+    return tf.reduce_min(distances, [1, 2]), tf.reduce_max(similarities, [1, 2])
+
+
+def time_fn(fn, images, vectors, num_steps):
+    """Mean wall-clock time of a compiled forward and backward pass"""
+
+    @tf.function
+    def step():
+        with tf.GradientTape() as tape:
+            tape.watch(images)
+            min_distances, similarities = fn(images, vectors)
+            loss = tf.reduce_sum(min_distances) + tf.reduce_sum(similarities)
+        return tape.gradient(loss, images)
+
+    step()
+    start = time.time()
+    for _ in range(num_steps):
+        grad = step()
+    grad.numpy()
+    return (time.time() - start) / num_steps
+
+
+def main(args):
+    parser = arg_parser()
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_prototypes', type=int, default=200)
+    parser.add_argument('--prototype_dim', type=int, default=128)
+    parser.add_argument('--spatial_size', type=int, default=7)
+    parser.add_argument('--num_steps', type=int, default=20)
+    args = parser.parse_args(args)
+
+    images = tf.random.uniform([
+        args.batch_size, args.spatial_size, args.spatial_size,
+        args.prototype_dim
+    ])
+    vectors = tf.random.uniform([args.num_prototypes, args.prototype_dim])
+
+    reference = conv_activations(images, vectors)
+    kernels = [('conv', conv_activations), ('matmul', matmul_activations),
+               ('matmul min first', min_l2_distance)]
+    print('{:>18s} {:>10s} {:>12s}'.format('', 's/step', 'max abs err'))
+    for name, fn in kernels:
+        step_time = time_fn(fn, images, vectors, args.num_steps)
+        error = max(
+            float(np.max(np.abs(a - b)))
+            for a, b in zip(fn(images, vectors), reference))
+        print('{:>18s} {:>10.5f} {:>12.2e}'.format(name, step_time, error))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
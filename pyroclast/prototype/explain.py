@@ -0,0 +1,97 @@
+"""Explanations of every image of a dataset split
+
+Streams a split through `ProtoPNet.explain` once and writes, for each
+image, a row of the image followed by the similarity maps of its top k
+prototypes overlaid on it. PNG encoding runs in an `ArtifactWriter`, so
+the model never waits on the disk.
+"""
+import os
+import os.path as osp
+
+import matplotlib.pyplot as plt
+import numpy as np
+from tqdm import tqdm
+
+from pyroclast.common.artifact_writer import ArtifactWriter
+from pyroclast.common.plot import compose_grid
+from pyroclast.common.tf_util import normalize_image
+
+
+def overlay_maps(images, maps, cmap='jet', alpha=0.5):
+    """Blends colormapped similarity maps with their images
+
+    Args:
+        images (np.array): shape [N, H, W, C] with values in [0, 1]
+        maps (np.array): shape [N, k, H, W], each scaled by its own range
+        alpha (float): Optional, weight of the maps in the blend
+
+    Returns:
+        np.array of shape [N, k, H, W, 3] with values in [0, 1]
+    """
+    low = maps.min(axis=(2, 3), keepdims=True)
+    high = maps.max(axis=(2, 3), keepdims=True)
+    maps = (maps - low) / np.maximum(high - low, 1e-8)
+    heat = plt.get_cmap(cmap)(maps)[..., :3]
+    images = np.broadcast_to(images[..., :3], images.shape[:3] + (3,))[:, None]
+    return (1 - alpha) * images + alpha * heat
+
+
+def explain_dataset(model,
+                    batches,
+                    output_dir,
+                    k=3,
+                    artifact_writer=None,
+                    debug=False):
+    """Writes an explanation image per datum and a summary of all of them
+
+    Images are written to output_dir/explanation_<index>.png, where index
+    is the datum's 'index', so names don't depend on the order of
+    batches, and the top prototypes of every image to
+    output_dir/explanations.npz.
+
+    Args:
+        model (ProtoPNet): Model to explain
+        batches (iterable of dict): Batches with 'image', 'label', and 'index', as served by `setup_tfds`
+        output_dir (str): Directory to write to
+        k (int): Optional, number of prototypes per image
+        artifact_writer (ArtifactWriter): Optional, if None one is created and closed before returning
+
+    Returns:
+        summary (dict of np.array): 'index', 'label', and 'prediction' of shape [N], and 'prototype', 'similarity', and 'contribution' of shape [N, k]
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    owns_writer = artifact_writer is None
+    if owns_writer:
+        # bounded, so a fast model can't queue the whole split in memory
+        artifact_writer = ArtifactWriter(max_pending=64)
+    summary = {
+        key: [] for key in [
+            'index', 'label', 'prediction', 'prototype', 'similarity',
+            'contribution'
+        ]
+    }
+    if debug:
+        batches = tqdm(batches)
+    try:
+        for batch in batches:
+            x = normalize_image(batch['image'])
+            explanation = model.explain(x, k)
+            overlays = overlay_maps(x.numpy(), explanation['maps'].numpy())
+            for image, image_overlays, index in zip(x.numpy(), overlays,
+                                                    np.asarray(batch['index'])):
+                grid, _ = compose_grid([image] + list(image_overlays),
+                                       cmap='gray')
+                artifact_writer.save_array(
+                    osp.join(output_dir, 'explanation_{}.png'.format(index)),
+                    grid)
+            for key in summary:
+                if key in ['index', 'label']:
+                    summary[key].append(np.asarray(batch[key]))
+                else:
+                    summary[key].append(explanation[key].numpy())
+    finally:
+        if owns_writer:
+            artifact_writer.close()
+    summary = {key: np.concatenate(value) for key, value in summary.items()}
+    np.savez(osp.join(output_dir, 'explanations.npz'), **summary)
+    return summary
@@ -0,0 +1,93 @@
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+
+from pyroclast.common.models import get_network_builder
+from pyroclast.prototype.explain import explain_dataset, overlay_maps
+from pyroclast.prototype.model import ProtoPNet, _explain
+
+
+class ExplainTest(parameterized.TestCase):
+
+    def setUp(self):
+        conv_stack = get_network_builder('mnist_conv')()
+        self.model = ProtoPNet(conv_stack, 20, 16, 10)
+        self.x = tf.random.uniform([6, 28, 28, 1])
+
+    def test_explain(self):
+        explanation = self.model.explain(self.x, k=3)
+        conv_output = self.model.final_conv(self.model.conv_stack(self.x))
+        _, similarity_maps = self.model.prototype_layer(conv_output,
+                                                        self.model.prototypes)
+        similarities = tf.reduce_max(similarity_maps, axis=[1, 2]).numpy()
+        prediction = np.argmax(self.model(self.x)[0], axis=1)
+        contribution = similarities * self.model.classifier.kernel.numpy(
+        ).T[prediction]
+        np.testing.assert_array_equal(explanation['prediction'], prediction)
+        np.testing.assert_array_equal(explanation['prototype'],
+                                      np.argsort(-contribution, axis=1)[:, :3])
+        np.testing.assert_allclose(explanation['contribution'],
+                                   -np.sort(-contribution, axis=1)[:, :3],
+                                   rtol=1e-5)
+        np.testing.assert_allclose(explanation['similarity'],
+                                   np.take_along_axis(
+                                       similarities,
+                                       explanation['prototype'].numpy(), 1),
+                                   rtol=1e-5)
+
+        # [N, H, W, k] maps of the chosen prototypes, at input resolution
+        maps = np.take_along_axis(
+            similarity_maps.numpy(),
+            explanation['prototype'].numpy()[:, None, None],
+            axis=3)
+        np.testing.assert_allclose(explanation['maps'],
+                                   np.transpose(tf.image.resize(maps, [28, 28]),
+                                                [0, 3, 1, 2]),
+                                   rtol=1e-4,
+                                   atol=1e-4)
+
+    def test_explain_batch_sizes_share_a_trace(self):
+        # the first call runs eagerly and builds the model
+        self.model.explain(self.x[:1])
+        num_traces = _explain.experimental_get_tracing_count()
+        # the second batch size generalizes the trace to any batch size
+        for batch_size in [4, 4, 3, 2, 5]:
+            self.model.explain(self.x[:batch_size])
+        assert _explain.experimental_get_tracing_count() - num_traces == 2
+
+    def test_overlay_maps(self):
+        images = np.random.uniform(size=[2, 5, 5, 1])
+        maps = np.random.normal(size=[2, 3, 5, 5])
+        overlays = overlay_maps(images, maps)
+        assert overlays.shape == (2, 3, 5, 5, 3)
+        assert np.all(overlays >= 0.) and np.all(overlays <= 1.)
+        # with no weight on the maps, only the image remains
+        np.testing.assert_allclose(
+            overlay_maps(images, maps, alpha=0.)[:, 1],
+            np.tile(images, [1, 1, 1, 3]))
+
+    def test_explain_dataset(self):
+        output_dir = tempfile.mkdtemp()
+        batches = [{
+            'image': tf.cast(self.x[:4] * 255, tf.uint8),
+            'label': tf.zeros([4], tf.int64),
+            'index': tf.constant([5, 0, 3, 1], tf.int64)
+        }, {
+            'image': tf.cast(self.x[4:] * 255, tf.uint8),
+            'label': tf.ones([2], tf.int64),
+            'index': tf.constant([4, 2], tf.int64)
+        }]
+        summary = explain_dataset(self.model, batches, output_dir, k=2)
+        files = sorted(os.listdir(output_dir))
+        assert files == sorted(
+            ['explanation_{}.png'.format(i) for i in range(6)] +
+            ['explanations.npz'])
+        saved = np.load(os.path.join(output_dir, 'explanations.npz'))
+        assert saved['prototype'].shape == (6, 2)
+        np.testing.assert_array_equal(saved['label'], [0, 0, 0, 0, 1, 1])
+        np.testing.assert_array_equal(saved['index'], [5, 0, 3, 1, 4, 2])
+        np.testing.assert_array_equal(saved['prediction'],
+                                      summary['prediction'])
@@ -3,6 +3,8 @@ import tensorflow as tf
 
 from pyroclast.prototype.prototype_layer import PrototypeLayer
 from pyroclast.common.feature_classifier_mixin import FeatureClassifierMixin
+from pyroclast.common.tf_util import normalize_image
+from pyroclast.prototype.tf_util import bilinear_upsampling_matrix
 
 
 class ProtoPNet(FeatureClassifierMixin, tf.Module):
@@ -87,10 +89,8 @@ class ProtoPNet(FeatureClassifierMixin, tf.Module):
     def prototype_activations(self, x):
         conv_output = self.final_conv(self.conv_stack(x))
         assert conv_output.shape[1:3] == [7, 7]
-        distances, similarities = self.prototype_layer(conv_output,
-                                                       self.prototypes)
-        minimum_distances = -self.max_pool(-distances)
-        prototype_activations = self.max_pool(similarities)
+        minimum_distances, prototype_activations = self.prototype_layer.min_distances(
+            conv_output, self.prototypes)
         return prototype_activations, minimum_distances, conv_output
 
     def __call__(self, x):
@@ -106,6 +106,94 @@ class ProtoPNet(FeatureClassifierMixin, tf.Module):
         return self.classifier(
             prototype_activations), minimum_distances, conv_output
 
+    def push_prototypes(self, batches):
+        """Replaces each prototype with its nearest training patch
+
+        Makes a single pass over the data, keeping the running nearest
+        patch of every prototype on device. Each batch takes one
+        distance computation against all prototypes. With class
+        specific prototypes, only patches of images from a prototype's
+        class are considered.
+
+        Args:
+            batches (iterable of dict): Batches with 'image', 'label', and 'index', as served by `setup_tfds`
+
+        Returns:
+            provenance (dict of np.array): 'min_distance', 'image_index', 'h', and 'w' of each prototype's nearest patch, each of shape [num_prototypes]. 'image_index' is the 'index' of the patch's image, so it doesn't depend on the order of batches
+        """
+        num_prototypes = self.prototypes.shape[0]
+        min_distance = tf.Variable(tf.fill([num_prototypes], np.inf))
+        image_index = tf.Variable(tf.fill([num_prototypes], -1))
+        row = tf.Variable(tf.fill([num_prototypes], -1))
+        col = tf.Variable(tf.fill([num_prototypes], -1))
+        nearest_patch = tf.Variable(self.prototypes)
+
+        @tf.function
+        def push_step(image, label, index):
+            conv_output = self.final_conv(
+                self.conv_stack(normalize_image(image)))
+            distances, _ = self.prototype_layer(conv_output, self.prototypes)
+            if self.class_specific:
+                # [batch_size, num_prototypes]
+                is_same_class = tf.gather(
+                    tf.transpose(self.prototype_class_identity),
+                    tf.cast(label, tf.int32)) > 0
+                distances = tf.where(is_same_class[:, None, None, :], distances,
+                                     np.inf)
+            height, width = tf.shape(distances)[1], tf.shape(distances)[2]
+            distances = tf.reshape(distances, [-1, num_prototypes])
+            flat_idx = tf.argmin(distances, axis=0, output_type=tf.int32)
+            batch_min = tf.reduce_min(distances, axis=0)
+            improved = batch_min < min_distance
+
+            patches = tf.gather(
+                tf.reshape(conv_output, [-1, conv_output.shape[-1]]), flat_idx)
+            spatial_idx = flat_idx % (height * width)
+            min_distance.assign(tf.where(improved, batch_min, min_distance))
+            image_index.assign(
+                tf.where(
+                    improved,
+                    tf.gather(tf.cast(index, tf.int32),
+                              flat_idx // (height * width)), image_index))
+            row.assign(tf.where(improved, spatial_idx // width, row))
+            col.assign(tf.where(improved, spatial_idx % width, col))
+            nearest_patch.assign(
+                tf.where(improved[:, None], patches, nearest_patch))
+
+        for batch in batches:
+            push_step(batch['image'], batch['label'], batch['index'])
+        self.prototypes.assign(nearest_patch)
+        return {
+            'min_distance': min_distance.numpy(),
+            'image_index': image_index.numpy(),
+            'h': row.numpy(),
+            'w': col.numpy()
+        }
+
+    def explain(self, x, k=3):
+        """Top k prototypes of each image, with their similarity maps
+
+        Prototypes are ranked by their contribution to the logit of the
+        predicted class, i.e. their similarity to the image times their
+        weight in the last layer. Each 7x7 similarity map is upsampled
+        to the input's resolution by a precomputed bilinear operator.
+        After the first, eager, call builds the model, a batch is
+        explained in one compiled call.
+
+        Args:
+            x (tf.Tensor): shape [N, H, W, C] normalized images
+            k (int): Optional, number of prototypes per image
+
+        Returns:
+            dict of tf.Tensor with keys 'prediction' of shape [N],
+            'prototype', 'similarity', and 'contribution' of shape [N, k],
+            and 'maps' of shape [N, k, H, W]
+        """
+        layers = [self.final_conv, self.classifier]
+        if all(layer.built for layer in layers):
+            return _explain(self, x, k)
+        return _explain.python_function(self, x, k)
+
     def conv_prototype_objective(self, min_distances, label=None):
         """
         Args:
@@ -119,8 +207,9 @@ class ProtoPNet(FeatureClassifierMixin, tf.Module):
         term_dict = dict()
         if self.class_specific:
             assert label is not None
-            prototypes_of_correct_class = tf.transpose(
-                self.prototype_class_identity[:, label])
+            # shape [batch_size, num_prototypes]
+            prototypes_of_correct_class = tf.gather(
+                tf.transpose(self.prototype_class_identity), label)
             """
             Because the last activation of `self.final_conv` is a sigmoid,
             this is the numerical maximum. The only problem with this
@@ -158,3 +247,32 @@ class ProtoPNet(FeatureClassifierMixin, tf.Module):
     def get_classification_module(self):
         """Defined for implementing FeatureClassifierMixin"""
         return self.classifier
+
+
+@tf.function(reduce_retracing=True)
+def _explain(model, x, k):
+    """Compiled body of `ProtoPNet.explain`"""
+    conv_output = model.final_conv(model.conv_stack(x))
+    _, similarity_maps = model.prototype_layer(conv_output, model.prototypes)
+    similarities = tf.reduce_max(similarity_maps, axis=[1, 2])
+    prediction = tf.argmax(model.classifier(similarities),
+                           axis=1,
+                           output_type=tf.int32)
+    # [N, num_prototypes] weight of each prototype for the predicted class
+    weights = tf.gather(tf.transpose(model.classifier.kernel), prediction)
+    contribution, prototype = tf.math.top_k(similarities * weights, k)
+
+    # [N, k, 7, 7]
+    maps = tf.gather(tf.transpose(similarity_maps, [0, 3, 1, 2]),
+                     prototype,
+                     batch_dims=1)
+    upsample_h = bilinear_upsampling_matrix(maps.shape[2], x.shape[1])
+    upsample_w = bilinear_upsampling_matrix(maps.shape[3], x.shape[2])
+    maps = tf.einsum('hi,nkij,wj->nkhw', upsample_h, maps, upsample_w)
+    return {
+        'prediction': prediction,
+        'prototype': prototype,
+        'similarity': tf.gather(similarities, prototype, batch_dims=1),
+        'contribution': contribution,
+        'maps': maps
+    }
@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 from absl.testing import parameterized
 
@@ -48,3 +49,17 @@ class PrototypeModelTest(parameterized.TestCase):
                                            norm=2)
         assert robustness.shape == (self.args['num_prototypes'],
                                     self.ds['num_classes'])
+
+    def test_push_prototypes(self):
+        batches = list(self.ds['train'])
+        provenance = self.model.push_prototypes(batches)
+        index = list(np.concatenate([b['index'] for b in batches]))
+        images = np.concatenate([b['image'] for b in batches])
+        patches = self.model.final_conv(
+            self.model.conv_stack(tf.cast(images, tf.float32) / 255.))
+        # every prototype is now the patch recorded in its provenance
+        np.testing.assert_allclose(
+            self.model.prototypes.numpy(),
+            patches.numpy()[[index.index(i) for i in provenance['image_index']],
+                            provenance['h'], provenance['w']],
+            atol=1e-5)
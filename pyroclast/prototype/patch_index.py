@@ -0,0 +1,325 @@
+"""Nearest neighbor index over the patch embeddings of a dataset
+
+Explaining a ProtoPNet prediction ("this looks like that") means finding
+the training patches nearest to a prototype or to a patch of a test
+image. A `PatchIndex` holds the conv output of every training image as
+a memory-mapped [num_patches, C] matrix, so queries never recompute the
+training set.
+
+    index = PatchIndex.build(model, data_dict['train'], 'patch_index')
+    distances, rows = index.search(model.prototypes.numpy(), k=5)
+    image_index, h, w = index.locate(rows)
+
+Patches are recorded with the 'index' of their image (see `setup_tfds`),
+its position in the unshuffled split, so shuffled batches can be
+indexed and `locate` still points at the training image.
+
+Exact search is a blocked matrix multiply over the memory-mapped
+shards. An optional inverted file with product quantized residuals (IVF-PQ) answers
+approximate queries by only scanning the lists nearest to each query.
+"""
+import json
+import os
+import os.path as osp
+import shutil
+
+import numpy as np
+from tqdm import tqdm
+
+from pyroclast.common.preprocessed_dataset import ShardedArray, ShardWriter
+from pyroclast.common.tf_util import normalize_image
+
+INDEX_FILENAME = 'index.json'
+IVF_FILENAMES = ['coarse', 'codebooks', 'codes', 'ids', 'offsets']
+
+
+def kmeans(data, num_clusters, num_iters=20, seed=0):
+    """Lloyd's algorithm
+
+    Args:
+        data (np.array): shape [N, D]
+        num_clusters (int): Number of centroids, at most N
+
+    Returns:
+        centroids (np.array): shape [num_clusters, D]
+    """
+    rng = np.random.RandomState(seed)
+    centroids = data[rng.choice(data.shape[0], num_clusters, replace=False)]
+    for _ in range(num_iters):
+        assignment = nearest_centroid(data, centroids)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, data)
+        # empty clusters keep their previous centroid
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return centroids
+
+
+def nearest_centroid(data, centroids):
+    distances = squared_distances(data, centroids)
+    return np.argmin(distances, axis=1)
+
+
+def squared_distances(a, b, b_sq=None):
+    """Pairwise squared l2 distances between the rows of a and b"""
+    if b_sq is None:
+        b_sq = np.sum(np.square(b), axis=1)
+    distances = np.sum(np.square(a), axis=1, keepdims=True) - 2 * a @ b.T + b_sq
+    return np.maximum(distances, 0.)
+
+
+def merge_top_k(distances, ids, new_distances, new_ids, k):
+    """Keeps the k smallest distances of each row of both sets"""
+    distances = np.concatenate([distances, new_distances], axis=1)
+    ids = np.concatenate([ids, new_ids], axis=1)
+    if distances.shape[1] > k:
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        distances = np.take_along_axis(distances, top, axis=1)
+        ids = np.take_along_axis(ids, top, axis=1)
+    order = np.argsort(distances, axis=1)
+    return np.take_along_axis(distances, order,
+                              axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+class PatchIndex(object):
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): Directory written by `PatchIndex.build`
+        """
+        self.path = path
+        with open(osp.join(path, INDEX_FILENAME)) as index_file:
+            self.metadata = json.load(index_file)
+        self.patch_shape = self.metadata['patch_shape']
+        self.embeddings = ShardedArray(self._shard_paths('embeds'))
+        self.squared_norms = ShardedArray(self._shard_paths('squared_norms'))
+        self.image_index = ShardedArray(self._shard_paths('image_index'))
+        self.ivf = None
+        if osp.exists(osp.join(path, 'ivf_coarse.npy')):
+            self.ivf = {
+                name: np.load(osp.join(path, 'ivf_{}.npy'.format(name)),
+                              mmap_mode='r') for name in IVF_FILENAMES
+            }
+
+    def _shard_paths(self, name):
+        return [
+            osp.join(self.path, '{}_{:05d}.npy'.format(name, i))
+            for i in range(len(self.metadata[name]))
+        ]
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @staticmethod
+    def build(model, batches, path, shard_size=2**18, debug=False):
+        """Writes the conv output of every patch of every image
+
+        Args:
+            model (ProtoPNet): Model whose conv output is indexed
+            batches (iterable of dict): Batches with 'image' and 'index', as served by `setup_tfds`
+            path (str): Directory to write the index to
+            shard_size (int): Number of patches per shard
+
+        Returns:
+            index (PatchIndex)
+        """
+        # written to a temporary directory so readers never see a partial index
+        tmp_path = '{}.tmp{}'.format(path, os.getpid())
+        os.makedirs(tmp_path)
+        embed_writer = ShardWriter(tmp_path, 'embeds', shard_size)
+        norm_writer = ShardWriter(tmp_path, 'squared_norms', shard_size)
+        index_writer = ShardWriter(tmp_path, 'image_index', shard_size)
+        patch_shape = None
+        if debug:
+            batches = tqdm(batches)
+        for batch in batches:
+            _, _, conv_output = model.prototype_activations(
+                normalize_image(batch['image']))
+            conv_output = conv_output.numpy()
+            patch_shape = list(conv_output.shape[1:3])
+            patches = np.reshape(conv_output, [-1, conv_output.shape[-1]])
+            embed_writer.append(patches)
+            norm_writer.append(np.sum(np.square(patches), axis=1))
+            index_writer.append(np.asarray(batch['index'], dtype=np.int64))
+        metadata = {
+            'embeds': embed_writer.close(),
+            'squared_norms': norm_writer.close(),
+            'image_index': index_writer.close(),
+            'patch_shape': patch_shape
+        }
+        with open(osp.join(tmp_path, INDEX_FILENAME), 'w') as index_file:
+            json.dump(metadata, index_file)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        return PatchIndex(path)
+
+    def locate(self, rows):
+        """Maps rows of the index to the patches they came from
+
+        Returns:
+            image_index, h, w (np.array): Each of the same shape as rows, image_index is the 'index' of the patch's image. All three are -1 where rows is -1
+        """
+        rows = np.asarray(rows)
+        missing = rows < 0
+        rows = np.where(missing, 0, rows)
+        patches_per_image = self.patch_shape[0] * self.patch_shape[1]
+        spatial = rows % patches_per_image
+        return (np.where(missing, -1,
+                         self.image_index[rows // patches_per_image]),
+                np.where(missing, -1, spatial // self.patch_shape[1]),
+                np.where(missing, -1, spatial % self.patch_shape[1]))
+
+    def search(self,
+               queries,
+               k=5,
+               block_size=2**15,
+               approximate=False,
+               num_probe=8,
+               rerank_factor=4):
+        """Finds the k nearest patches of each query
+
+        Args:
+            queries (np.array): shape [num_queries, C]
+            k (int): Number of neighbors to return
+            block_size (int): Optional, number of patches compared to the queries at once
+            approximate (bool): Optional, use the IVF-PQ index built by `build_ivf`
+            num_probe (int): Optional, number of inverted lists scanned per approximate query
+            rerank_factor (int): Optional, an approximate query re-ranks the rerank_factor * k nearest PQ candidates exactly
+
+        Returns:
+            distances (np.array): shape [num_queries, k] squared l2 distances, ascending
+            rows (np.array): shape [num_queries, k] rows of the index, see `locate`. When an approximate query finds fewer than k patches, missing rows are -1 with distance inf
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        if approximate:
+            if self.ivf is None:
+                raise ValueError('Approximate search needs build_ivf first')
+            return self._search_ivf(queries, k, num_probe, rerank_factor)
+        distances = np.full([queries.shape[0], 0], np.inf, dtype=np.float32)
+        rows = np.zeros([queries.shape[0], 0], dtype=np.int64)
+        for shard, norms, offset in zip(self.embeddings.shards,
+                                        self.squared_norms.shards,
+                                        self.embeddings.offsets):
+            for start in range(0, shard.shape[0], block_size):
+                block = shard[start:start + block_size]
+                block_distances = squared_distances(
+                    queries, block, norms[start:start + block_size])
+                block_k = min(k, block.shape[0])
+                top = np.argpartition(block_distances, block_k - 1,
+                                      axis=1)[:, :block_k]
+                distances, rows = merge_top_k(
+                    distances, rows,
+                    np.take_along_axis(block_distances, top, axis=1),
+                    top + offset + start, k)
+        return distances, rows
+
+    def build_ivf(self,
+                  num_lists=256,
+                  num_subspaces=8,
+                  num_codes=256,
+                  train_size=2**16,
+                  seed=0):
+        """Builds an inverted file over product quantized residuals
+
+        Each patch is assigned to its nearest of num_lists coarse
+        centroids, and its residual from that centroid is encoded as
+        num_subspaces bytes, one per slice of its dimensions.
+
+        Args:
+            num_lists (int): Number of coarse centroids
+            num_subspaces (int): Number of slices of each residual, must divide C
+            num_codes (int): Centroids per slice, at most 256
+            train_size (int): Number of patches sampled to fit the centroids
+        """
+        dim = self.embeddings.shape[1]
+        if dim % num_subspaces != 0:
+            raise ValueError(
+                'num_subspaces {} must divide the dimension {}'.format(
+                    num_subspaces, dim))
+        rng = np.random.RandomState(seed)
+        sample = self.embeddings[np.sort(
+            rng.choice(len(self), min(train_size, len(self)),
+                       replace=False))].astype(np.float32)
+        coarse = kmeans(sample, min(num_lists, sample.shape[0]), seed=seed)
+        residuals = sample - coarse[nearest_centroid(sample, coarse)]
+        sub_dim = dim // num_subspaces
+        codebooks = np.stack([
+            kmeans(residuals[:, j * sub_dim:(j + 1) * sub_dim],
+                   min(num_codes, sample.shape[0]),
+                   seed=seed) for j in range(num_subspaces)
+        ])
+
+        assignment = np.zeros([len(self)], dtype=np.int64)
+        codes = np.lib.format.open_memmap(osp.join(self.path,
+                                                   'ivf_codes.tmp.npy'),
+                                          mode='w+',
+                                          dtype=np.uint8,
+                                          shape=(len(self), num_subspaces))
+        for shard, offset in zip(self.embeddings.shards,
+                                 self.embeddings.offsets):
+            block = np.asarray(shard, dtype=np.float32)
+            block_assignment = nearest_centroid(block, coarse)
+            residual = block - coarse[block_assignment]
+            assignment[offset:offset + block.shape[0]] = block_assignment
+            for j in range(num_subspaces):
+                codes[offset:offset + block.shape[0], j] = nearest_centroid(
+                    residual[:, j * sub_dim:(j + 1) * sub_dim], codebooks[j])
+
+        # rows are grouped by list so each list is a contiguous slice
+        ids = np.argsort(assignment, kind='stable')
+        offsets = np.concatenate([[0],
+                                  np.cumsum(
+                                      np.bincount(assignment,
+                                                  minlength=coarse.shape[0]))])
+        np.save(osp.join(self.path, 'ivf_codes.npy'), codes[ids])
+        del codes
+        os.remove(osp.join(self.path, 'ivf_codes.tmp.npy'))
+        for name, value in [('coarse', coarse), ('codebooks', codebooks),
+                            ('ids', ids), ('offsets', offsets)]:
+            np.save(osp.join(self.path, 'ivf_{}.npy'.format(name)), value)
+        self.ivf = {
+            name: np.load(osp.join(self.path, 'ivf_{}.npy'.format(name)),
+                          mmap_mode='r') for name in IVF_FILENAMES
+        }
+
+    def _search_ivf(self, queries, k, num_probe, rerank_factor):
+        """Scans the nearest lists with PQ distances, then re-ranks exactly"""
+        coarse = self.ivf['coarse']
+        codebooks = self.ivf['codebooks']
+        num_subspaces, _, sub_dim = codebooks.shape
+        num_probe = min(num_probe, coarse.shape[0])
+        probes = np.argsort(squared_distances(queries, coarse),
+                            axis=1)[:, :num_probe]
+
+        distances = np.full([queries.shape[0], k], np.inf, dtype=np.float32)
+        rows = np.full([queries.shape[0], k], -1, dtype=np.int64)
+        for q, query in enumerate(queries):
+            candidates = []
+            approximate_distances = []
+            for l in probes[q]:
+                start, end = self.ivf['offsets'][l], self.ivf['offsets'][l + 1]
+                if start == end:
+                    continue
+                residual = np.reshape(query - coarse[l],
+                                      [num_subspaces, 1, sub_dim])
+                # [num_subspaces, num_codes] distances of each slice to each code
+                table = np.sum(np.square(residual - codebooks), axis=-1)
+                codes = self.ivf['codes'][start:end]
+                approximate_distances.append(
+                    np.sum(table[np.arange(num_subspaces), codes], axis=1))
+                candidates.append(self.ivf['ids'][start:end])
+            if not candidates:
+                continue
+            candidates = np.concatenate(candidates)
+            approximate_distances = np.concatenate(approximate_distances)
+            num_rerank = min(k * rerank_factor, candidates.shape[0])
+            shortlist = np.sort(candidates[np.argpartition(
+                approximate_distances, num_rerank - 1)[:num_rerank]])
+            exact = squared_distances(query[None], self.embeddings[shortlist],
+                                      self.squared_norms[shortlist])[0]
+            order = np.argsort(exact)[:k]
+            distances[q, :order.shape[0]] = exact[order]
+            rows[q, :order.shape[0]] = shortlist[order]
+        return distances, rows
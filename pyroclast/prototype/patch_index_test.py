@@ -0,0 +1,85 @@
+import os.path as osp
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+
+from pyroclast.common.models import get_network_builder
+from pyroclast.common.tf_util import normalize_image
+from pyroclast.prototype.model import ProtoPNet
+from pyroclast.prototype.patch_index import PatchIndex
+
+
+class PatchIndexTest(parameterized.TestCase):
+
+    def setUp(self):
+        tf.random.set_seed(0)
+        self.tmp_dir = tempfile.mkdtemp()
+        conv_stack = get_network_builder('mnist_conv')()
+        self.model = ProtoPNet(conv_stack, 10, 16, 10)
+        # served out of order, as a shuffled split would be
+        self.order = np.random.RandomState(0).permutation(24)
+        self.batches = [{
+            'image':
+                tf.cast(tf.random.uniform([8, 28, 28, 1], maxval=256, seed=i),
+                        tf.uint8),
+            'index':
+                self.order[i * 8:(i + 1) * 8]
+        } for i in range(3)]
+        # small shards and blocks so search merges across both
+        self.index = PatchIndex.build(self.model,
+                                      self.batches,
+                                      osp.join(self.tmp_dir, 'index'),
+                                      shard_size=100)
+        images = tf.concat([b['image'] for b in self.batches], 0)
+        _, _, conv_output = self.model.prototype_activations(
+            normalize_image(images))
+        self.conv_output = conv_output.numpy()
+        # rows of conv_output are in batch order
+        self.position = np.argsort(self.order)
+
+    def test_search(self):
+        queries = self.model.prototypes.numpy()
+        distances, rows = self.index.search(queries, k=3, block_size=30)
+        patches = np.reshape(self.conv_output, [-1, queries.shape[-1]])
+        expected = np.sum(np.square(queries[:, None] - patches), axis=-1)
+        np.testing.assert_allclose(distances,
+                                   np.sort(expected, axis=1)[:, :3],
+                                   rtol=1e-4,
+                                   atol=1e-4)
+        image_index, h, w = self.index.locate(rows)
+        np.testing.assert_array_equal(self.order[rows // 49], image_index)
+        np.testing.assert_allclose(
+            self.conv_output[self.position[image_index], h, w], patches[rows])
+
+    def test_approximate_search(self):
+        self.index.build_ivf(num_lists=8, num_subspaces=4, num_codes=16)
+        patches = np.reshape(self.conv_output, [-1, 16])
+        queries = patches[:20]
+        # probing every list only leaves the PQ shortlist approximate
+        distances, rows = self.index.search(queries,
+                                            k=1,
+                                            approximate=True,
+                                            num_probe=8)
+        # near duplicate patches may be found instead of the query's own
+        np.testing.assert_allclose(distances[:, 0], 0., atol=1e-3)
+        np.testing.assert_allclose(patches[rows[:, 0]], queries, atol=1e-2)
+        assert np.mean(rows[:, 0] == np.arange(20)) >= 0.8
+
+    def test_approximate_search_missing_rows(self):
+        self.index.build_ivf(num_lists=8, num_subspaces=4, num_codes=16)
+        queries = self.model.prototypes.numpy()
+        # a single list can't hold every patch
+        distances, rows = self.index.search(queries,
+                                            k=len(self.index),
+                                            approximate=True,
+                                            num_probe=1,
+                                            rerank_factor=1)
+        missing = rows == -1
+        assert np.all(np.any(missing, axis=1))
+        assert np.all(np.isinf(distances[missing]))
+        assert np.all(np.isfinite(distances[~missing]))
+        for located in self.index.locate(rows):
+            np.testing.assert_array_equal(located[missing], -1)
+            assert np.all(located[~missing] >= 0)
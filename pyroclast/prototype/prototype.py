@@ -1,3 +1,5 @@
+import collections
+import copy
 import os
 
 import numpy as np
@@ -5,10 +7,233 @@ import tensorflow as tf
 from tqdm import tqdm
 
 from pyroclast.common.early_stopping import EarlyStopping
+from pyroclast.common.embedding_cache import (EmbeddingCache, cache_key,
+                                              module_fingerprint)
 from pyroclast.common.models import get_network_builder
+from pyroclast.common.preprocessed_dataset import PreprocessedDataset
+from pyroclast.common.tf_util import InputWaitTimer, normalize_image
 from pyroclast.common.util import dummy_context_mgr
+from pyroclast.prototype.explain import explain_dataset
 from pyroclast.prototype.model import ProtoPNet
-from pyroclast.prototype.tf_util import l2_convolution
+
+PHASE_3_SOLVERS = ['sgd', 'lbfgs']
+
+
+def cache_prototype_activations(data_dict, model, conv_stack_name, cache_dir,
+                                max_bytes, seed):
+    """Replaces the train and test sets with cached prototype activations
+
+    Only the last layer is trained in phase 3, so the activations are
+    fixed. Cache entries are keyed on the weights of every module below
+    the last layer, so activations of other prototypes are never reused.
+
+    Args:
+        data_dict (dict): As returned by `setup_tfds`
+        model (ProtoPNet): Model whose prototype activations are cached
+        conv_stack_name (str): Name of the conv stack network
+        cache_dir (str): Directory of the embedding cache
+        max_bytes (int): Size bound of the embedding cache
+        seed (int): Seed of the shuffle order
+
+    Returns:
+        A copy of data_dict where train and test are batches of prototype activations
+    """
+    for x in data_dict['train']:
+        batch_size = x['label'].shape[0]
+        # build the model so its weights can be fingerprinted
+        model.features(normalize_image(x['image']))
+        break
+    cache = EmbeddingCache(cache_dir, max_bytes)
+    fingerprint = module_fingerprint(
+        list(model.conv_stack.variables) + list(model.final_conv.variables) +
+        [model.prototypes])
+    config = {
+        'conv_stack_name': conv_stack_name,
+        'shape': [int(d) for d in data_dict['shape']],
+        'data_limit': data_dict.get('data_limit', -1),
+        'embedding': 'prototype_activations'
+    }
+
+    cached_data_dict = copy.copy(data_dict)
+    keys = []
+    for split in ['train', 'test']:
+        key = cache_key(fingerprint, data_dict['name'], split, config)
+        cached_data_dict[split] = PreprocessedDataset(data_dict[split],
+                                                      model.features,
+                                                      cache.path(key))(
+                                                          batch_size,
+                                                          shuffle_seed=seed)
+        cache.touch(key)
+        keys.append(key)
+    cache.evict(keep=keys)
+    return cached_data_dict
+
+
+LbfgsResults = collections.namedtuple(
+    'LbfgsResults',
+    ['position', 'converged', 'num_iterations', 'objective_value'])
+
+
+def _pseudo_gradient(w, g, l1_coeff):
+    """Steepest descent direction of f(w) + l1_coeff * ||w||_1, negated
+
+    Where w is zero the l1 norm isn't differentiable, and the one sided
+    derivative pointing downhill is used, or zero if neither is.
+    """
+    right = g + l1_coeff
+    left = g - l1_coeff
+    at_zero = np.where(right < 0., right, np.where(left > 0., left, 0.))
+    return np.where(w > 0., right, np.where(w < 0., left, at_zero))
+
+
+def _inverse_hessian_product(v, s_list, y_list):
+    """L-BFGS two loop recursion"""
+    q = np.copy(v)
+    alphas = []
+    for s, y in zip(reversed(s_list), reversed(y_list)):
+        alpha = s.dot(q) / y.dot(s)
+        q -= alpha * y
+        alphas.append(alpha)
+    if s_list:
+        q *= s_list[-1].dot(y_list[-1]) / y_list[-1].dot(y_list[-1])
+    for s, y, alpha in zip(s_list, y_list, reversed(alphas)):
+        beta = y.dot(q) / y.dot(s)
+        q += (alpha - beta) * s
+    return q
+
+
+def fit_classifier_lbfgs(model,
+                         ds,
+                         l1_coeff,
+                         max_iterations=500,
+                         num_correction_pairs=10,
+                         tolerance=1e-10):
+    """Fits the last layer to cached prototype activations with OWL-QN
+
+    Minimizes the mean cross entropy plus l1_coeff times the l1 norm of
+    the weights over the whole set at once, which is convex in the
+    weights. The l1 norm isn't smooth, so plain L-BFGS would only shrink
+    weights towards zero. Orthant-wise L-BFGS (Andrew and Gao, "Scalable
+    Training of L1-Regularized Log-Linear Models") steps along the
+    pseudo-gradient and never lets a weight cross zero in a step, so
+    weights which should be zero are exactly zero.
+
+    The whole training set of activations is held in memory, as float64,
+    i.e. 8 * num_data * num_prototypes bytes.
+
+    Args:
+        model (ProtoPNet): Model whose classifier is fit
+        ds (tf.data.Dataset): Batches of prototype activations in 'image' and labels in 'label'
+        l1_coeff (float): Weight of the l1 penalty
+        max_iterations (int): Optional, maximum number of iterations
+        num_correction_pairs (int): Optional, number of past steps which approximate the inverse Hessian
+        tolerance (float): Optional, stops when the pseudo-gradient's largest entry or the relative decrease of the objective is smaller
+
+    Returns:
+        results (LbfgsResults): Final kernel, flattened, whether it converged, number of iterations, and objective value
+    """
+    activations, labels = zip(*[(b['image'], b['label']) for b in ds])
+    activations = tf.cast(tf.concat(activations, 0), tf.float64)
+    labels = tf.cast(tf.concat(labels, 0), tf.int32)
+    kernel = model.classifier.kernel
+
+    @tf.function
+    def smooth_loss_and_gradient(flat_kernel):
+        with tf.GradientTape() as tape:
+            tape.watch(flat_kernel)
+            w = tf.reshape(flat_kernel, kernel.shape)
+            loss = tf.reduce_mean(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels,
+                                                               logits=tf.matmul(
+                                                                   activations,
+                                                                   w)))
+        return loss, tape.gradient(loss, flat_kernel)
+
+    def objective(w):
+        loss, g = smooth_loss_and_gradient(tf.constant(w))
+        return float(loss) + l1_coeff * np.sum(np.abs(w)), g.numpy()
+
+    w = np.reshape(kernel.numpy(), [-1]).astype(np.float64)
+    f, g = objective(w)
+    s_list, y_list = [], []
+    converged = False
+    num_iterations = 0
+    while num_iterations < max_iterations and not converged:
+        num_iterations += 1
+        pg = _pseudo_gradient(w, g, l1_coeff)
+        if np.max(np.abs(pg)) < tolerance:
+            converged = True
+            break
+        direction = -_inverse_hessian_product(pg, s_list, y_list)
+        # only keep coordinates which descend
+        direction = np.where(direction * pg < 0., direction, 0.)
+        orthant = np.where(w != 0., np.sign(w), -np.sign(pg))
+        step_size = 1. if s_list else 1. / np.linalg.norm(pg)
+        # backtracking line search, projected onto the orthant
+        while True:
+            w_new = w + step_size * direction
+            w_new = np.where(np.sign(w_new) == orthant, w_new, 0.)
+            f_new, g_new = objective(w_new)
+            if f_new <= f + 1e-4 * pg.dot(w_new - w) or step_size < 1e-10:
+                break
+            step_size /= 2.
+        converged = f - f_new <= tolerance * max(abs(f), 1.)
+        s, y = w_new - w, g_new - g
+        if s.dot(y) > 1e-12:
+            s_list = (s_list + [s])[-num_correction_pairs:]
+            y_list = (y_list + [y])[-num_correction_pairs:]
+        w, f, g = w_new, f_new, g_new
+
+    kernel.assign(np.reshape(w, kernel.shape))
+    return LbfgsResults(w, converged, num_iterations, f)
+
+
+class Evaluator(object):
+    """Mean loss and classification rate of batches, accumulated on device
+
+    Every batch runs one compiled step which adds to device variables, so
+    the host only syncs once per pass. No summaries are written and
+    global_step isn't advanced, so evaluating any split is side effect
+    free.
+    """
+
+    def __init__(self, compute_loss):
+        """
+        Args:
+            compute_loss (callable): Maps (x, labels, phase) to logits, loss of shape [batch_size], and a dict of loss terms
+        """
+        self.compute_loss = compute_loss
+        self.loss = tf.Variable(0., dtype=tf.float64)
+        self.correct = tf.Variable(0, dtype=tf.int64)
+        self.count = tf.Variable(0, dtype=tf.int64)
+        self.eval_step = tf.function(self._eval_step, reduce_retracing=True)
+
+    def _eval_step(self, batch, phase):
+        x = normalize_image(batch['image'])
+        labels = tf.cast(batch['label'], tf.int32)
+        y_hat, loss, _ = self.compute_loss(x, labels, phase)
+        prediction = tf.math.argmax(y_hat, axis=1, output_type=tf.int32)
+        self.loss.assign_add(tf.cast(tf.reduce_sum(loss), tf.float64))
+        self.correct.assign_add(
+            tf.reduce_sum(tf.cast(tf.equal(prediction, labels), tf.int64)))
+        self.count.assign_add(tf.cast(tf.shape(x)[0], tf.int64))
+
+    def __call__(self, batches, phase):
+        """
+        Args:
+            batches (iterable of dict): Batches from a dataset, or of cached prototype activations in phase 3
+            phase (int): Value in {1,3} which determines the objective
+
+        Returns:
+            mean loss and classification rate over the batches
+        """
+        for v in [self.loss, self.correct, self.count]:
+            v.assign(tf.zeros_like(v))
+        for batch in batches:
+            self.eval_step(batch, phase)
+        count = float(self.count.numpy())
+        return float(self.loss.numpy()) / count, float(
+            self.correct.numpy()) / count
 
 
 def learn(data_dict,
@@ -28,7 +253,21 @@ def learn(data_dict,
           num_prototypes=20,
           prototype_dim=128,
           is_class_specific=False,
-          delay_conv_stack_training=False):
+          delay_conv_stack_training=False,
+          phase_3_solver='sgd',
+          preprocessed_dir='.preprocessed_data',
+          preprocessed_max_bytes=20 * 2**30,
+          num_explained_prototypes=0):
+    """
+    Args:
+        phase_3_solver (str): 'sgd' trains the last layer for up to max_epochs_phase_3 epochs, 'lbfgs' fits it to the whole training set at once
+        preprocessed_dir (str): Directory of the cache of prototype activations used in phase 3
+        preprocessed_max_bytes (int): Size bound of the cache
+        num_explained_prototypes (int): If positive, the final model's top prototypes of every test image are rendered to output_dir/explanations
+    """
+    if phase_3_solver not in PHASE_3_SOLVERS:
+        raise ValueError('Unknown phase_3_solver {}, options are {}'.format(
+            phase_3_solver, PHASE_3_SOLVERS))
     writer = tf.summary.create_file_writer(output_dir)
     global_step = tf.compat.v1.train.get_or_create_global_step()
     optimizer = tf.keras.optimizers.Adam(learning_rate=learning_rate,
@@ -36,6 +275,7 @@ def learn(data_dict,
                                          epsilon=0.01)
 
     # Using VGG19 here necessitates a 3 channel image input
+    conv_stack_name = conv_stack
     conv_stack = get_network_builder(conv_stack)()
     model = ProtoPNet(conv_stack,
                       num_prototypes,
@@ -58,6 +298,36 @@ def learn(data_dict,
                                                           'phase3_model'),
                                                       max_to_keep=3)
 
+    def compute_loss(x, labels, phase):
+        """
+        Returns:
+            logits, loss of shape [batch_size], and the dict of loss terms
+        """
+        if phase == 3:
+            # phase 3 batches hold cached prototype activations
+            y_hat = model.classify_features(x)
+            loss_term_dict = {
+                'l1': tf.norm(model.classifier.trainable_weights[0], 1)
+            }
+        else:
+            y_hat, minimum_distances, _ = model(x)
+            loss_term_dict = model.conv_prototype_objective(minimum_distances,
+                                                            label=labels)
+        loss_term_dict[
+            'classification'] = tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=labels, logits=y_hat)
+
+        # build loss
+        assert phase in [1, 3]
+        loss = loss_term_dict['classification']
+        if 'cluster' in loss_term_dict and phase == 1:
+            loss += cluster_coeff * loss_term_dict['cluster']
+        if 'l1' in loss_term_dict:
+            loss += l1_coeff * loss_term_dict['l1']
+        if 'separation' in loss_term_dict and phase == 1:
+            loss += separation_coeff * loss_term_dict['separation']
+        return y_hat, loss, loss_term_dict
+
     # define minibatch fn
     def run_minibatch(epoch, batch, phase, is_train=True):
         """
@@ -67,27 +337,12 @@ def learn(data_dict,
             phase (int): Value in {1,3} which determines what objective and variables are used in training updates.
             is_train (bool): Optional, run backwards pass if True
         """
-        x = tf.cast(batch['image'], tf.float32) / 255.
+        x = normalize_image(batch['image'])
         labels = tf.cast(batch['label'], tf.int32)
 
         with tf.GradientTape() if is_train else dummy_context_mgr() as tape:
             global_step.assign_add(1)
-            y_hat, minimum_distances, _ = model(x)
-            classification_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(
-                labels=labels, logits=y_hat)
-            loss_term_dict = model.conv_prototype_objective(minimum_distances,
-                                                            label=labels)
-
-            # build loss
-            assert phase in [1, 3]
-            loss = classification_loss
-            if 'cluster' in loss_term_dict and phase == 1:
-                loss += cluster_coeff * loss_term_dict['cluster']
-            if 'l1' in loss_term_dict:
-                loss += l1_coeff * loss_term_dict['l1']
-            if 'separation' in loss_term_dict and phase == 1:
-                loss += separation_coeff * loss_term_dict['separation']
-
+            y_hat, loss, loss_term_dict = compute_loss(x, labels, phase)
             mean_loss = tf.reduce_mean(loss)
 
         # calculate gradients for current loss
@@ -121,7 +376,7 @@ def learn(data_dict,
                               classification_rate,
                               step=global_step)
             tf.summary.scalar(prefix + "loss/mean classification",
-                              tf.reduce_mean(classification_loss),
+                              tf.reduce_mean(loss_term_dict['classification']),
                               step=global_step)
             if 'cluster' in loss_term_dict:
                 tf.summary.scalar(prefix + "loss/mean cluster",
@@ -144,9 +399,14 @@ def learn(data_dict,
         loss_numerator = tf.reduce_sum(loss)
         accuracy_numerator = tf.reduce_sum(
             tf.cast(tf.equal(prediction, labels), tf.int32))
-        denominator = x.shape[0]
+        denominator = tf.shape(x)[0]
         return loss_numerator, accuracy_numerator, denominator
 
+    evaluate = Evaluator(compute_loss)
+
+    def classification_rate(ds):
+        return evaluate(ds, phase=1)[1]
+
     ### PHASE 1
     # run training loop
     print("PHASE 1 - TRAINING CONV STACK AND PROTOTYPES")
@@ -155,9 +415,10 @@ def learn(data_dict,
                                    eps=0.03)
     for epoch in range(max_epochs_phase_1):
         # train
-        train_batches = data_dict['train']
+        train_timer = InputWaitTimer(data_dict['train'])
+        train_batches = train_timer
         if debug:
-            train_batches = tqdm(train_batches, total=data_dict['train_bpe'])
+            train_batches = tqdm(train_timer, total=data_dict['train_bpe'])
         print("Epoch", epoch)
         print("TRAIN")
         loss_numerator = 0
@@ -170,25 +431,28 @@ def learn(data_dict,
             denominator += d
         print("Train Accuracy:", float(acc_numerator) / float(denominator))
         print("Train Loss:", float(loss_numerator) / float(denominator))
+        print("Train Input Wait:", train_timer)
 
         # test
-        test_batches = data_dict['test']
+        test_timer = InputWaitTimer(data_dict['test'])
+        test_batches = test_timer
         if debug:
-            test_batches = tqdm(test_batches, total=data_dict['test_bpe'])
+            test_batches = tqdm(test_timer, total=data_dict['test_bpe'])
         print("TEST")
-        loss_numerator = 0
-        acc_numerator = 0
-        denominator = 0
-        for batch in test_batches:
-            l, a, d = run_minibatch(epoch, batch, phase=1, is_train=False)
-            acc_numerator += a
-            loss_numerator += l
-            denominator += d
-        print("Test Accuracy:", float(acc_numerator) / float(denominator))
-        print("Test Loss:", float(loss_numerator) / float(denominator))
+        test_loss, test_accuracy = evaluate(test_batches, phase=1)
+        print("Test Accuracy:", test_accuracy)
+        print("Test Loss:", test_loss)
+        with writer.as_default():
+            tf.summary.scalar("validate_classification_rate",
+                              test_accuracy,
+                              step=global_step)
+            tf.summary.scalar("validate_loss/mean final loss",
+                              test_loss,
+                              step=global_step)
+        print("Test Input Wait:", test_timer)
 
         # checkpointing and early stopping
-        if early_stopping(epoch, float(loss_numerator) / float(denominator)):
+        if early_stopping(epoch, test_loss):
             break
 
     # restore best parameters
@@ -197,62 +461,42 @@ def learn(data_dict,
     ### PHASE 2
     print("PHASE 2 - PUSHING PROTOTYPES")
 
-    def classification_rate(ds):
-        numerator = 0.
-        denominator = 0.
-        for batch in ds:
-            x = tf.cast(batch['image'], tf.float32) / 255.
-            labels = tf.cast(batch['label'], tf.int64)
-            y_hat, _, _ = model(x)
-            numerator += tf.reduce_sum(
-                tf.cast(tf.equal(labels, tf.argmax(y_hat, axis=1)), tf.float32))
-            denominator += labels.shape[0]
-        return numerator / denominator
-
-    def calculate_patches(image):
-        x = tf.cast(image, tf.float32) / 255.
-        _, _, patches = model(x)
-        return patches
-
     print("Classification rate before prototype push: ",
           classification_rate(data_dict['train']))
-    # calculate intput to prototype layer from each datum
-    patches = list(data_dict['train'].map(lambda x: (calculate_patches(x[
-        'image']), x['label'])).apply(lambda ds: ds.unbatch()))
-
-    # group the data into classes
-    class_patches = [[] for i in range(data_dict['num_classes'])]
-    for img, label in patches:
-        class_patches[label.numpy()].append(img)
-    class_patches = [np.stack(cp) for cp in class_patches]
-
-    # set new prototype values
-    new_prototypes = model.prototypes.numpy()
-    for i, proto in enumerate(model.prototypes.numpy()):
-        # get the associated class of the prototype
-        label = np.argmax(model.prototype_class_identity[i])
-        # calculate distance between prototype and all patches of the associated class
-        distances = np.reshape(
-            l2_convolution(class_patches[label], np.expand_dims(proto, 0)),
-            [-1])
-        # set new value
-        new_prototypes[i] = np.reshape(class_patches[label],
-                                       [-1])[np.argmin(distances)]
-    model.prototypes = new_prototypes
+    push_batches = data_dict['train']
+    if debug:
+        push_batches = tqdm(push_batches, total=data_dict['train_bpe'])
+    provenance = model.push_prototypes(push_batches)
+    # image indices are positions in the unshuffled train split
+    np.savez(os.path.join(output_dir, 'push_provenance.npz'), **provenance)
     print("Classification rate after prototype push: ",
           classification_rate(data_dict['train']))
 
     ### PHASE 3
     print("PHASE 3 - TRAINING CLASSIFIER")
+    # only the last layer is trained, so prototype activations are computed once
+    phase_3_data = cache_prototype_activations(data_dict, model,
+                                               conv_stack_name,
+                                               preprocessed_dir,
+                                               preprocessed_max_bytes, seed)
+    if phase_3_solver == 'lbfgs':
+        results = fit_classifier_lbfgs(model, phase_3_data['train'], l1_coeff)
+        print("L-BFGS converged:", bool(results.converged), "after",
+              int(results.num_iterations), "iterations with loss",
+              float(results.objective_value))
+        ckpt_manager_phase_3.save()
+        # the last layer is already fit, so the training loop is skipped
+        max_epochs_phase_3 = 0
     early_stopping = EarlyStopping(patience_phase_3,
                                    ckpt_manager_phase_3,
                                    eps=0.03)
     # run training loop
     for epoch in range(max_epochs_phase_3):
         # train
-        train_batches = data_dict['train']
+        train_timer = InputWaitTimer(phase_3_data['train'])
+        train_batches = train_timer
         if debug:
-            train_batches = tqdm(train_batches, total=data_dict['train_bpe'])
+            train_batches = tqdm(train_timer, total=phase_3_data['train_bpe'])
         print("Epoch", epoch)
         print("TRAIN")
         loss_numerator = 0
@@ -265,28 +509,39 @@ def learn(data_dict,
             denominator += d
         print("Train Accuracy:", float(acc_numerator) / float(denominator))
         print("Train Loss:", float(loss_numerator) / float(denominator))
+        print("Train Input Wait:", train_timer)
 
         # test
-        test_batches = data_dict['test']
+        test_timer = InputWaitTimer(phase_3_data['test'])
+        test_batches = test_timer
         if debug:
-            test_batches = tqdm(test_batches, total=data_dict['test_bpe'])
+            test_batches = tqdm(test_timer, total=phase_3_data['test_bpe'])
         print("TEST")
-        loss_numerator = 0
-        acc_numerator = 0
-        denominator = 0
-        for batch in test_batches:
-            l, a, d = run_minibatch(epoch, batch, phase=3, is_train=False)
-            acc_numerator += a
-            loss_numerator += l
-            denominator += d
-        print("Test Accuracy:", float(acc_numerator) / float(denominator))
-        print("Test Loss:", float(loss_numerator) / float(denominator))
+        test_loss, test_accuracy = evaluate(test_batches, phase=3)
+        print("Test Accuracy:", test_accuracy)
+        print("Test Loss:", test_loss)
+        with writer.as_default():
+            tf.summary.scalar("validate_classification_rate",
+                              test_accuracy,
+                              step=global_step)
+            tf.summary.scalar("validate_loss/mean final loss",
+                              test_loss,
+                              step=global_step)
+        print("Test Input Wait:", test_timer)
 
         # checkpointing and early stopping
-        if early_stopping(epoch, float(loss_numerator) / float(denominator)):
+        if early_stopping(epoch, test_loss):
             break
 
     # restore final parameters and print performance
     checkpoint.restore(ckpt_manager_phase_3.latest_checkpoint).assert_consumed()
     print("Final Train Accuracy:", classification_rate(data_dict['train']))
     print("Final Test Accuracy:", classification_rate(data_dict['test']))
+
+    if num_explained_prototypes > 0:
+        print("EXPLAINING TEST SET")
+        explain_dataset(model,
+                        data_dict['test'],
+                        os.path.join(output_dir, 'explanations'),
+                        k=num_explained_prototypes,
+                        debug=debug)
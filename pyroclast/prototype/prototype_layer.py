@@ -1,6 +1,7 @@
 import tensorflow as tf
 
-from pyroclast.prototype.tf_util import l2_convolution
+from pyroclast.prototype.tf_util import (distance_similarity, l2_distance,
+                                         min_l2_distance)
 
 
 class PrototypeLayer(tf.Module):
@@ -21,7 +22,19 @@ class PrototypeLayer(tf.Module):
             epsilon (float): Optional, some sufficiently small value
         """
 
-        distances = l2_convolution(z, prototypes)
-        similarities = tf.math.log((distances + 1) / (distances + epsilon))
+        distances = l2_distance(z, prototypes)
+        similarities = distance_similarity(distances, epsilon)
 
         return distances, similarities
+
+    def min_distances(self, z, prototypes, epsilon=1e-4):
+        """
+        Args:
+            z (tf.Tensor): shape [N_1,7,7,C]
+            prototypes (tf.Tensor): shape [N_2,C]
+            epsilon (float): Optional, some sufficiently small value
+
+        Returns:
+            minimum distances and maximum similarities over the patches of each image, both of shape [N_1,N_2]
+        """
+        return min_l2_distance(z, prototypes, epsilon)
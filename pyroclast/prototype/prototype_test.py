@@ -0,0 +1,172 @@
+import os
+import tempfile
+import types
+from unittest import mock
+
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+
+from pyroclast.common import tf_util
+from pyroclast.common.models import get_network_builder
+from pyroclast.common.tf_util import normalize_image, setup_tfds
+from pyroclast.common.tf_util_test import fake_tfds_load
+from pyroclast.prototype.model import ProtoPNet
+from pyroclast.prototype.prototype import (Evaluator,
+                                           cache_prototype_activations,
+                                           fit_classifier_lbfgs)
+
+
+def softmax_cross_entropy_gradient(x, labels, w):
+    logits = x.dot(w)
+    p = np.exp(logits - logits.max(axis=1, keepdims=True))
+    p /= p.sum(axis=1, keepdims=True)
+    p[np.arange(len(labels)), labels] -= 1.
+    return x.T.dot(p) / len(labels)
+
+
+def proximal_gradient_reference(x, labels, w, l1_coeff, num_steps=20000):
+    """Minimizes the same objective with many small proximal steps"""
+    step_size = len(labels) / np.linalg.norm(x, 2)**2
+    for _ in range(num_steps):
+        w = w - step_size * softmax_cross_entropy_gradient(x, labels, w)
+        w = np.sign(w) * np.maximum(np.abs(w) - step_size * l1_coeff, 0.)
+    return w
+
+
+class FitClassifierLbfgsTest(parameterized.TestCase):
+
+    @parameterized.parameters(0.01, 0.05)
+    def test_matches_reference(self, l1_coeff):
+        rng = np.random.RandomState(0)
+        x = rng.uniform(size=[200, 10])
+        # noisy labels of a sparse linear model, so the fit is bounded
+        true_w = np.zeros([10, 3])
+        true_w[:3] = rng.normal(size=[3, 3]) * 4.
+        labels = np.argmax(x.dot(true_w) + rng.gumbel(size=[200, 3]), axis=1)
+        ds = tf.data.Dataset.from_tensor_slices({
+            'image': x.astype(np.float32),
+            'label': labels
+        }).batch(32)
+        classifier = tf.keras.layers.Dense(3, use_bias=False)
+        classifier.build([None, 10])
+        model = types.SimpleNamespace(classifier=classifier)
+        initial_w = classifier.kernel.numpy().astype(np.float64)
+
+        results = fit_classifier_lbfgs(model, ds, l1_coeff)
+        expected = proximal_gradient_reference(
+            x.astype(np.float32).astype(np.float64), labels, initial_w,
+            l1_coeff)
+        assert results.converged
+        np.testing.assert_allclose(classifier.kernel, expected, atol=1e-3)
+        # the l1 penalty gives exact zeros
+        assert np.mean(expected == 0.) > 0.2
+        np.testing.assert_array_equal(classifier.kernel.numpy() == 0.,
+                                      expected == 0.)
+
+
+class CachePrototypeActivationsTest(parameterized.TestCase):
+
+    def test_cached_activations(self):
+        with mock.patch.object(tf_util.tfds, 'load',
+                               fake_tfds_load(10, shape=(28, 28, 1))):
+            data_dict = setup_tfds('fake', 4, shuffle_seed=0)
+        model = ProtoPNet(
+            get_network_builder('mnist_conv')(), 6, 8, data_dict['num_classes'])
+        cache_dir = tempfile.mkdtemp()
+        cached = cache_prototype_activations(data_dict, model, 'mnist_conv',
+                                             cache_dir, 2**30, 0)
+
+        for split in ['train', 'test']:
+            # the splits are shuffled, so rows are matched by activation
+            batches = list(data_dict[split])
+            expected = np.concatenate(
+                [model.features(normalize_image(b['image'])) for b in batches])
+            expected_labels = np.concatenate([b['label'] for b in batches])
+            batches = list(cached[split])
+            assert [b['image'].shape for b in batches] == [(4, 6), (4, 6),
+                                                           (2, 6)]
+            activations = np.concatenate([b['image'] for b in batches])
+            labels = np.concatenate([b['label'] for b in batches])
+            distances = np.abs(activations[:, None] -
+                               expected[None]).sum(axis=-1)
+            rows = np.argmin(distances, axis=1)
+            np.testing.assert_array_equal(np.sort(rows), np.arange(10))
+            np.testing.assert_allclose(activations, expected[rows], atol=1e-5)
+            np.testing.assert_array_equal(labels, expected_labels[rows])
+
+        # new prototypes need new activations
+        entries = set(os.listdir(cache_dir))
+        model.prototypes.assign(model.prototypes + 1.)
+        cache_prototype_activations(data_dict, model, 'mnist_conv', cache_dir,
+                                    0, 0)
+        # and the old ones are evicted to make room
+        new_entries = set(os.listdir(cache_dir))
+        assert len(new_entries) == len(entries)
+        assert not new_entries & entries
+
+
+class EvaluatorTest(parameterized.TestCase):
+
+    def setUp(self):
+        with mock.patch.object(tf_util.tfds, 'load',
+                               fake_tfds_load(10, shape=(28, 28, 1))):
+            # the last batch has 2 data
+            self.data_dict = setup_tfds('fake', 4, shuffle_seed=0)
+        self.model = ProtoPNet(
+            get_network_builder('mnist_conv')(), 6, 8,
+            self.data_dict['num_classes'])
+
+    def compute_loss(self, x, labels, phase):
+        # as in prototype.learn
+        if phase == 3:
+            y_hat = self.model.classify_features(x)
+            loss_term_dict = {
+                'l1': tf.norm(self.model.classifier.trainable_weights[0], 1)
+            }
+        else:
+            y_hat, minimum_distances, _ = self.model(x)
+            loss_term_dict = self.model.conv_prototype_objective(
+                minimum_distances, label=labels)
+        loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=labels,
+                                                              logits=y_hat)
+        for term in ['cluster', 'l1', 'separation']:
+            if term in loss_term_dict:
+                loss += 0.1 * loss_term_dict[term]
+        return y_hat, loss, loss_term_dict
+
+    @parameterized.parameters(1, 3)
+    def test_matches_eager_reference(self, phase):
+        batches = self.data_dict['test']
+        if phase == 3:
+            batches = cache_prototype_activations(self.data_dict, self.model,
+                                                  'mnist_conv',
+                                                  tempfile.mkdtemp(), 2**30,
+                                                  0)['test']
+        batches = list(batches)
+        loss_sum, correct, count = 0., 0, 0
+        for batch in batches:
+            labels = tf.cast(batch['label'], tf.int32)
+            y_hat, loss, _ = self.compute_loss(normalize_image(batch['image']),
+                                               labels, phase)
+            loss_sum += float(tf.reduce_sum(loss))
+            correct += int(
+                tf.reduce_sum(
+                    tf.cast(
+                        tf.equal(tf.argmax(y_hat, axis=1, output_type=tf.int32),
+                                 labels), tf.int32)))
+            count += int(labels.shape[0])
+
+        global_step = tf.compat.v1.train.get_or_create_global_step()
+        step = int(global_step)
+        evaluate = Evaluator(self.compute_loss)
+        num_traces = []
+        for _ in range(2):
+            loss, accuracy = evaluate(batches, phase)
+            np.testing.assert_allclose(loss, loss_sum / count, rtol=1e-5)
+            assert accuracy == correct / count
+            num_traces.append(
+                evaluate.eval_step.experimental_get_tracing_count())
+        assert int(global_step) == step
+        # a full and a partial batch, after which the trace is reused
+        assert num_traces[0] <= 2 and num_traces[1] == num_traces[0]
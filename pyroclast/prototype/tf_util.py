@@ -1,13 +1,18 @@
+import functools
+
+import numpy as np
 import tensorflow as tf
 
 
-def l2_convolution(images, vectors):
+def l2_distance(images, vectors):
     '''
-    Calculate pairwise l2 distance between the patches of an image and an array of vectors
+    Calculate pairwise squared l2 distance between the patches of an image and an array of vectors
 
-    Calculating the l2 distance between each of the HxW patches and the
-    N_2 vectors. Naively, this would require looping O(n^2) times, but
-    a convolution makes the control flow moot.
+    Each of the HxW patches is a row of a [N_1*H*W, C] matrix, so the
+    cross term with all N_2 vectors is a single matrix multiply.
+    Distances are clamped at zero, as rounding can make them slightly
+    negative. The clamp zeroes the gradient of those distances, which
+    are within rounding of zero, where the exact gradient is near zero.
 
     Args:
         images (tf.Tensor): shape [N_1,H,W,C] activation images
@@ -16,21 +21,72 @@ def l2_convolution(images, vectors):
     Returns:
         tf.Tensor of l2 distances with shape [N_1, H, W, N_2]
     '''
-    # shape [N_1,H,W,N_2]
-    image_sq = tf.nn.conv2d(input=images**2,
-                            filters=tf.ones(
-                                [1, 1, images.shape[-1], vectors.shape[0]]),
-                            strides=1,
-                            padding="SAME")
-
+    patches = tf.reshape(images, [-1, images.shape[-1]])
+    # shape [N_1*H*W, 1]
+    patches_sq = tf.reduce_sum(patches**2, axis=1, keepdims=True)
     # shape [N_2]
-    vectors_sq = tf.reduce_sum(vectors**2, 1)
-
-    vector_filters = tf.expand_dims(tf.expand_dims(tf.transpose(vectors), 0), 0)
-    # shape [N_1,H,W,N_2]
-    image_vector_prod = tf.nn.conv2d(input=images,
-                                     filters=vector_filters,
-                                     strides=1,
-                                     padding="SAME")
+    vectors_sq = tf.reduce_sum(vectors**2, axis=1)
+    # shape [N_1*H*W, N_2]
+    patch_vector_prod = tf.matmul(patches, vectors, transpose_b=True)
     # equiv to $(x - y)^2$
-    return image_sq - (2 * image_vector_prod) + vectors_sq
+    distances = tf.maximum(patches_sq - 2 * patch_vector_prod + vectors_sq, 0.)
+    return tf.reshape(
+        distances, tf.concat([tf.shape(images)[:-1], [tf.shape(vectors)[0]]],
+                             0))
+
+
+def distance_similarity(distances, epsilon=1e-4):
+    '''
+    Similarity log((d + 1) / (d + epsilon)), which decreases with distance
+    '''
+    return tf.math.log((distances + 1) / (distances + epsilon))
+
+
+def min_l2_distance(images, vectors, epsilon=1e-4):
+    '''
+    Calculate the minimum distance and maximum similarity of each vector over all patches
+
+    As similarity decreases with distance, the maximum similarity is
+    that of the minimum distance, so similarities are only calculated
+    for the N_1 x N_2 minima.
+
+    Args:
+        images (tf.Tensor): shape [N_1,H,W,C] activation images
+        vectors (tf.Tensor): shape [N_2,C] list of vectors
+        epsilon (float): Optional, some sufficiently small value
+
+    Returns:
+        min_distances (tf.Tensor): shape [N_1, N_2]
+        max_similarities (tf.Tensor): shape [N_1, N_2]
+    '''
+    min_distances = tf.reduce_min(l2_distance(images, vectors), axis=[1, 2])
+    return min_distances, distance_similarity(min_distances, epsilon)
+
+
+@functools.lru_cache(maxsize=None)
+def bilinear_upsampling_matrix(in_size, out_size):
+    '''
+    Linear operator of a 1D bilinear resize, as done by `tf.image.resize`
+
+    Resizing an [H_in, W_in] map to [H_out, W_out] is then
+    `A @ map @ B.T` where A is the [H_out, H_in] matrix and B the
+    [W_out, W_in] one. Matrices are cached, so a size pair is only
+    built once.
+
+    Args:
+        in_size (int): Length of the input axis
+        out_size (int): Length of the output axis
+
+    Returns:
+        np.array of shape [out_size, in_size], each row sums to 1
+    '''
+    # half pixel centers, clamped to the edge pixels
+    source = (np.arange(out_size) + 0.5) * (in_size / out_size) - 0.5
+    source = np.clip(source, 0, in_size - 1)
+    lower = np.floor(source).astype(np.int64)
+    upper = np.minimum(lower + 1, in_size - 1)
+    fraction = source - lower
+    matrix = np.zeros([out_size, in_size], dtype=np.float32)
+    np.add.at(matrix, (np.arange(out_size), lower), 1 - fraction)
+    np.add.at(matrix, (np.arange(out_size), upper), fraction)
+    return matrix
@@ -0,0 +1,65 @@
+import numpy as np
+import tensorflow as tf
+from absl.testing import parameterized
+
+from pyroclast.prototype.tf_util import (bilinear_upsampling_matrix,
+                                         distance_similarity, l2_distance,
+                                         min_l2_distance)
+
+
+class PrototypeTfUtilTest(parameterized.TestCase):
+
+    def setUp(self):
+        self.images = tf.random.uniform([3, 7, 7, 16])
+        self.vectors = tf.random.uniform([10, 16])
+
+    def test_l2_distance(self):
+        expected = np.sum(np.square(self.images.numpy()[..., None, :] -
+                                    self.vectors.numpy()),
+                          axis=-1)
+        distances = l2_distance(self.images, self.vectors)
+        assert distances.shape == (3, 7, 7, 10)
+        np.testing.assert_allclose(distances, expected, rtol=1e-4, atol=1e-4)
+
+    @parameterized.parameters(False, True)
+    def test_l2_distance_gradients(self, pushed):
+        vectors = self.vectors
+        if pushed:
+            # pushed prototypes are patches, whose distance may clamp at 0
+            vectors = tf.concat(
+                [vectors[2:],
+                 tf.reshape(self.images, [-1, 16])[:2]], 0)
+        weights = tf.random.normal([3, 7, 7, 10])
+
+        def gradients(distance_fn):
+            with tf.GradientTape() as tape:
+                tape.watch([self.images, vectors])
+                loss = tf.reduce_sum(weights *
+                                     distance_fn(self.images, vectors))
+            return tape.gradient(loss, [self.images, vectors])
+
+        broadcast_distance = lambda images, vectors: tf.reduce_sum(
+            tf.square(images[..., None, :] - vectors), axis=-1)
+        for gradient, expected in zip(gradients(l2_distance),
+                                      gradients(broadcast_distance)):
+            np.testing.assert_allclose(gradient, expected, atol=1e-4)
+
+    def test_min_l2_distance(self):
+        distances = l2_distance(self.images, self.vectors)
+        min_distances, max_similarities = min_l2_distance(
+            self.images, self.vectors)
+        np.testing.assert_allclose(min_distances,
+                                   tf.reduce_min(distances, [1, 2]))
+        np.testing.assert_allclose(max_similarities,
+                                   tf.reduce_max(distance_similarity(distances),
+                                                 [1, 2]),
+                                   rtol=1e-5)
+
+    @parameterized.parameters((7, 28), (7, 224), (7, 30))
+    def test_bilinear_upsampling_matrix(self, in_size, out_size):
+        maps = self.images[..., :2]
+        matrix = bilinear_upsampling_matrix(in_size, out_size)
+        upsampled = tf.einsum('hi,nijc,wj->nhwc', matrix, maps, matrix)
+        np.testing.assert_allclose(upsampled,
+                                   tf.image.resize(maps, [out_size, out_size]),
+                                   atol=1e-5)
@@ -8,6 +8,7 @@ import tensorflow as tf
 from tensorflow.python.client import device_lib
 
 from pyroclast.common.cmd_util import common_arg_parser, parse_unknown_args
+from pyroclast.common.data_server import setup_data_server
 from pyroclast.common.datasets import check_datasets, get_dataset_builder
 from pyroclast.common.tf_util import setup_tfds
 
@@ -62,7 +63,16 @@ def run_task(args, extra_args):
     task_func = get_task_function(args.module, args.task, args.submodule)
     module_kwargs = get_task_function_defaults(args.module, args.dataset)
     module_kwargs.update(extra_args)
-    if check_datasets(args.dataset):
+    if args.data_server is not None:
+        data_dict = setup_data_server(args.data_server,
+                                      args.dataset,
+                                      args.batch_size,
+                                      args.resize_data_shape,
+                                      args.data_limit,
+                                      shuffle_seed=args.seed,
+                                      normalize=args.normalize_data,
+                                      drop_remainder=args.drop_remainder)
+    elif check_datasets(args.dataset):
         data_dict = get_dataset_builder(args.dataset)(args.batch_size,
                                                       args.resize_data_shape,
                                                       args.data_limit,
@@ -73,7 +83,12 @@ def run_task(args, extra_args):
                                args.resize_data_shape,
                                args.data_limit,
                                args.data_dir,
-                               shuffle_seed=args.seed)
+                               shuffle_seed=args.seed,
+                               shuffle_buffer_size=args.shuffle_buffer_size,
+                               cache=args.cache_data,
+                               normalize=args.normalize_data,
+                               drop_remainder=args.drop_remainder,
+                               snapshot_dir=args.snapshot_dir)
 
     print('Running {} on {} with arguments \n{}'.format(args.task, args.module,
                                                         args.dataset,
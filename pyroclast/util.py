@@ -14,6 +14,8 @@ def direct(func):
         data_dir = kwargs['data_dir'] if 'data_dir' in kwargs else None
         seed = kwargs['seed'] if 'seed' in kwargs else None
         output_dir = kwargs['output_dir'] if 'output_dir' in kwargs else './'
+        # consumed here, the wrapped function doesn't take it
+        snapshot_dir = kwargs.pop('snapshot_dir', None)
         if check_datasets(dataset):
             data_dict = get_dataset_builder(dataset)(batch_size,
                                                      resize_data_shape,
@@ -24,7 +26,8 @@ def direct(func):
                                    resize_data_shape,
                                    data_limit,
                                    data_dir,
-                                   shuffle_seed=seed)
+                                   shuffle_seed=seed,
+                                   snapshot_dir=snapshot_dir)
 
         kwargs['data_dict'] = data_dict
         func(*args, **kwargs)